@@ -0,0 +1,406 @@
+#! /usr/bin/env python
+
+'''
+Timing benchmarks for the slower pieces of the StackedLayers pipeline.
+
+Usage:
+    ./benchmarks.py concat
+    ./benchmarks.py lcn
+    ./benchmarks.py tica
+    ./benchmarks.py float32
+    ./benchmarks.py ticacost
+    ./benchmarks.py ticachunked
+    OMP_NUM_THREADS=1 ./benchmarks.py ticathreads
+    OMP_NUM_THREADS=1 ./benchmarks.py fpparallel
+    ./benchmarks.py dataload
+'''
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import tempfile
+import shutil
+from numpy import *
+
+from util.misc import importFromFile
+from util.fileIO import datasetPath, blosc, zstd
+from util.dataLoaders import saveToFile, loadUpsonData3, saveLoadedDataset
+from layers import DataArrangement, ConcatenationLayer, LcnLayer, TicaLayer
+from tica import TICA, neighborMatrix
+from stackedLayers import StackedLayers
+
+
+
+def timeit(func, repeats = 3):
+    '''Returns the best wall time of repeats calls to func, in seconds,
+    and the result of the last call.'''
+    best = None
+    for ii in range(repeats):
+        tic = time.time()
+        ret = func()
+        elapsed = time.time() - tic
+        best = elapsed if best is None else min(best, elapsed)
+    return best, ret
+
+
+
+def benchConcat(nSlices = 2000, quick = False):
+    '''Compares the strided and loop versions of ConcatenationLayer._forwardProp.'''
+
+    if quick:
+        nSlices = 50
+
+    # (inputSize, sliceShape, concat, stride)
+    configs = [((8,8),    (2,2),  (2,2), (2,2)),     # as in the tica-16-16-16-16-16 layers files
+               ((8,8),    (4,4),  (2,2), (2,2)),
+               ((8,8),    (4,4),  (2,2), (1,1)),
+               ((8,8),    (8,8),  (3,3), (1,1)),
+               ((8,8,3),  (4,4),  (2,2), (2,2)),
+               ((16,16),  (2,2),  (2,2), (1,1)),
+               ]
+
+    rng = random.RandomState(0)
+    print '%-10s %-8s %-8s %-8s %12s %12s %9s  %s' % ('inputSize', 'slice', 'concat', 'stride',
+                                                     'loop (s)', 'strided (s)', 'speedup', 'match')
+    for inputSize, sliceShape, concat, stride in configs:
+        layer = ConcatenationLayer({'name': 'cat', 'type': 'concat', 'concat': concat, 'stride': stride})
+        layer.inputSize = inputSize
+        layer.outputSize = layer.calculateOutputSize(inputSize)
+
+        data = rng.normal(0, 1, (prod(inputSize), prod(sliceShape) * nSlices))
+        arrangement = DataArrangement(sliceShape, nSlices)
+
+        layer.referenceImpl = True
+        loopTime, (loopOut, junk) = timeit(lambda : layer.forwardProp(data, arrangement, quiet = True), repeats = 1)
+        layer.referenceImpl = False
+        stridedTime, (stridedOut, junk) = timeit(lambda : layer.forwardProp(data, arrangement, quiet = True))
+
+        print '%-10s %-8s %-8s %-8s %12.4f %12.4f %8.1fx  %s' % (repr(inputSize), repr(sliceShape), repr(concat), repr(stride),
+                                                                loopTime, stridedTime, loopTime / stridedTime,
+                                                                array_equal(loopOut, stridedOut))
+
+
+
+def nWorkersList():
+    '''1, 2, 4, ... up to the number of cores.'''
+    nList = [1]
+    while nList[-1] * 2 <= multiprocessing.cpu_count():
+        nList.append(nList[-1] * 2)
+    if nList[-1] != multiprocessing.cpu_count():
+        nList.append(multiprocessing.cpu_count())
+    return nList
+
+
+
+def benchParallelForwardProp(nSamples = 20000, quick = False):
+    '''Times StackedLayers.forwardPropPixelSamples with 1 to N processes.
+    Run with OMP_NUM_THREADS=1 (or similar) so each process uses one core.'''
+
+    if quick:
+        nSamples = 1000
+
+    ll = [{'name': 'data', 'type': 'data', 'dataClass': 'UpsonData3',
+           'imageSize': (240,320), 'patchSize': (10,10), 'stride': (10,10), 'colors': 1}]
+    for ii in (1, 2):
+        ll.append({'name': 'tica%d' % ii, 'type': 'tica', 'hiddenSize': (16,16),
+                   'neighborhood': ('gaussian', 1.5, 0, 0), 'lambd': .03, 'epsilon': 1e-5})
+        ll.append({'name': 'ds%d' % ii, 'type': 'downsample', 'factor': (2,2)})
+        ll.append({'name': 'lcn%d' % ii, 'type': 'lcn', 'gaussWidth': 2.0})
+        if ii == 1:
+            ll.append({'name': 'cat%d' % ii, 'type': 'concat', 'concat': (2,2), 'stride': (2,2)})
+    sl = StackedLayers(ll)
+    for layer in sl.layers:
+        if layer.trainable:
+            layer.initialize(seed = 0)    # untrained weights are fine for timing
+
+    rng = random.RandomState(0)
+    largePatches = rng.uniform(0, 1, (20*20, nSamples)).astype(float32)
+
+    nProcsList = nWorkersList()
+
+    print '%6s %12s %9s  %s' % ('nProcs', 'time (s)', 'speedup', 'match')
+    serialTime, (serialOut, junk) = timeit(lambda : sl.forwardPropPixelSamples(largePatches, quiet = True), repeats = 1)
+    for nProcs in nProcsList:
+        elapsed, (out, junk) = timeit(lambda : sl.forwardPropPixelSamples(largePatches, quiet = True, nProcs = nProcs), repeats = 1)
+        print '%6d %12.4f %8.2fx  %s' % (nProcs, elapsed, serialTime / elapsed, array_equal(out, serialOut))
+
+
+
+def benchLcn(nExamples = 20000, quick = False):
+    '''Compares LcnLayer forward prop against the old version, which
+    rebuilt the dense Gaussian neighbor matrix on every call.'''
+
+    if quick:
+        nExamples = 1000
+
+    def oldLcn(data, inputSize, gaussWidth):
+        gaussNeighbors = neighborMatrix(inputSize, gaussWidth, gaussian=True)
+        vv = data - dot(gaussNeighbors, data)
+        sig = sqrt(dot(gaussNeighbors, vv**2))
+        return vv / maximum(.01, sig)
+
+    rng = random.RandomState(0)
+    print '%-10s %10s %12s %12s %12s %9s  %s' % ('inputSize', 'storage', 'build (s)', 'old fp (s)', 'new fp (s)', 'speedup', 'max diff')
+    for inputSize in ((8,8), (16,16), (32,32)):
+        layer = LcnLayer({'name': 'lcn', 'type': 'lcn', 'gaussWidth': 2.0})
+        layer.inputSize = inputSize
+        layer.outputSize = layer.calculateOutputSize(inputSize)
+        data = rng.normal(0, 1, (prod(inputSize), nExamples))
+        arrangement = DataArrangement((1,1), nExamples)
+
+        buildTime, gaussNeighbors = timeit(layer.gaussNeighbors, repeats = 1)
+        oldTime, oldOut = timeit(lambda : oldLcn(data, inputSize, 2.0), repeats = 1)
+        newTime, (newOut, junk) = timeit(lambda : layer.forwardProp(data, arrangement, quiet = True))
+        print '%-10s %10s %12.4f %12.4f %12.4f %8.1fx  %g' % (repr(inputSize), 'dense' if isinstance(gaussNeighbors, ndarray) else 'sparse',
+                                                             buildTime, oldTime, newTime, oldTime / newTime, abs(oldOut - newOut).max())
+
+
+
+def benchTicaNeighbors(nExamples = 5000, quick = False):
+    '''Times building the TICA neighbor matrix and the TICA cost with a
+    dense vs. sparse neighbor matrix, for increasingly large hidden layers.'''
+
+    if quick:
+        nExamples = 500
+
+    rng = random.RandomState(0)
+    nInputs = 100
+    data = rng.normal(0, 1, (nInputs, nExamples))
+    print '%-10s %9s %12s %12s %12s %12s  %s' % ('hidden', 'density', 'build (s)', 'dense (s)', 'sparse (s)', 'speedup', 'max rel diff')
+    for hiddenLayerShape in ((16,16), (32,32), (64,64)):
+        buildTime, HH = timeit(lambda : neighborMatrix(hiddenLayerShape, 1.5, gaussian = True, sparse = True), repeats = 1)
+        tica = TICA(nInputs = nInputs, hiddenLayerShape = hiddenLayerShape, neighborhoodParams = ('gaussian', 1.5, 0, 0),
+                    lambd = .05, epsilon = 1e-5, initWW = False)
+        tica.initWW(seed = 0)
+        tica.HH = HH
+        sparseTime, sparseCost = timeit(lambda : tica.cost(tica.WW, data), repeats = 1)
+        tica.HH = HH.toarray()
+        denseTime, denseCost = timeit(lambda : tica.cost(tica.WW, data), repeats = 1)
+        relDiff = abs(sparseCost[3] - denseCost[3]).max() / abs(denseCost[3]).max()
+        print '%-10s %9.4f %12.4f %12.4f %12.4f %11.1fx  %g' % (repr(hiddenLayerShape), HH.nnz / float(prod(HH.shape)),
+                                                               buildTime, denseTime, sparseTime, denseTime / sparseTime, relDiff)
+
+
+
+def benchFloat32(nExamples = 50000, quick = False):
+    '''Compares TICA cost and getRepresentation in float32 vs. float64
+    for the TICA layers in the shipped Upson and NYU layer files.'''
+
+    if quick:
+        nExamples = 2000
+
+    paramsDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'params')
+    layerFiles = ['upson3-1c-10--tica-16-16-16-16-16.layers',
+                  'nyu-1c-10--tica-16-16-16-16-16.layers',
+                  'nyu-1d-10--tica-16-16-16-16-16.layers']
+
+    # Collect distinct TICA configurations
+    configs = []
+    for layerFile in layerFiles:
+        sl = StackedLayers(importFromFile(os.path.join(paramsDir, layerFile), 'layers'))
+        for layer in sl.layers:
+            if isinstance(layer, TicaLayer):
+                config = (prod(layer.inputSize), layer.hiddenSize, layer.neighborhood, layer.lambd, layer.epsilon)
+                if config not in configs:
+                    configs.append(config)
+
+    rng = random.RandomState(0)
+    print '%-8s %-10s %12s %12s %9s %12s %12s %9s %12s %12s' % ('nInputs', 'hidden', 'cost64 (s)', 'cost32 (s)', 'speedup',
+                                                             'fp64 (s)', 'fp32 (s)', 'speedup', 'cost rdiff', 'grad rdiff')
+    for nInputs, hiddenSize, neighborhood, lambd, epsilon in configs:
+        data = rng.normal(0, 1, (nInputs, nExamples))
+        data /= sqrt(sum(data**2, 0))          # like the unit norm whitener output
+        data32 = data.astype(float32)
+        results = {}
+        for useFloat32, dat in ((False, data), (True, data32)):
+            tica = TICA(nInputs = nInputs, hiddenLayerShape = hiddenSize, neighborhoodParams = neighborhood,
+                        lambd = lambd, epsilon = epsilon, float32 = useFloat32, initWW = False)
+            tica.initWW(seed = 0)
+            costTime, costEtc = timeit(lambda : tica.cost(tica.WW.flatten(), dat))
+            fpTime, junk = timeit(lambda : tica.getRepresentation(dat))
+            results[useFloat32] = (costTime, fpTime, costEtc[0], costEtc[3])
+        (costTime64, fpTime64, cost64, grad64), (costTime32, fpTime32, cost32, grad32) = results[False], results[True]
+        print '%-8d %-10s %12.4f %12.4f %8.2fx %12.4f %12.4f %8.2fx %12.2g %12.2g' % (
+            nInputs, repr(hiddenSize), costTime64, costTime32, costTime64 / costTime32,
+            fpTime64, fpTime32, fpTime64 / fpTime32,
+            abs(cost32 - cost64) / abs(cost64), linalg.norm(grad32 - grad64) / linalg.norm(grad64))
+
+
+
+def benchTicaCost(nExamples = 50000, nCalls = 5, quick = False):
+    '''Compares TICA.cost (workspace buffers) against
+    TICA._costReference, as in repeated calls from L-BFGS, and prints
+    the per-phase time breakdown.'''
+
+    if quick:
+        nExamples = 2000
+
+    rng = random.RandomState(0)
+    nInputs = 256
+    for useFloat32 in (False, True):
+        data = rng.normal(0, 1, (nInputs, nExamples)).astype(float32 if useFloat32 else float64)
+        tica = TICA(nInputs = nInputs, hiddenLayerShape = (16,16), neighborhoodParams = ('gaussian', 1.5, 0, 0),
+                    lambd = .03, epsilon = 1e-5, float32 = useFloat32, initWW = False)
+        tica.initWW(seed = 0)
+        WW = tica.WW.flatten()
+
+        # Alternate between the two versions, as the timings are noisy
+        refTime = newTime = None
+        for ii in range(nCalls):
+            tica.referenceImpl = True
+            elapsed, refResult = timeit(lambda : tica.cost(WW, data), repeats = 1)
+            refTime = elapsed if refTime is None else min(refTime, elapsed)
+            tica.referenceImpl = False
+            if ii == 0:
+                tica.costTimes.clear()
+            elapsed, newResult = timeit(lambda : tica.cost(WW, data), repeats = 1)
+            newTime = elapsed if newTime is None else min(newTime, elapsed)
+        identical = refResult[:3] == newResult[:3] and array_equal(refResult[3], newResult[3])
+
+        print '\n%s, best of %d calls: reference %.4fs, workspace %.4fs (%.2fx), identical: %s' % (
+            'float32' if useFloat32 else 'float64', nCalls, refTime, newTime, refTime / newTime, identical)
+        tica.printCostTimes()
+
+
+
+def benchTicaChunked(nExamples = 100000, quick = False):
+    '''Compares TICA.cost on an in-memory array with chunked cost on a
+    memmap of the same data, for several chunk sizes. Reports the
+    memory held in the cost workspaces, which scales with the chunk
+    size instead of the number of examples.'''
+
+    if quick:
+        nExamples = 5000
+
+    def workspaceBytes(tica):
+        return sum([sum([buf.nbytes for buf in ws.buffers.values()]) for ws in tica._workspaces.values()])
+
+    rng = random.RandomState(0)
+    nInputs = 300
+    tempDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempDir, 'data.npy')
+        save(filename, rng.normal(0, 1, (nInputs, nExamples)))
+        data = load(filename)
+        dataMemmap = load(filename, mmap_mode = 'r')
+
+        tica = TICA(nInputs = nInputs, hiddenLayerShape = (16,16), neighborhoodParams = ('gaussian', 1.5, 0, 0),
+                    lambd = .03, epsilon = 1e-5, initWW = False)
+        tica.initWW(seed = 0)
+        WW = tica.WW.flatten()
+
+        print '%-12s %10s %16s %12s %12s' % ('chunkSize', 'time (s)', 'workspace (MB)', 'cost rdiff', 'grad rdiff')
+        refTime, ref = timeit(lambda : tica.cost(WW, data), repeats = 1)
+        print '%-12s %10.4f %16.1f %12s %12s' % ('in memory', refTime, workspaceBytes(tica) / 1e6, '-', '-')
+        for chunkSize in (1000, 10000, 50000):
+            tica._workspaces.clear()
+            tica.chunkSize = chunkSize
+            elapsed, out = timeit(lambda : tica.cost(WW, dataMemmap), repeats = 1)
+            print '%-12d %10.4f %16.1f %12.2g %12.2g' % (chunkSize, elapsed, workspaceBytes(tica) / 1e6,
+                                                         abs(out[0] - ref[0]) / abs(ref[0]),
+                                                         linalg.norm(out[3] - ref[3]) / linalg.norm(ref[3]))
+    finally:
+        shutil.rmtree(tempDir)
+
+
+
+def benchTicaThreads(nExamples = 100000, quick = False):
+    '''Times TICA.cost with 1 to N threads. Run with OMP_NUM_THREADS=1
+    (or similar) so that BLAS does not start threads of its own.'''
+
+    if quick:
+        nExamples = 5000
+
+    rng = random.RandomState(0)
+    nInputs = 256
+    data = rng.normal(0, 1, (nInputs, nExamples))
+    tica = TICA(nInputs = nInputs, hiddenLayerShape = (16,16), neighborhoodParams = ('gaussian', 1.5, 0, 0),
+                lambd = .03, epsilon = 1e-5, initWW = False)
+    tica.initWW(seed = 0)
+    WW = tica.WW.flatten()
+
+    print '%8s %12s %9s %12s %12s  %s' % ('nThreads', 'time (s)', 'speedup', 'cost rdiff', 'grad rdiff', 'reproducible')
+    serialTime, serial = timeit(lambda : tica.cost(WW, data))
+    for nThreads in nWorkersList():
+        tica.nThreads = nThreads
+        elapsed, out = timeit(lambda : tica.cost(WW, data))
+        again = tica.cost(WW, data)
+        print '%8d %12.4f %8.2fx %12.2g %12.2g  %s' % (nThreads, elapsed, serialTime / elapsed,
+                                                       abs(out[0] - serial[0]) / abs(serial[0]),
+                                                       linalg.norm(out[3] - serial[3]) / linalg.norm(serial[3]),
+                                                       out[0] == again[0] and array_equal(out[3], again[3]))
+
+
+
+def benchDataLoad(nExamples = 50000, quick = False):
+    '''Compares loading an upson_rovio_3 style data file (10x10 color
+    patches with labels) from a .pkl.gz against loading it from a
+    dataset, uncompressed (a memmap) and with each available
+    compression. "load + pass" also reads all of the data once.'''
+
+    if quick:
+        nExamples = 5000
+
+    rng = random.RandomState(0)
+    imageMatrix = rng.randint(0, 256, (nExamples, 300)) / 255.0    # one example per row, as made by makeUpsonRovio3
+    labelMatrix = (rng.uniform(0, 1, (nExamples, 13)) > .7).astype(float)
+    labelStrings = ['label%d' % ii for ii in range(13)]
+
+    def dirSize(path):
+        if os.path.isdir(path):
+            return sum([os.path.getsize(os.path.join(path, ff)) for ff in os.listdir(path)])
+        return os.path.getsize(path)
+
+    tempDir = tempfile.mkdtemp()
+    try:
+        pklFile = os.path.join(tempDir, 'train_10_%d_3c.pkl.gz' % nExamples)
+        saveToFile(pklFile, (imageMatrix, labelMatrix, labelStrings), quiet = True)
+        refTime, ref = timeit(lambda : loadUpsonData3(pklFile), repeats = 1)
+
+        print '%-14s %10s %12s %16s  %s' % ('format', 'size (MB)', 'load (s)', 'load + pass (s)', 'match')
+        print '%-14s %10.1f %12.4f %16.4f  %s' % ('pkl.gz', dirSize(pklFile) / 1e6, refTime,
+                                                  refTime + timeit(lambda : ref[0].sum(), repeats = 1)[0], True)
+        compressions = [None, 'zlib'] + (['blosc'] if blosc else []) + (['zstd'] if zstd else [])
+        for compression in compressions:
+            filename = os.path.join(tempDir, '%s.pkl.gz' % compression)
+            saveLoadedDataset(filename, ref, compression = compression, quiet = True)
+            elapsed, out = timeit(lambda : loadUpsonData3(filename))
+            passTime, junk = timeit(lambda : loadUpsonData3(filename)[0].sum())
+            print '%-14s %10.1f %12.4f %16.4f  %s' % ('dset ' + (compression or '(memmap)'), dirSize(datasetPath(filename)) / 1e6,
+                                                      elapsed, passTime,
+                                                      array_equal(out[0], ref[0]) and array_equal(out[1], ref[1]) and out[2] == ref[2])
+    finally:
+        shutil.rmtree(tempDir)
+
+
+
+benchmarks = {'concat':     benchConcat,
+              'fpparallel': benchParallelForwardProp,
+              'lcn':        benchLcn,
+              'tica':       benchTicaNeighbors,
+              'float32':    benchFloat32,
+              'ticacost':   benchTicaCost,
+              'ticachunked': benchTicaChunked,
+              'ticathreads': benchTicaThreads,
+              'dataload':   benchDataLoad,
+              }
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs timing benchmarks.')
+    parser.add_argument('benchmark', type = str, choices = sorted(benchmarks.keys()), nargs = '+',
+                        help = 'Which benchmark(s) to run')
+    parser.add_argument('--quick', action='store_true', help = 'Enable quick mode (default: off)')
+    args = parser.parse_args()
+
+    for name in args.benchmark:
+        print '\nBenchmark: %s' % name
+        benchmarks[name](quick = args.quick)
+
+
+
+if __name__ == '__main__':
+    main()
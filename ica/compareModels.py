@@ -7,13 +7,12 @@ from numpy import *
 
 from GitResultsManager import resman
 
-from util.dataLoaders import loadCifarData, loadCifarDataMonochrome, loadCifarDataSubsets
+from util.dataLoaders import loadCifarData, loadCifarDataMonochrome, loadCifarDataSubsets, loadUpsonData
 
 
 
 def main():
-    data = loadFromPklGz('../data/upson_rovio_2/train_10_50000_1c.pkl.gz')
-    data = data.T   # Make into one example per column
+    data = loadUpsonData('../data/upson_rovio_2/train_10_50000_1c.pkl.gz')   # one example per column
     data = data[:,:5000]      # HACK!!!!!!!!!
     
     hiddenISize = 8
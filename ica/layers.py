@@ -15,7 +15,7 @@ from numpy import *
 from scipy.optimize import minimize
 
 from util.cache import cached, PersistentHasher, persistentHash
-from util.misc import invSigmoid01
+from util.misc import invSigmoid01, stridedWindows
 from GitResultsManager import resman, fmtSeconds
 from util.dataPrep import PCAWhiteningDataNormalizer
 from util.dataLoaders import loadNYU2Data, loadCS294Images
@@ -26,7 +26,7 @@ from visualize import plotImageData
 
 
 
-MAX_CACHE_SIZE_MB = 500
+MAX_CACHE_SIZE_MB = 500          # largest NYU2 data to cache; the whole cache is limited by util.cache.globalCacheMaxSizeMB
 
 class DataArrangement(object):
     '''Represents a particular arragement of data. Example: 1000 slices of 2 x
@@ -386,11 +386,11 @@ class UpsonData3(ImageDataLayer):
             return (self.patchSize[0], self.patchSize[1], 3)
 
     def getData(self, patchSize, number, seed = None):
-        samples, labelMatrix, labelStrings = cached(makeUpsonRovio3.randomSampleMatrixWithLabels,
-                                                    makeUpsonRovio3.trainFilter,
-                                                    color = (self.colors == 3),
-                                                    Nw = patchSize, Nsamples = number, seed = seed,
-                                                    imgDirectory = '../data/upson_rovio_3/imgfiles')
+        # Not cached: sampling from the image store is faster than loading a cached result
+        samples, labelMatrix, labelStrings = makeUpsonRovio3.randomSampleMatrixWithLabels(makeUpsonRovio3.trainFilter,
+                                                                                         color = (self.colors == 3),
+                                                                                         Nw = patchSize, Nsamples = number, seed = seed,
+                                                                                         imgDirectory = '../data/upson_rovio_3/imgfiles')
 
         return samples.T    # one example per column
 
@@ -483,7 +483,9 @@ class PCAWhiteningLayer(NormalizingLayer):
         self.pcaWhiteningDataNormalizer = None
 
     def _train(self, data, dataArrangement, trainParams = None, quick = False):
-        self.pcaWhiteningDataNormalizer = PCAWhiteningDataNormalizer(data)
+        # if trainParams has a chunkSize, data (e.g. a memmap) is streamed in chunks (see PCA)
+        chunkSize = trainParams.get('chunkSize') if trainParams else None
+        self.pcaWhiteningDataNormalizer = PCAWhiteningDataNormalizer(data, chunkSize = chunkSize)
 
     @noHint
     def _forwardProp(self, data, dataArrangement, sublayer):
@@ -558,6 +560,7 @@ class StretchingLayer(TrainableLayer):
 class TicaLayer(TrainableLayer):
 
     nSublayers = 2   # hidden representation + pooled representation
+    float32 = False  # Class attribute so older pickled layers pick it up
 
     def __init__(self, params):
         super(TicaLayer, self).__init__(params)
@@ -566,6 +569,7 @@ class TicaLayer(TrainableLayer):
         self.neighborhood = params['neighborhood']
         self.lambd = params['lambd']
         self.epsilon = params['epsilon']
+        self.float32 = params.get('float32', False)    # train and forward prop in single precision
         self.tica = None
 
         assert isinstance(self.hiddenSize, tuple)
@@ -582,18 +586,27 @@ class TicaLayer(TrainableLayer):
                          neighborhoodParams = self.neighborhood,
                          lambd              = self.lambd,
                          epsilon            = self.epsilon,
+                         float32            = self.float32,
                          initWW             = False)
         self.tica.initWW(seed)
 
     def _train(self, data, dataArrangement, trainParams, quick = False):
-        maxFuncCalls = trainParams['maxFuncCalls']
-        if quick:
-            print 'QUICK MODE: chopping maxFuncCalls from %d to 1!' % maxFuncCalls
-            maxFuncCalls = 1
-            
+        method = trainParams.get('method', 'lbfgs')
+        if method == 'lbfgs':
+            maxFuncCalls = trainParams['maxFuncCalls']
+            if quick:
+                print 'QUICK MODE: chopping maxFuncCalls from %d to 1!' % maxFuncCalls
+                maxFuncCalls = 1
+            learnArgs = {'maxFun': maxFuncCalls}
+        else:
+            minibatchParams = dict((key, trainParams[key]) for key in TICA.minibatchParamNames if key in trainParams)
+            if quick:
+                print 'QUICK MODE: stopping %s after 1 minibatch!' % method
+                minibatchParams['maxIter'] = 1
+            learnArgs = {'method': method, 'minibatchParams': minibatchParams}
 
         tic = time.time()
-        self.tica.learn(data, maxFun = maxFuncCalls)
+        self.tica.learn(data, **learnArgs)
         execTime = time.time() - tic
         #if logDir:
         #    saveToFile(os.path.join(logDir, (prefix if prefix else '') + 'tica.pkl.gz'), tica)    # save learned model
@@ -916,19 +929,42 @@ class MaxPool(NonDataLayer):
 
 class LcnLayer(NonDataLayer):
 
+    sparseMaxDensity = .15    # store gaussNeighbors as a sparse matrix if at most this fraction is non-zero
+
     def __init__(self, params):
         super(LcnLayer, self).__init__(params)
         self.gaussWidth = params['gaussWidth']
+        self._gaussNeighbors = None    # (inputSize, matrix), built on first use
+
+    def gaussNeighbors(self):
+        '''Returns the Gaussian neighbor matrix used for LCN. It is
+        built only once (inputSize is not known until the layer is
+        stacked, so this happens on first use). Large, mostly zero
+        matrices (e.g. for 32x32 inputs) are stored in CSR format.'''
+
+        built = getattr(self, '_gaussNeighbors', None)      # older pickled layers lack this
+        if built is None or built[0] != self.inputSize:
+            gaussNeighbors = neighborMatrix(self.inputSize, self.gaussWidth, gaussian=True, sparse=True)
+            if gaussNeighbors.nnz > self.sparseMaxDensity * prod(gaussNeighbors.shape):
+                gaussNeighbors = gaussNeighbors.toarray()
+            self._gaussNeighbors = (self.inputSize, gaussNeighbors)
+        return self._gaussNeighbors[1]
+
+    def __getstate__(self):
+        # The neighbor matrix is cheap to rebuild, so do not pickle it
+        state = self.__dict__.copy()
+        state['_gaussNeighbors'] = None
+        return state
 
     @noHint
     def _forwardProp(self, data, dataArrangement, sublayer):
         dimension, numExamples = data.shape
 
-        gaussNeighbors = neighborMatrix(self.inputSize, self.gaussWidth, gaussian=True)
+        gaussNeighbors = self.gaussNeighbors()
 
         # 2. LCN
-        vv = data - dot(gaussNeighbors, data)
-        sig = sqrt(dot(gaussNeighbors, vv**2))
+        vv = data - gaussNeighbors.dot(data)
+        sig = sqrt(gaussNeighbors.dot(vv**2))
         cc = .01     # ss = sorted(sig.flatten()); ss[len(ss)/10] = 0.026 in one test. So .01 seems about right.
         yy = vv / maximum(cc, sig)
 
@@ -938,11 +974,14 @@ class LcnLayer(NonDataLayer):
 
 class ConcatenationLayer(NonDataLayer):
 
+    referenceImpl = False      # default. Class attribute so older pickled layers pick it up.
+
     def __init__(self, params):
         super(ConcatenationLayer, self).__init__(params)
 
         self.concat = params['concat']
         self.stride = params['stride']
+        self.referenceImpl = params.get('referenceImpl', False)   # True to use the slow loop version
 
         assert isinstance(self.concat, tuple)
         assert isinstance(self.stride, tuple)
@@ -996,25 +1035,60 @@ class ConcatenationLayer(NonDataLayer):
         if tooSmall or any(remainders):
             raise Exception('%s cannot be evenly concatenated by concat %s and stride %s'
                             % (dataArrangement, self.concat, self.stride))
+        if len(dataArrangement.sliceShape) != len(self.concat):
+            raise Exception('%s does not match concat %s' % (dataArrangement, self.concat))
 
         reshapedData = reshape(data, (data.shape[0], dataArrangement.nSlices,) + dataArrangement.sliceShape)
 
         newDataArrangement = DataArrangement(newLayerShape, dataArrangement.nSlices)
 
+        if self.referenceImpl:
+            concatenatedData = self._concatenateLoop(reshapedData, newLayerShape, dataArrangement.nSlices)
+        else:
+            concatenatedData = self._concatenateStrided(reshapedData, newLayerShape, dataArrangement.nSlices)
+
+        return concatenatedData, newDataArrangement
+
+    def _concatenateStrided(self, reshapedData, newLayerShape, nSlices):
+        '''Vectorized version of _concatenateLoop. Works for any
+        number of slice dimensions (1D, 2D, ...) and any patch shape,
+        including color. Returns data of the same dtype as the input.'''
+
+        nDims = len(self.concat)
+        oldPatchLength = reshapedData.shape[0]
+
+        # windows.shape = (oldPatchLength, nSlices) + newLayerShape + concat. No copy yet.
+        windows = stridedWindows(reshapedData, self.concat, self.stride, axis = 2)
+
+        # Output rows are ordered (concat..., oldPatchLength) and output
+        # columns (nSlices, newLayerShape...), both in C-order, which is
+        # exactly the order in which _concatenateLoop fills them.
+        order = tuple(range(2+nDims, 2+2*nDims)) + (0, 1) + tuple(range(2, 2+nDims))
+        concatenatedData = empty((prod(self.concat) * oldPatchLength, nSlices * prod(newLayerShape)),
+                                 dtype = reshapedData.dtype)
+        concatenatedData.reshape(self.concat + (oldPatchLength, nSlices) + newLayerShape)[...] = windows.transpose(order)
+
+        assert concatenatedData.shape[0] == prod(self.outputSize)
+        return concatenatedData
+
+    def _concatenateLoop(self, reshapedData, newLayerShape, nSlices):
+        '''Original loop version, kept as a reference for checking
+        _concatenateStrided. Only works for 2D slices.'''
+
         # BEGIN: 2D data assumption
         # Note: this only works for 2D data! Add other cases if needed.
 
         assert len(self.concat) == 2, 'Only works for 2D data for now!'
-        assert len(dataArrangement.sliceShape) == 2, 'Only works for 2D data for now!'
+        assert len(newLayerShape) == 2, 'Only works for 2D data for now!'
 
         concatenatedData = zeros((prod(self.outputSize),
-                                  prod(newLayerShape) * dataArrangement.nSlices))
+                                  prod(newLayerShape) * nSlices))
         
         oldPatchLength = prod(self.inputSize)
         newPatchCounter = 0
         # Note: this code assumes the default numpy flattening order:
         # C-order, or row-major order.
-        for layerIdx in xrange(dataArrangement.nSlices):
+        for layerIdx in xrange(nSlices):
             for newPatchII in xrange(newLayerShape[0]):
                 for newPatchJJ in xrange(newLayerShape[1]):
                     oldPatchStartII = newPatchII * self.stride[0]
@@ -1031,7 +1105,7 @@ class ConcatenationLayer(NonDataLayer):
         assert curLoc == prod(self.outputSize)
         # END: 2D data assumption
 
-        return concatenatedData, newDataArrangement
+        return concatenatedData
 
 
 
@@ -41,6 +41,11 @@ def l2RowScaledGrad(xx, yy, outerDeriv):
 
 
 class RICA(object):
+
+    # trainParams keys passed through to runMinibatchOptimization
+    minibatchParamNames = ('epochs', 'maxIter', 'batchSize', 'learningRate', 'lrHalfLife', 'momentum',
+                           'decayRho', 'adaEpsilon', 'evalEvery', 'evalExamples', 'seed')
+
     def __init__(self, nInputs, nOutputs = 400, lambd = .005, epsilon = 1e-5,
                  float32 = False, saveDir = '', initWW = True):
         self.nInputs    = nInputs
@@ -89,6 +94,11 @@ class RICA(object):
         if self.nInputs != nInputs:
             raise Exception('Expected %d dimensional input, but got %d' % (self.nInputs, nInputs))
 
+        if self.float32:
+            # WW comes from the optimizer in float64. data should already be float32 (no copy then).
+            WW = array(WW, dtype='float32')
+            data = asarray(data, dtype='float32')
+
         # NOTE: Flattening and reshaping is in C order in numpy but Fortran order in Matlab. This should not matter.
         WW = WW.reshape(self.nOutputs, nInputs)
         WWold = WW
@@ -109,7 +119,7 @@ class RICA(object):
         # sparsity_cost = params.lambda * sum(sum(K));
         # K = 1./K;
         KK = sqrt(self.epsilon + hidden ** 2)
-        sparsityCost = self.lambd * sum(KK)
+        sparsityCost = self.lambd * sum(KK, dtype = float64)    # accumulate in float64 even for float32
         KK = 1/KK
 
         # % Reconstruction Loss and Back Prop
@@ -117,7 +127,7 @@ class RICA(object):
         # reconstruction_cost = 0.5 * sum(sum(diff.^2));
         # outderv = diff;
         reconDiff = reconstruction - data
-        reconstructionCost = .5 * sum(reconDiff ** 2)
+        reconstructionCost = .5 * sum(reconDiff ** 2, dtype = float64)
         outDeriv = reconDiff
 
         # % Backprop Output Layer
@@ -140,6 +150,9 @@ class RICA(object):
         # grad = grad(:);
         grad = l2RowScaledGrad(WWold, WW, WGrad)
         grad = grad.flatten()
+        if self.float32:
+            # convert back to keep fortran happy
+            grad = array(grad, dtype='float64')
 
         # % compute the cost comprised of: 1) sparsity and 2) reconstruction
         # cost = sparsity_cost + reconstruction_cost;
@@ -152,6 +165,11 @@ class RICA(object):
         return cost, sparsityCost, reconstructionCost, grad
 
 
+    def releaseCostBuffers(self):
+        '''Frees any memory cost keeps between calls. No-op here, see TICA.'''
+        pass
+
+
     def dataPrep(self, data, whiten, normData):
         raise Exception('Use other methods now')
         # deleted
@@ -160,10 +178,13 @@ class RICA(object):
 
     def runOptimization(self, data, maxFun, plotEvery):
 
-        # Convert to float32 to be faster, if desired
-        if self.float32:
-            data = array(data, dtype='float32')
-            WW = array(WW, dtype='float32')
+        # Convert to float32 to be faster, if desired. This is done
+        # once here; cost converts WW to float32 on each call, and the
+        # optimizer itself only ever sees float64. Data processed in
+        # chunks (TICA with chunkSize set) is left alone so that it is
+        # not read into memory all at once; each chunk is converted.
+        if self.float32 and getattr(self, 'chunkSize', None) is None:
+            data = asarray(data, dtype='float32')
 
         # HACK to make faster HACK
         #data = data[:,:8000]
@@ -186,6 +207,7 @@ class RICA(object):
                            jac = True,    # cost function retuns both value and gradient
                            method = 'L-BFGS-B',
                            options = {'maxiter': maxFun, 'disp': True})
+        self.releaseCostBuffers()
         #results = cached(minimize,
         #                 self.costAndLog,
         #                 WW,
@@ -212,6 +234,96 @@ class RICA(object):
         return WW
 
 
+    def runMinibatchOptimization(self, data, method = 'adadelta', epochs = 10, maxIter = None, batchSize = 1000,
+                                 learningRate = .01, lrHalfLife = None, momentum = .9, decayRho = .95,
+                                 adaEpsilon = 1e-6, evalEvery = 100, evalExamples = None, seed = 0):
+        '''Minibatch alternative to runOptimization. Each epoch visits
+        the examples (columns of data) once in a new random order, in
+        minibatches of batchSize. data may be a memmap: only one
+        minibatch at a time is copied into memory.
+
+        method: 'sgd', 'momentum', or 'adadelta' (as in sandbox/descent.py)
+        learningRate: step size for sgd and momentum. If lrHalfLife is
+            given, the step size at iteration t is
+            learningRate / (1 + t / lrHalfLife).
+        evalEvery: log the cost on evalExamples randomly chosen
+            examples (default: all of them) every this many
+            iterations, as well as before the first iteration and after
+            the last one.
+        '''
+
+        if method not in ('sgd', 'momentum', 'adadelta'):
+            raise Exception('Unknown minibatch method: %s' % repr(method))
+
+        rng = random.RandomState(seed)
+        nExamples = data.shape[1]
+        if evalExamples is None or evalExamples >= nExamples:
+            evalData = data
+        else:
+            evalData = data[:, sort(rng.choice(nExamples, evalExamples, replace = False))]
+
+        print 'RICA minibatch fitting (%s) with %d %d-dimensional data points, batch size %d' % (method, data.shape[1], data.shape[0], batchSize)
+
+        self.costLog = None
+        startWall = time.time()
+        WW = self.WW.flatten()
+        self.costAndLog(WW, evalData)
+
+        velocity = zeros(WW.shape)    # momentum
+        expG2    = zeros(WW.shape)    # adadelta
+        expDx2   = zeros(WW.shape)    # adadelta
+        iteration = 0
+        epoch = 0
+        for epoch in xrange(epochs):
+            order = rng.permutation(nExamples)
+            for start in xrange(0, nExamples, batchSize):
+                # sorted indices keep reads from a memmap mostly sequential
+                batch = data[:, sort(order[start:start + batchSize])]
+                grad = self.cost(WW, batch)[3]
+
+                if method == 'adadelta':
+                    expG2  = decayRho * expG2 + (1-decayRho) * grad**2
+                    deltaX = -sqrt(expDx2 + adaEpsilon)/sqrt(expG2 + adaEpsilon) * grad
+                    expDx2 = decayRho * expDx2 + (1-decayRho) * deltaX**2
+                else:
+                    lr = learningRate if lrHalfLife is None else learningRate / (1 + float(iteration) / lrHalfLife)
+                    if method == 'momentum':
+                        velocity = momentum * velocity - lr * grad
+                        deltaX = velocity
+                    else:
+                        deltaX = -lr * grad
+                WW = WW + deltaX
+                iteration += 1
+
+                if iteration % evalEvery == 0:
+                    print '  epoch %d, iteration %d:' % (epoch, iteration),
+                    self.costAndLog(WW, evalData)
+                if maxIter is not None and iteration >= maxIter:
+                    break
+            if maxIter is not None and iteration >= maxIter:
+                break
+        if iteration % evalEvery != 0:
+            print '  epoch %d, iteration %d:' % (epoch, iteration),
+            self.costAndLog(WW, evalData)
+        self.costLog = atleast_2d(self.costLog)    # one row per evaluation, even if there was only one (epochs = 0)
+        self.releaseCostBuffers()
+
+        wallSeconds = time.time() - startWall
+        print 'Optimization results:'
+        print '  %20s: %s' % ('iterations', iteration)
+        print '  %20s: %s' % ('epochs', epoch + 1 if epochs > 0 else 0)
+        print '  %20s: %s' % ('fval', self.costLog[-1][-1])
+        print '  %20s: %s' % ('wall time', fmtSeconds(wallSeconds))
+        print '  %20s: %s' % ('wall time/iteration', fmtSeconds(wallSeconds / max(iteration, 1)))
+
+        WW = WW.reshape(self.nOutputs, self.nInputs)
+
+        # Renormalize each patch of WW back to unit ball
+        WW = (WW.T / sqrt(sum(WW**2, axis=1))).T
+
+        return WW
+
+
     def plotCostLog(self):
         # plot sparsity/reconstruction costs over time
         costs = self.costLog
@@ -233,15 +345,27 @@ class RICA(object):
         return 'R: %g S*%g: %g T %g' % (reconstructionCost, self.lambd, sparsityCost, totalCost)
 
 
-    def learn(self, data, maxFun = 300, whiten = False, normData = True, plotEvery = None):
-        '''data should be one data point per COLUMN! (different)'''
+    def learn(self, data, maxFun = 300, whiten = False, normData = True, plotEvery = None,
+              method = 'lbfgs', minibatchParams = None):
+        '''data should be one data point per COLUMN! (different)
+
+        method: 'lbfgs' for full batch L-BFGS (runOptimization), or
+            'sgd', 'momentum', or 'adadelta' for minibatch training
+            (runMinibatchOptimization, called with minibatchParams).
+        '''
 
         if self.WW is None:
             raise Exception('Initialize WW first!')
         if data.shape[0] != self.nInputs:
             raise Exception('Expected %d dimensional input, but got %d' % (self.nInputs, data.shape[0]))
 
-        self.WW = self.runOptimization(data, maxFun, plotEvery)
+        try:
+            if method == 'lbfgs':
+                self.WW = self.runOptimization(data, maxFun, plotEvery)
+            else:
+                self.WW = self.runMinibatchOptimization(data, method = method, **(minibatchParams or {}))
+        finally:
+            self.releaseCostBuffers()
 
         #if self.saveDir:
         #    saveToFile(os.path.join(self.saveDir, 'WW+pca.pkl.gz'), (WW, self.pca))
@@ -15,7 +15,7 @@ from scipy.optimize.lbfgsb import fmin_l_bfgs_b
 from tica import TICA
 from GitResultsManager import resman, fmtSeconds
 from util.plotting import tile_raster_images
-from util.dataLoaders import loadFromPklGz, saveToFile
+from util.dataLoaders import saveToFile, loadAtariData
 
 
 
@@ -24,8 +24,7 @@ if __name__ == '__main__':
 
     print 'probably want simple instead... finish this file first'
     sys.exit(1)
-    data = loadFromPklGz('../data/atari/mspacman_train_15_50000_3c.pkl.gz')
-    data = data.T   # Make into one example per column
+    data = loadAtariData('../data/atari/mspacman_train_15_50000_3c.pkl.gz')   # one example per column
     #data = data[:,:5000]      # HACK!!!!!!!!!
     
     #hiddenISize = 20
@@ -3,13 +3,19 @@
 import ipdb as pdb
 import os
 import gc
-from numpy import zeros, ones, prod, reshape, ceil, sqrt, random
+import ctypes
+import traceback
+import Queue
+import multiprocessing
+import numpy
+from numpy import zeros, ones, empty, prod, reshape, ceil, sqrt, random, float32, float64, array_equal, frombuffer
+from numpy.lib.format import open_memmap
 from scipy.optimize import minimize
 from scipy.linalg import norm
 from IPython import embed
 
-from util.dataLoaders import loadFromPklGz, saveToFile
-from util.misc import dictPrettyPrint, relhack, Tic
+from util.dataLoaders import loadFromPklGz, saveToFile, resetNYU2Data
+from util.misc import dictPrettyPrint, relhack, Tic, stridedWindows
 from layers import layerClassNames, DataArrangement, Layer, DataLayer, UpsonData3, NYU2_Labeled, CS294Images, DummyDataLayer
 from layers import NormalizingLayer, PCAWhiteningLayer, TicaLayer, DownsampleLayer, LcnLayer, ConcatenationLayer
 from visualize import plotImageData, plotTopActivations, plotGrayActivations, plotReshapedActivations, plotActHist, plotActLines
@@ -17,6 +23,161 @@ from gradCheck import numericalCheckVectorGrad
 
 
 
+# State shared with forked worker processes by _forwardPropParallel
+_parallelState = {}
+
+def _forwardPropParallelWorker(sliceRange):
+    '''Runs in a worker process: forward props one range of slices and
+    writes the result into the shared output matrix.'''
+    begin, end = sliceRange
+    sl = _parallelState['stackedLayers']
+    startLayerIdx, layerIdx, sublayer = _parallelState['args']
+    colsPerSlice = _parallelState['colsPerSlice']
+
+    chunk, chunkArrangement = _parallelState['getChunk'](begin, end)
+    rep, repArrangement = sl.forwardProp(chunk, chunkArrangement, startLayerIdx, layerIdx, sublayer, quiet = True)
+    _parallelState['out'][:,begin*colsPerSlice:end*colsPerSlice] = rep
+    return end - begin
+
+
+
+def sharedEmpty(shape, dtype = float32):
+    '''Like numpy.empty, but allocated in shared memory, so that writes
+    made by forked child processes are visible in the parent.'''
+    nbytes = int(prod(shape)) * numpy.dtype(dtype).itemsize
+    return frombuffer(multiprocessing.RawArray(ctypes.c_byte, nbytes), dtype = dtype).reshape(shape)
+
+
+
+class PatchPrefetcher(object):
+    '''Samples the training data for one layer in background worker
+    processes, batchSlices large patches at a time, while the caller
+    consumes earlier batches (see StackedLayers.train and visLayer).
+
+    Batch kk is sampled by dataLayer.getData with seed seed + kk and
+    cut into the patches seen by the layer (as in getDataForLayer) by
+    one of nProcs forked workers, which writes it into one of
+    queueBatches slots in shared memory. Slots are reused once the
+    consumer is done with them, so at most queueBatches batches are
+    ever held in memory, and the consumer receives the batches in
+    order. The result is therefore the same for any nProcs, and is
+    the same as getDataForLayer if there is only one batch (otherwise
+    the examples differ, but come from the same distribution).
+    '''
+
+    def __init__(self, stackedLayers, layerIdx, numExamples, batchSlices = None, nProcs = 2, queueBatches = None, seed = 0):
+        self.stackedLayers = stackedLayers
+        self.layer = stackedLayers.layers[layerIdx]
+        self.dataLayer = stackedLayers.layers[0]
+        self.seesPixels = stackedLayers._seesPixels(self.layer, self.dataLayer)
+        self.numExamples = numExamples
+        self.nProcs = max(1, nProcs)
+        if batchSlices is None:
+            # A few batches per process keeps every process busy
+            batchSlices = max(1, int(ceil(numExamples / (4.0 * self.nProcs))))
+        self.batchSlices = batchSlices
+        self.nBatches = int(ceil(float(numExamples) / batchSlices))
+        self.queueBatches = queueBatches if queueBatches else 2 * self.nProcs
+        self.seed = seed
+
+    def _sample(self, kk, largeBuf = None, stackedBuf = None):
+        '''Samples batch kk into the flat buffers, if given. Returns
+        (largePatches, stackedPatches).'''
+        nSlices = min(self.batchSlices, self.numExamples - kk * self.batchSlices)
+        large = self.dataLayer.getData(self.seesPixels, nSlices, seed = self.seed + kk)
+        if largeBuf is None:
+            return large, self.stackedLayers.getSampledAndStackedPatches(large, self.layer, self.dataLayer)
+        largeOut, stackedOut = self._slotViews(largeBuf, stackedBuf, nSlices)
+        largeOut[:] = large
+        self.stackedLayers.getSampledAndStackedPatches(largeOut, self.layer, self.dataLayer, out = stackedOut)
+        return largeOut, stackedOut
+
+    def _slotViews(self, largeBuf, stackedBuf, nSlices):
+        '''C-contiguous views of the start of the flat slot buffers,
+        shaped for a batch of nSlices.'''
+        return (largeBuf[:self.largeRows * nSlices].reshape(self.largeRows, nSlices),
+                stackedBuf[:self.stackedRows * nSlices * self.patchesPerSlice].reshape(self.stackedRows, -1))
+
+    def _work(self):
+        '''Runs in each worker process.'''
+        resetNYU2Data()     # batch 0 was sampled in the parent, whose NYU2 h5py file must not be shared
+        while True:
+            slot = self._free.get()     # claim a slot before a batch, so the next batch in order can always be written
+            kk = self._tasks.get()
+            if kk is None:
+                return
+            try:
+                self._sample(kk, self._largeSlots[slot], self._stackedSlots[slot])
+                self._done.put((kk, slot, None))
+            except:
+                self._done.put((kk, slot, traceback.format_exc()))
+                return
+
+    def batches(self):
+        '''Generator over (largePatches, stackedPatches,
+        dataArrangement) for each batch, in order. largePatches and
+        stackedPatches live in a shared slot that is recycled when the
+        next batch is requested, so copy anything that must be kept.'''
+
+        # Sample the first batch here, to learn the sizes of the slots
+        large, stacked = self._sample(0)
+        self.largeRows = large.shape[0]
+        self.stackedRows = stacked.shape[0]
+        self.patchesPerSlice = prod(self.layer.seesPatches)
+        first = (large, stacked, DataArrangement(sliceShape = self.layer.seesPatches, nSlices = large.shape[1]))
+        if self.nBatches == 1:
+            yield first
+            return
+
+        # Start the workers on the other batches before handing out the first
+        self._largeSlots = [sharedEmpty((self.largeRows * self.batchSlices,), dtype = large.dtype)
+                            for ii in range(self.queueBatches)]
+        self._stackedSlots = [sharedEmpty((self.stackedRows * self.batchSlices * self.patchesPerSlice,), dtype = stacked.dtype)
+                              for ii in range(self.queueBatches)]
+
+        self._free = multiprocessing.Queue()
+        self._tasks = multiprocessing.Queue()
+        self._done = multiprocessing.Queue()
+        for slot in range(self.queueBatches):
+            self._free.put(slot)
+        for kk in range(1, self.nBatches) + [None] * self.nProcs:
+            self._tasks.put(kk)
+        procs = [multiprocessing.Process(target = self._work) for ii in range(self.nProcs)]
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+
+        try:
+            yield first
+            del first, large, stacked
+            arrived = {}
+            slot = None
+            for kk in range(1, self.nBatches):
+                while kk not in arrived:
+                    alive = any([proc.is_alive() for proc in procs])    # checked first: exited workers have flushed their results
+                    try:
+                        doneKK, doneSlot, error = self._done.get(timeout = 1)
+                    except Queue.Empty:
+                        if not alive:
+                            raise Exception('All prefetch workers exited before batch %d was sampled' % kk)
+                        continue
+                    if error:
+                        raise Exception('Prefetch worker failed on batch %d:\n%s' % (doneKK, error))
+                    arrived[doneKK] = doneSlot
+                if slot is not None:
+                    self._free.put(slot)    # done with the previous batch
+                slot = arrived.pop(kk)
+                nSlices = min(self.batchSlices, self.numExamples - kk * self.batchSlices)
+                large, stacked = self._slotViews(self._largeSlots[slot], self._stackedSlots[slot], nSlices)
+                yield large, stacked, DataArrangement(sliceShape = self.layer.seesPatches, nSlices = nSlices)
+        finally:
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+                proc.join()
+
+
+
 class StackedLayers(object):
 
     def __init__(self, layerList):
@@ -95,11 +256,14 @@ class StackedLayers(object):
             else:
                 print '--'
 
-    def forwardPropPixelSamples(self, data, startLayerIdx = 0, layerIdx = None, sublayer = None, quiet = False):
+    def forwardPropPixelSamples(self, data, startLayerIdx = 0, layerIdx = None, sublayer = None, quiet = False,
+                                chunkSize = None, out = None, outFilename = None, nProcs = None):
         '''Push the given large pixel samples through the layers startLayerIdx, startLayerIdx+1, ..., layerIdx.
         Assume the sample is from layer startLayerIdx (default: 0, or dataLayer).
         If layerIdx is None, set layerIdx = max.
         If sublayer is None, set sublayer = max.
+        If chunkSize is given, streams the samples through in chunks (see forwardProp).
+        If nProcs > 1, shards the samples across processes (see forwardProp).
         '''
 
         if layerIdx is None: layerIdx = len(self.layers)-1
@@ -108,20 +272,67 @@ class StackedLayers(object):
         layer = self.layers[layerIdx]
         dataLayer = self.layers[0]
 
+        if nProcs is not None and nProcs > 1:
+            if out is not None:
+                raise Exception('out is not supported with nProcs > 1, use outFilename instead')
+            getChunk = lambda begin, end: (self.getSampledAndStackedPatches(data[:,begin:end], layer, dataLayer),
+                                           DataArrangement(sliceShape = layer.seesPatches, nSlices = end-begin))
+            slicesPerChunk = None if chunkSize is None else max(1, chunkSize / prod(layer.seesPatches))
+            return self._forwardPropParallel(getChunk, data.shape[1], slicesPerChunk, startLayerIdx, layerIdx, sublayer,
+                                             nProcs, quiet = quiet, outFilename = outFilename)
+
+        if chunkSize is not None or out is not None or outFilename is not None:
+            chunks = self._iterPixelSampleChunks(data, layer, dataLayer, chunkSize)
+            return self._forwardPropChunks(chunks, data.shape[1], startLayerIdx, layerIdx, sublayer, quiet = quiet,
+                                           out = out, outFilename = outFilename)
+
         dataArrangement = DataArrangement(sliceShape = layer.seesPatches, nSlices = data.shape[1])
         dataPatches = self.getSampledAndStackedPatches(data, layer, dataLayer)
 
         return self.forwardProp(dataPatches, dataArrangement, startLayerIdx, layerIdx, sublayer, quiet = quiet)
             
-    def forwardProp(self, data, dataArrangement, startLayerIdx = 0, layerIdx = None, sublayer = None, quiet = False):
+    def forwardProp(self, data, dataArrangement, startLayerIdx = 0, layerIdx = None, sublayer = None, quiet = False,
+                    chunkSize = None, out = None, outFilename = None, nProcs = None):
         '''Push the given data through the layers 0, 1, ..., layerIdx.
         If layerIdx is None, set layerIdx = max.
         If sublayer is None, set sublayer = max.
+
+        If chunkSize is given, the data is streamed through the layers
+        roughly chunkSize examples (rounded to whole slices) at a time
+        and each chunk's output is written into one preallocated result:
+        out if given, else a new .npy memmap at outFilename if given, else
+        a new array. Peak memory for intermediate representations is
+        then bounded by chunkSize instead of by the size of data. The
+        result is identical to pushing all the data through at once,
+        since every layer operates on each slice independently.
+
+        If nProcs > 1, the chunks are instead pushed through by a pool
+        of nProcs forked worker processes. Workers see the trained
+        layers and the input data through memory inherited from this
+        process (read-only, nothing is pickled) and write their results
+        directly into an output matrix in shared memory (or into the
+        shared memmap at outFilename). Set OMP_NUM_THREADS=1 (or
+        similar for your BLAS) to avoid oversubscribing cores.
         '''
 
         if layerIdx is None: layerIdx = len(self.layers)-1
         if sublayer is None: sublayer = self.layers[layerIdx].nSublayers-1
 
+        if nProcs is not None and nProcs > 1:
+            if out is not None:
+                raise Exception('out is not supported with nProcs > 1, use outFilename instead')
+            patchesPerSlice = prod(dataArrangement.sliceShape)
+            getChunk = lambda begin, end: (data[:,begin*patchesPerSlice:end*patchesPerSlice],
+                                           DataArrangement(sliceShape = dataArrangement.sliceShape, nSlices = end-begin))
+            slicesPerChunk = None if chunkSize is None else max(1, chunkSize / patchesPerSlice)
+            return self._forwardPropParallel(getChunk, dataArrangement.nSlices, slicesPerChunk, startLayerIdx, layerIdx, sublayer,
+                                             nProcs, quiet = quiet, outFilename = outFilename)
+
+        if chunkSize is not None or out is not None or outFilename is not None:
+            chunks = self._iterChunks(data, dataArrangement, chunkSize)
+            return self._forwardPropChunks(chunks, dataArrangement.nSlices, startLayerIdx, layerIdx, sublayer, quiet = quiet,
+                                           out = out, outFilename = outFilename)
+
         if not quiet:
             print 'forwardProp from layer %d through %d (s%d)' % (startLayerIdx+1, layerIdx, sublayer)
         currentRep = data
@@ -142,10 +353,121 @@ class StackedLayers(object):
             currentArrangement = newArrangement
         return currentRep, currentArrangement
 
-    def train(self, trainParams, saveDir = None, quick = False, maxlayer = -1, onlyInit = False):
+    def _iterChunks(self, data, dataArrangement, chunkSize = None):
+        '''Generator over (dataChunk, chunkArrangement) pairs, each
+        containing whole slices and about chunkSize examples (all
+        data in one chunk if chunkSize is None).'''
+
+        patchesPerSlice = prod(dataArrangement.sliceShape)
+        nSlices = dataArrangement.nSlices
+        slicesPerChunk = max(1, nSlices if chunkSize is None else chunkSize / patchesPerSlice)
+        for begin in xrange(0, nSlices, slicesPerChunk):
+            end = min(begin + slicesPerChunk, nSlices)
+            yield (data[:,begin*patchesPerSlice:end*patchesPerSlice],
+                   DataArrangement(sliceShape = dataArrangement.sliceShape, nSlices = end-begin))
+
+    def _iterPixelSampleChunks(self, largePatches, layer, dataLayer, chunkSize = None):
+        '''Like _iterChunks, but cuts up chunks of large pixel samples
+        into patches on the fly, so the full stacked patch matrix is
+        never created. The patch buffer is reused between chunks.'''
+
+        slicesPerChunk = max(1, largePatches.shape[1] if chunkSize is None else chunkSize / prod(layer.seesPatches))
+        buf = None
+        for begin in xrange(0, largePatches.shape[1], slicesPerChunk):
+            end = min(begin + slicesPerChunk, largePatches.shape[1])
+            if end - begin != slicesPerChunk:
+                buf = None    # last, smaller chunk
+            buf = self.getSampledAndStackedPatches(largePatches[:,begin:end], layer, dataLayer, out = buf)
+            yield buf, DataArrangement(sliceShape = layer.seesPatches, nSlices = end-begin)
+
+    def _forwardPropChunks(self, chunks, nSlices, startLayerIdx, layerIdx, sublayer, quiet = False, out = None, outFilename = None):
+        '''Pushes each (data, dataArrangement) chunk from the chunks
+        iterator through the layers and writes the results, in order,
+        into a single output matrix (see forwardProp).'''
+
+        ret = out
+        sliceShape = None
+        col = 0
+        nChunks = 0
+        for ii, (chunk, chunkArrangement) in enumerate(chunks):
+            rep, repArrangement = self.forwardProp(chunk, chunkArrangement, startLayerIdx, layerIdx, sublayer,
+                                                   quiet = (quiet or ii > 0))
+            if ret is None:
+                shape = (rep.shape[0], rep.shape[1] / repArrangement.nSlices * nSlices)
+                if outFilename:
+                    ret = open_memmap(outFilename, mode = 'w+', dtype = rep.dtype, shape = shape)
+                else:
+                    ret = empty(shape, dtype = rep.dtype)
+            ret[:,col:col+rep.shape[1]] = rep
+            col += rep.shape[1]
+            sliceShape = repArrangement.sliceShape
+            nChunks += 1
+        if nChunks == 0:
+            # The output size is only known once some data has been pushed through
+            raise Exception('No data to forward prop (%d slices)' % nSlices)
+        if col != ret.shape[1]:
+            raise Exception('Expected %d output columns but got %d' % (ret.shape[1], col))
+        if not quiet:
+            print '    streamed %d slices through in %d chunks' % (nSlices, nChunks)
+        return ret, DataArrangement(sliceShape = sliceShape, nSlices = nSlices)
+
+    def _forwardPropParallel(self, getChunk, nSlices, slicesPerChunk, startLayerIdx, layerIdx, sublayer, nProcs,
+                             quiet = False, outFilename = None):
+        '''Forward props the slices returned by getChunk(begin, end)
+        for all ranges of slices in [0, nSlices) using a pool of
+        nProcs worker processes (see forwardProp).'''
+
+        if nSlices == 0:
+            raise Exception('No data to forward prop (0 slices)')
+        if slicesPerChunk is None:
+            # A few chunks per process balances load without too much overhead
+            slicesPerChunk = max(1, int(ceil(nSlices / (4.0 * nProcs))))
+        ranges = [(begin, min(begin + slicesPerChunk, nSlices)) for begin in xrange(0, nSlices, slicesPerChunk)]
+
+        # Push the first chunk through here to learn the output shape and dtype
+        chunk, chunkArrangement = getChunk(*ranges[0])
+        rep, repArrangement = self.forwardProp(chunk, chunkArrangement, startLayerIdx, layerIdx, sublayer, quiet = quiet)
+        colsPerSlice = rep.shape[1] / repArrangement.nSlices
+        shape = (rep.shape[0], colsPerSlice * nSlices)
+        if outFilename:
+            ret = open_memmap(outFilename, mode = 'w+', dtype = rep.dtype, shape = shape)
+        else:
+            ret = sharedEmpty(shape, dtype = rep.dtype)
+        ret[:,0:rep.shape[1]] = rep
+
+        _parallelState['stackedLayers'] = self
+        _parallelState['getChunk'] = getChunk
+        _parallelState['args'] = (startLayerIdx, layerIdx, sublayer)
+        _parallelState['colsPerSlice'] = colsPerSlice
+        _parallelState['out'] = ret
+        try:
+            pool = multiprocessing.Pool(nProcs)    # forked after _parallelState is set, so workers inherit it
+            try:
+                pool.map(_forwardPropParallelWorker, ranges[1:], chunksize = 1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _parallelState.clear()
+
+        if not quiet:
+            print '    pushed %d slices through in %d chunks with %d processes' % (nSlices, len(ranges), nProcs)
+        return ret, DataArrangement(sliceShape = repArrangement.sliceShape, nSlices = nSlices)
+
+    def train(self, trainParams, saveDir = None, quick = False, maxlayer = -1, onlyInit = False, chunkSize = None, nProcs = None,
+              prefetch = None):
         '''Train all layers.
 
-        if onlyInit, then do initialization but skip training.'''
+        if onlyInit, then do initialization but skip training.
+        if chunkSize, stream training data through the lower layers
+        chunkSize examples at a time (see forwardProp).
+        if nProcs > 1, forward prop training data through the lower
+        layers using nProcs processes (see forwardProp).
+        if prefetch, sample training data in batches (of about
+        chunkSize examples, if given) using prefetch background
+        processes while earlier batches are forward propped (see
+        PatchPrefetcher). Unless there is only one batch, this
+        samples different (but equally random) examples.'''
         
         # check to make sure each trainParam matches a known layer...
         for layerName in trainParams.keys():
@@ -187,24 +509,40 @@ class StackedLayers(object):
                 assert len(layer.seesPatches) == len(dataLayer.patchSize)
                 assert len(layer.seesPatches) == len(dataLayer.stride)
 
-                # Get data
-                print 'gc.collect found', gc.collect(), 'objects'
-                trainRawDataLargePatches, trainRawDataPatches = self.getDataForLayer(layerIdx, numExamples)
-                print 'Memory used to store trainRawDataLargePatches: %g MB' % (trainRawDataLargePatches.nbytes/1e6)
-                print 'Memory used to store trainRawDataPatches:      %g MB' % (trainRawDataPatches.nbytes/1e6)
-                del trainRawDataLargePatches
-                print 'gc.collect found', gc.collect(), 'objects'
-
-                # Push data through N-1 layers
-                dataArrangementLayer0 = DataArrangement(sliceShape = layer.seesPatches, nSlices = numExamples)
-                tic = Tic('forward prop')
-                trainPrevLayerData, dataArrangementPrevLayer = self.forwardProp(trainRawDataPatches, dataArrangementLayer0, layerIdx=layerIdx-1)
-                tic()
-                print 'Memory used to store trainPrevLayerData: %g MB' % (trainPrevLayerData.nbytes/1e6)
+                if prefetch:
+                    # Sample data in the background while streaming it through N-1 layers
+                    dummy, trainPrevLayerData, dataArrangementPrevLayer = self._forwardPropPrefetched(layerIdx, numExamples,
+                                                                                                      chunkSize = chunkSize, prefetch = prefetch)
+                    print 'Memory used to store trainPrevLayerData: %g MB' % (trainPrevLayerData.nbytes/1e6)
+                elif chunkSize or nProcs > 1:
+                    # Get data and stream it through N-1 layers
+                    trainRawDataLargePatches = self.getLargePatchesForLayer(layerIdx, numExamples)
+                    print 'Memory used to store trainRawDataLargePatches: %g MB' % (trainRawDataLargePatches.nbytes/1e6)
+                    tic = Tic('forward prop')
+                    trainPrevLayerData, dataArrangementPrevLayer = self._forwardPropLargePatches(trainRawDataLargePatches, layer, layerIdx-1,
+                                                                                                 chunkSize = chunkSize, nProcs = nProcs)
+                    tic()
+                    print 'Memory used to store trainPrevLayerData: %g MB' % (trainPrevLayerData.nbytes/1e6)
+                    del trainRawDataLargePatches
+                else:
+                    # Get data
+                    print 'gc.collect found', gc.collect(), 'objects'
+                    trainRawDataLargePatches, trainRawDataPatches = self.getDataForLayer(layerIdx, numExamples)
+                    print 'Memory used to store trainRawDataLargePatches: %g MB' % (trainRawDataLargePatches.nbytes/1e6)
+                    print 'Memory used to store trainRawDataPatches:      %g MB' % (trainRawDataPatches.nbytes/1e6)
+                    del trainRawDataLargePatches
+                    print 'gc.collect found', gc.collect(), 'objects'
+
+                    # Push data through N-1 layers
+                    dataArrangementLayer0 = DataArrangement(sliceShape = layer.seesPatches, nSlices = numExamples)
+                    tic = Tic('forward prop')
+                    trainPrevLayerData, dataArrangementPrevLayer = self.forwardProp(trainRawDataPatches, dataArrangementLayer0, layerIdx=layerIdx-1)
+                    tic()
+                    print 'Memory used to store trainPrevLayerData: %g MB' % (trainPrevLayerData.nbytes/1e6)
 
-                # Free the raw patches from memory
-                del trainRawDataPatches
-                print 'gc.collect found', gc.collect(), 'objects'
+                    # Free the raw patches from memory
+                    del trainRawDataPatches
+                    print 'gc.collect found', gc.collect(), 'objects'
 
                 # Train layer
                 tic = Tic('train')
@@ -229,7 +567,7 @@ class StackedLayers(object):
                     tic = Tic('vis')
                     #prefix = 'layer_%02d_%s_' % (layerIdx, layer.name)
                     #layer.plot(trainPrevLayerData, dataArrangementPrevLayer, saveDir, prefix)
-                    self.visLayer(layerIdx, saveDir = saveDir, quick = quick)
+                    self.visLayer(layerIdx, saveDir = saveDir, quick = quick, chunkSize = chunkSize, nProcs = nProcs, prefetch = prefetch)
                     tic()
                     print
 
@@ -241,7 +579,55 @@ class StackedLayers(object):
         seesPixels = tuple([ps + st * (sp-1) for sp,ps,st in zip(layer.seesPatches,dataLayer.patchSize, dataLayer.stride)])
         return seesPixels
 
-    def getDataForLayer(self, layerIdx, numExamples):
+    def _forwardPropLargePatches(self, largePatches, layer, layerIdx, chunkSize = None, nProcs = None):
+        '''Cuts largePatches into the patches seen by layer and pushes
+        them through layers 1, ..., layerIdx, chunkSize examples at a
+        time and/or using nProcs processes.'''
+
+        dataLayer = self.layers[0]
+        sublayer = self.layers[layerIdx].nSublayers-1
+        if nProcs > 1:
+            getChunk = lambda begin, end: (self.getSampledAndStackedPatches(largePatches[:,begin:end], layer, dataLayer),
+                                           DataArrangement(sliceShape = layer.seesPatches, nSlices = end-begin))
+            slicesPerChunk = None if chunkSize is None else max(1, chunkSize / prod(layer.seesPatches))
+            return self._forwardPropParallel(getChunk, largePatches.shape[1], slicesPerChunk, 0, layerIdx, sublayer, nProcs)
+        else:
+            chunks = self._iterPixelSampleChunks(largePatches, layer, dataLayer, chunkSize)
+            return self._forwardPropChunks(chunks, largePatches.shape[1], 0, layerIdx, sublayer)
+
+    def _forwardPropPrefetched(self, layerIdx, numExamples, chunkSize = None, prefetch = 2, keepLarge = False):
+        '''Gets numExamples examples of the data seen by layer layerIdx
+        and pushes them through layers 1, ..., layerIdx-1, like
+        getLargePatchesForLayer followed by _forwardPropLargePatches,
+        except that the data is sampled and cut up by prefetch
+        background processes (see PatchPrefetcher) while earlier
+        batches are pushed through the layers here. Returns
+        (largePatches, rep, repArrangement), where largePatches is
+        None unless keepLarge.'''
+
+        layer = self.layers[layerIdx]
+        sublayer = self.layers[layerIdx-1].nSublayers-1
+        batchSlices = None if chunkSize is None else max(1, chunkSize / prod(layer.seesPatches))
+        prefetcher = PatchPrefetcher(self, layerIdx, numExamples, batchSlices = batchSlices, nProcs = prefetch)
+        largePatches = [None]
+
+        def chunks():
+            col = 0
+            for large, stacked, arrangement in prefetcher.batches():
+                if keepLarge:
+                    if largePatches[0] is None:
+                        largePatches[0] = empty((large.shape[0], numExamples), dtype = large.dtype)
+                    largePatches[0][:,col:col+large.shape[1]] = large
+                    col += large.shape[1]
+                yield stacked, arrangement
+
+        print 'Prefetching %d examples in %d batches with %d processes' % (numExamples, prefetcher.nBatches, prefetcher.nProcs)
+        tic = Tic('prefetch and forward prop')
+        rep, repArrangement = self._forwardPropChunks(chunks(), numExamples, 0, layerIdx-1, sublayer)
+        tic()
+        return largePatches[0], rep, repArrangement
+
+    def getLargePatchesForLayer(self, layerIdx, numExamples):
         layer = self.layers[layerIdx]
         dataLayer = self.layers[0]
         
@@ -252,38 +638,58 @@ class StackedLayers(object):
         rawDataLargePatches = dataLayer.getData(seesPixels, numExamples, seed = 0)
         tic()
 
+        return rawDataLargePatches
+
+    def getDataForLayer(self, layerIdx, numExamples):
+        layer = self.layers[layerIdx]
+        dataLayer = self.layers[0]
+
+        rawDataLargePatches = self.getLargePatchesForLayer(layerIdx, numExamples)
         rawDataPatches = self.getSampledAndStackedPatches(rawDataLargePatches, layer, dataLayer)
 
         return rawDataLargePatches, rawDataPatches
 
-    def getSampledAndStackedPatches(self, largePatches, layer, dataLayer):
+    def getSampledAndStackedPatches(self, largePatches, layer, dataLayer, dtype = float64, out = None):
+        '''Cuts each large patch (one per column of largePatches) into
+        the prod(layer.seesPatches) data layer patches it contains and
+        stacks them, one patch per column, into a (preallocated, if out
+        is given) matrix of the given dtype (or out's dtype). Pass
+        dtype = float32 to halve the memory of the stack. Works for
+        any number of patch dimensions; any extra channels (e.g.
+        colors) are taken to be the last, fastest varying dimension of
+        each patch.
+        '''
         seesPixels = self._seesPixels(layer, dataLayer)
-        numExamples = largePatches.shape[1]
-
-        # Reshape into patches
-        stackedPatches = zeros((prod(dataLayer.patchSize), prod(layer.seesPatches)*numExamples))
-
-        # BEGIN: 2D data assumption
-        # Note: this only works for 2D data! Add other cases if needed.
-        assert len(layer.seesPatches) == 2, 'Only works for 2D data for now!'
-        counter = 0
-        sp0,sp1 = layer.seesPatches
-        ps0,ps1 = dataLayer.patchSize
-        st0,st1 = dataLayer.stride
-        for largePatchIdx in xrange(largePatches.shape[1]):
-            thisLargePatch = reshape(largePatches[:,largePatchIdx], seesPixels)
-            # Note: this code flattens in the default numpy
-            # flattening order: C-order, or row-major order.
-            for ii in xrange(sp0):
-                for jj in xrange(sp1):
-                    stackedPatches[:,counter] = thisLargePatch[(ii*st0):(ii*st0+ps0),(jj*st1):(jj*st1+ps1)].flatten()
-                    counter += 1
-        # just check last patch
-        assert stackedPatches.shape[0] == len(thisLargePatch[(ii*st0):(ii*st0+ps0),(jj*st1):(jj*st1+ps1)].flatten())
-        assert stackedPatches.shape[1] == counter
-        # END: 2D data assumption
-
-        return stackedPatches
+        patchLength, numExamples = largePatches.shape
+        nChannels = patchLength / prod(seesPixels)
+        if nChannels * prod(seesPixels) != patchLength:
+            raise Exception('Expected patches of size %s (with any number of channels) but got %d rows'
+                            % (repr(seesPixels), patchLength))
+        channelShape = (nChannels,) if nChannels > 1 else ()
+        nDims = len(seesPixels)
+
+        stackedShape = (prod(dataLayer.patchSize) * nChannels, prod(layer.seesPatches) * numExamples)
+        if out is None:
+            out = empty(stackedShape, dtype = dtype)
+        if out.shape != stackedShape or not out.flags.c_contiguous:
+            raise Exception('out must be a C-contiguous array of shape %s' % repr(stackedShape))
+
+        # largeView.shape = (numExamples,) + seesPixels + channelShape. This
+        # is a view unless largePatches is not already in C-order.
+        largeView = reshape(largePatches.T, (numExamples,) + seesPixels + channelShape)
+
+        # windows.shape = (numExamples,) + seesPatches + patchSize + channelShape, no copy
+        windows = stridedWindows(largeView, dataLayer.patchSize, dataLayer.stride, axis = 1)
+        assert windows.shape[1:1+nDims] == tuple(layer.seesPatches)
+
+        # Note: this code flattens in the default numpy flattening
+        # order: C-order, or row-major order. Columns are ordered
+        # (example, seesPatches...) and rows (patchSize..., channel).
+        nChannelDims = len(channelShape)
+        order = (tuple(range(1+nDims, 1+2*nDims+nChannelDims)) + (0,) + tuple(range(1, 1+nDims)))
+        out.reshape(tuple(dataLayer.patchSize) + channelShape + (numExamples,) + tuple(layer.seesPatches))[...] = windows.transpose(order)
+
+        return out
 
     def optimalInputForUnit(self, unitIdx, startLayerIdx = 0, layerIdx = None, sublayer = None):
         if layerIdx is None: layerIdx = len(self.layers)-1
@@ -315,7 +721,8 @@ class StackedLayers(object):
 
         return xOpt
     
-    def visLayer(self, layerIdx, sublayer = None, startLayerIdx = 0, numExamples = 100000, saveDir = None, show = False, quick = False):
+    def visLayer(self, layerIdx, sublayer = None, startLayerIdx = 0, numExamples = 100000, saveDir = None, show = False, quick = False,
+                 chunkSize = None, nProcs = None, prefetch = None):
         layer     = self.layers[layerIdx]
         if sublayer is None: sublayer = layer.nSublayers - 1  # max by default
         dataLayer = self.layers[0]
@@ -331,13 +738,27 @@ class StackedLayers(object):
         NODATAYET = True
         if NODATAYET:
             # Get data and forward prop
-            rawDataLargePatches, rawDataPatches = self.getDataForLayer(layerIdx, numExamples)
-            dataArrangementLayer0 = DataArrangement(sliceShape = layer.seesPatches, nSlices = numExamples)
+            if prefetch:
+                rawDataLargePatches, prevLayerData, dataArrangementPrevLayer = self._forwardPropPrefetched(layerIdx, numExamples,
+                                                                                                           chunkSize = chunkSize,
+                                                                                                           prefetch = prefetch,
+                                                                                                           keepLarge = True)
+                tic = Tic('forward prop')
+            elif chunkSize or nProcs > 1:
+                rawDataLargePatches = self.getLargePatchesForLayer(layerIdx, numExamples)
+
+                tic = Tic('forward prop')
+                prevLayerData, dataArrangementPrevLayer = self._forwardPropLargePatches(rawDataLargePatches, layer, layerIdx-1,
+                                                                                        chunkSize = chunkSize, nProcs = nProcs)
+            else:
+                rawDataLargePatches, rawDataPatches = self.getDataForLayer(layerIdx, numExamples)
+                dataArrangementLayer0 = DataArrangement(sliceShape = layer.seesPatches, nSlices = numExamples)
         
-            tic = Tic('forward prop')
-            prevLayerData, dataArrangementPrevLayer = self.forwardProp(rawDataPatches, dataArrangementLayer0, layerIdx=layerIdx-1)
+                tic = Tic('forward prop')
+                prevLayerData, dataArrangementPrevLayer = self.forwardProp(rawDataPatches, dataArrangementLayer0, layerIdx=layerIdx-1)
             activations, dataArrangement = self.forwardProp(prevLayerData, dataArrangementPrevLayer,
-                                                            startLayerIdx = layerIdx-1, layerIdx=layerIdx, sublayer=sublayer)
+                                                            startLayerIdx = layerIdx-1, layerIdx=layerIdx, sublayer=sublayer,
+                                                            chunkSize = chunkSize, nProcs = nProcs)
             tic()
 
         # 0. Inputs
@@ -500,9 +921,115 @@ def check_2AE_backprop(checkHinting = False):
 
 
 
+def check_streamingForwardProp():
+    '''Checks that streaming and parallel forward prop give exactly the same result as the all-at-once version.'''
+    random.seed(0)
+
+    dimInput = 3
+    numExamples = 101
+
+    ll = []
+    ll.append({'name':       'data',
+               'type':       'data',
+               'dataClass':  'DummyDataLayer',
+               'outputSize': (dimInput,),
+               })
+    ll.append({'name':       'ae1',
+               'type':       'ae',
+               'hiddenSize': 4,
+               'beta':       3.0,
+               'rho':        .01,
+               'lambd':      .0001,
+               })
+    ll.append({'name':       'cat1',
+               'type':       'concat',
+               'concat':     (2,),
+               'stride':     (1,),
+               })
+    ll.append({'name':       'ae2',
+               'type':       'ae',
+               'hiddenSize': 5,
+               'beta':       3.0,
+               'rho':        .01,
+               'lambd':      .0001,
+               })
+
+    sl = StackedLayers(ll)
+
+    tp = {}
+    tp['ae1'] = {'examples': 0,
+                 'initb1': 'approx',
+                 'initW2asW1_T': False,
+                 'method': 'lbfgs',
+                 'maxFuncCalls': 300,
+                 }
+    tp['ae2'] = tp['ae1']
+    sl.train(tp, onlyInit = True)
+
+    dataArrangement = DataArrangement((3,), numExamples)
+    XX = random.normal(.5, .25, (dimInput, 3 * numExamples))
+
+    allAtOnce, allAtOnceArrangement = sl.forwardProp(XX, dataArrangement, quiet = True)
+    for chunkSize in (1, 3, 10, 100, 1000):
+        streamed, streamedArrangement = sl.forwardProp(XX, dataArrangement, quiet = True, chunkSize = chunkSize)
+        assert repr(streamedArrangement) == repr(allAtOnceArrangement)
+        assert array_equal(streamed, allAtOnce), 'streaming forwardProp mismatch for chunkSize = %d' % chunkSize
+    for nProcs, chunkSize in ((2, None), (3, 10)):
+        parallel, parallelArrangement = sl.forwardProp(XX, dataArrangement, quiet = True, chunkSize = chunkSize, nProcs = nProcs)
+        assert repr(parallelArrangement) == repr(allAtOnceArrangement)
+        assert array_equal(parallel, allAtOnce), 'parallel forwardProp mismatch for nProcs = %d' % nProcs
+    print 'check_streamingForwardProp: passed'
+
+
+
+def check_prefetchedForwardProp():
+    '''Checks that prefetched sampling and forward prop give the same
+    result for any number of processes, and the same as sampling each
+    batch by hand.'''
+
+    ll = [{'name': 'data', 'type': 'data', 'dataClass': 'DummyDataLayer', 'outputSize': (3,)},
+          {'name': 'ae1', 'type': 'ae', 'hiddenSize': 4, 'beta': 3.0, 'rho': .01, 'lambd': .0001},
+          {'name': 'cat1', 'type': 'concat', 'concat': (2,), 'stride': (1,)},
+          {'name': 'ae2', 'type': 'ae', 'hiddenSize': 5, 'beta': 3.0, 'rho': .01, 'lambd': .0001}]
+    sl = StackedLayers(ll)
+    tp = {'examples': 0, 'initb1': 'approx', 'initW2asW1_T': False, 'method': 'lbfgs', 'maxFuncCalls': 300}
+    sl.train({'ae1': tp, 'ae2': tp}, onlyInit = True)
+
+    # Make the dummy data layer sample 1D "images"
+    dataLayer = sl.layers[0]
+    dataLayer.patchSize = (3,)
+    dataLayer.getData = lambda patchSize, number, seed = None: random.RandomState(seed).normal(.5, .25, (prod(patchSize), number))
+    layerIdx = 3
+    numExamples = 101
+
+    # One batch: same as getDataForLayer
+    large, patches = sl.getDataForLayer(layerIdx, numExamples)
+    expected, expectedArrangement = sl.forwardProp(patches, DataArrangement((2,), numExamples), layerIdx = layerIdx-1, quiet = True)
+    prefLarge, prefRep, prefArrangement = sl._forwardPropPrefetched(layerIdx, numExamples, chunkSize = 1000, keepLarge = True)
+    assert array_equal(prefLarge, large) and array_equal(prefRep, expected)
+    assert repr(prefArrangement) == repr(expectedArrangement)
+
+    # Several batches of 5 slices, batch kk with seed kk
+    seesPixels = sl._seesPixels(sl.layers[layerIdx], dataLayer)
+    large = numpy.hstack([dataLayer.getData(seesPixels, min(5, numExamples - begin), seed = kk)
+                          for kk, begin in enumerate(range(0, numExamples, 5))])
+    patches = sl.getSampledAndStackedPatches(large, sl.layers[layerIdx], dataLayer)
+    expected, expectedArrangement = sl.forwardProp(patches, DataArrangement((2,), numExamples), layerIdx = layerIdx-1, quiet = True)
+    for prefetch in (1, 3):
+        prefLarge, prefRep, prefArrangement = sl._forwardPropPrefetched(layerIdx, numExamples, chunkSize = 10,
+                                                                        prefetch = prefetch, keepLarge = True)
+        assert array_equal(prefLarge, large), 'prefetched samples mismatch for prefetch = %d' % prefetch
+        assert array_equal(prefRep, expected), 'prefetched forwardProp mismatch for prefetch = %d' % prefetch
+        assert repr(prefArrangement) == repr(expectedArrangement)
+    print 'check_prefetchedForwardProp: passed'
+
+
+
 def tests():
     check_2AE_backprop(checkHinting = False)
     check_2AE_backprop(checkHinting = True)
+    check_streamingForwardProp()
+    check_prefetchedForwardProp()
 
 
 
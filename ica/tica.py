@@ -8,7 +8,12 @@ Jason Yosinski
 
 import pdb
 import os
+import time
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+import numpy
 from numpy import *
+import scipy.sparse
 from matplotlib import pyplot
 from GitResultsManager import resman
 
@@ -23,7 +28,7 @@ except ImportError:
 
 
 
-def neighborMatrix(hiddenLayerShape, neighborhoodSize, shrink = 0, gaussian = False, nPoolingIgnoredNeurons = 0):
+def neighborMatrix(hiddenLayerShape, neighborhoodSize, shrink = 0, gaussian = False, nPoolingIgnoredNeurons = 0, sparse = False):
     '''Generate the neighbor matrix H, a 4D tensor where for the original tensor:
     
         H_i,j,k,l = 1 if the pooled unit at i,j is connected to the hidden unit at k,l
@@ -41,6 +46,9 @@ def neighborMatrix(hiddenLayerShape, neighborhoodSize, shrink = 0, gaussian = Fa
        column, and so on) to ignore when computing the pooled neuron
        responses. If nPoolingIgnoredNeurons > 0, we simply set that
        many corresponding entries in the neighborMatrix to 0.
+    sparse: if True, return a scipy.sparse CSR matrix instead of a
+       dense array. The dense matrix is never built, so this works
+       for large hidden layers (e.g. 64x64).
     '''
     
     if shrink < 0:
@@ -55,40 +63,42 @@ def neighborMatrix(hiddenLayerShape, neighborhoodSize, shrink = 0, gaussian = Fa
     if nPoolingIgnoredNeurons < 0 or nPoolingIgnoredNeurons > nHidden:
         raise Exception('Expected nPoolingIgnoredNeurons in [0, %d] but got %d' % (nHidden, nPoolingIgnoredNeurons))
 
-    # Create the 4D neighborhood tensor.
-    # ret_i,j,k,l = 1 if the pooled unit at i,j is connected to the hidden unit at k,l
-    ret = zeros(pooledLayerShape + hiddenLayerShape)
-
+    # Distances / connections along each axis separately, indexed
+    # [pooled unit, hidden unit]. The 4D tensor
+    #   ret_i,j,k,l = 1 if the pooled unit at i,j is connected to the hidden unit at k,l
+    # is built from these one pooled row (fixed i) at a time.
     if gaussian:
         sigmaSq = float(neighborhoodSize)**2
-        halfIWidth = hiddenLayerShape[0]/2
-        halfJWidth = hiddenLayerShape[1]/2
-        for ii in range(pooledLayerShape[0]):
-            for jj in range(pooledLayerShape[1]):
-                for nnii in range(hiddenLayerShape[0]):
-                    for nnjj in range(hiddenLayerShape[1]):
-                        # get min dist (including wraparound)
-                        iDiff = (((ii - (nnii-shrink))+halfIWidth) % hiddenLayerShape[0])-halfIWidth
-                        jDiff = (((jj - (nnjj-shrink))+halfJWidth) % hiddenLayerShape[1])-halfJWidth
-                        distSq = iDiff ** 2 + jDiff ** 2
-                        weight = exp(-distSq / sigmaSq)
-                        #print ii, jj, nnii, nnjj, '  ', iDiff, jDiff, distSq, '%.3f' % exp(-distSq / sigmaSq)
-                        # cut off very low values
-                        ret[ii, jj, nnii, nnjj] = weight if weight > .01 else 0
-                        #ret[ii, jj, nnii, nnjj] = distSq   # Just for testing
+        iDistSq, jDistSq = [(((arange(pooledLayerShape[ax])[:,newaxis] - (arange(hiddenLayerShape[ax])[newaxis,:] - shrink))
+                              + hiddenLayerShape[ax]/2) % hiddenLayerShape[ax] - hiddenLayerShape[ax]/2) ** 2
+                            for ax in (0, 1)]    # min dist (including wraparound)
+    else:
+        iConnected, jConnected = [zeros((pooledLayerShape[ax], hiddenLayerShape[ax]), dtype = bool) for ax in (0, 1)]
+        for ax, connected in ((0, iConnected), (1, jConnected)):
+            pooledIdx = arange(pooledLayerShape[ax])
+            for nn in range(-neighborhoodSize, neighborhoodSize + 1):
+                connected[pooledIdx, (pooledIdx + shrink + nn) % hiddenLayerShape[ax]] = True
+
+    if sparse:
+        blocks = []
     else:
-        rangeNeighborII = range(-neighborhoodSize, neighborhoodSize + 1)
-        rangeNeighborJJ = range(-neighborhoodSize, neighborhoodSize + 1)
-
-        for ii in range(pooledLayerShape[0]):
-            for jj in range(pooledLayerShape[1]):
-                for nnii in rangeNeighborII:
-                    for nnjj in rangeNeighborJJ:
-                        ret[ii, jj, (ii+shrink+nnii) % hiddenLayerShape[0], (jj+shrink+nnjj) % hiddenLayerShape[1]] = 1
-
-    ret = reshape(ret, (nPooled, nHidden))
-    ret[:,0:nPoolingIgnoredNeurons] = 0     # Ignore some number of hidden neurons
-    ret = (ret.T / sum(ret, 1)).T     # Normalize to total weight 1 per pooling unit
+        ret = zeros((nPooled, nHidden))
+    for ii in range(pooledLayerShape[0]):
+        if gaussian:
+            weight = exp(-(iDistSq[ii][newaxis,:,newaxis] + jDistSq[:,newaxis,:]) / sigmaSq)
+            block = where(weight > .01, weight, 0)       # cut off very low values
+        else:
+            block = array(iConnected[ii][newaxis,:,newaxis] & jConnected[:,newaxis,:], dtype = float)
+        block = reshape(block, (pooledLayerShape[1], nHidden))
+        block[:,0:nPoolingIgnoredNeurons] = 0     # Ignore some number of hidden neurons
+        block = (block.T / sum(block, 1)).T       # Normalize to total weight 1 per pooling unit
+        if sparse:
+            blocks.append(scipy.sparse.csr_matrix(block))
+        else:
+            ret[ii*pooledLayerShape[1]:(ii+1)*pooledLayerShape[1],:] = block
+
+    if sparse:
+        ret = scipy.sparse.vstack(blocks, format = 'csr')
     return ret
 
 
@@ -98,9 +108,59 @@ def fullNeighborMatrix(hiddenLayerShape, neighborhoodSize):
 
 
 
+class TicaCostWorkspace(object):
+    '''Buffers used by TICA.cost for data of one dtype, kept between
+    calls to avoid reallocating several nHidden x nDatapoints arrays
+    on each one. The buffers are flat and only grow; resize makes
+    contiguous (rows, nDatapoints) views of them, so calls with fewer
+    columns (e.g. the last chunk) reuse them. If TICA.cacheDataT is
+    set, also keeps a contiguous copy of data.T for the gradient
+    products, which is only remade when cost is called with different
+    data (so do not modify data in place between calls). Not used for
+    chunked data, whose chunks may reuse one buffer.'''
+
+    def __init__(self, nInputs, nHidden, nPooled, dtype):
+        self.rows = {'hidden':    nHidden,
+                     'hiddenTmp': nHidden,     # hidden ** 2, then Ha, then hidden * Ha
+                     'pooled':    nPooled,     # absPooledActivations, then its inverse
+                     'reconDiff': nInputs,
+                     'inputTmp':  nInputs,     # reconDiff ** 2
+                     }
+        self.dtype     = dtype
+        self.capacity  = 0
+        self.buffers   = {}
+        self.data      = None
+        self.dataT     = None
+
+    def resize(self, nDatapoints):
+        if nDatapoints > self.capacity:
+            self.buffers = dict([(name, empty(rows * nDatapoints, dtype = self.dtype)) for name, rows in self.rows.items()])
+            self.capacity = nDatapoints
+        for name, rows in self.rows.items():
+            setattr(self, name, self.buffers[name][:rows * nDatapoints].reshape(rows, nDatapoints))
+
+    def getDataT(self, data):
+        # Compare memory location rather than identity, since each call
+        # may be given a new view (chunk or shard) of the same data.
+        # self.data keeps the old memory alive, so it cannot be reused.
+        if (self.data is None or self.data.__array_interface__['data'] != data.__array_interface__['data']
+            or self.data.shape != data.shape or self.data.strides != data.strides or self.data.dtype != data.dtype):
+            self.dataT = ascontiguousarray(data.T)
+            self.data = data
+        return self.dataT
+
+
+
 class TICA(RICA):
     '''See RICA for constructor arguments.'''
 
+    sparseMaxDensity = .15    # store HH as a sparse matrix if at most this fraction is non-zero
+    referenceImpl = False     # if True, cost uses _costReference
+    cacheDataT = False        # keep a contiguous copy of data.T for the gradient (a full extra copy of data; measured no faster)
+    chunkSize = None          # if set, cost processes data in chunks of this many columns
+    nThreads = 1              # if > 1, cost splits each chunk into this many shards processed by a thread pool
+    costPhases = ('setup', 'forward', 'recon', 'pooling', 'reconGrad', 'poolingGrad', 'finish')
+
     def __init__(self, nInputs, lambd = .005, hiddenLayerShape = (10,10), neighborhoodParams = ('gaussian', 1.0, 0, 0),
                  epsilon = 1e-5, saveDir = '', float32 = False, initWW = True):
         ''''''
@@ -128,10 +188,13 @@ class TICA(RICA):
         self.nPooled = (self.hiddenLayerShape[0] - self.shrink*2) * (self.hiddenLayerShape[1] - self.shrink*2)
         self.HH = neighborMatrix(self.hiddenLayerShape, self.neighborhoodSize,
                                  shrink = self.shrink, gaussian = self.neighborhoodIsGaussian,
-                                 nPoolingIgnoredNeurons = self.nPoolingIgnoredNeurons)
+                                 nPoolingIgnoredNeurons = self.nPoolingIgnoredNeurons,
+                                 sparse = True)
+        if self.HH.nnz > self.sparseMaxDensity * prod(self.HH.shape):
+            self.HH = self.HH.toarray()    # small or wide neighborhoods: dense products are faster
 
         if self.float32:
-            self.HH = array(self.HH, dtype='float32')
+            self.HH = self.HH.astype('float32')
 
 
     def costAndLog(self, WW, data, plotEvery = None):
@@ -155,8 +218,277 @@ class TICA(RICA):
             returns totalCost, poolingCost, reconstructionCost, grad, hidden, reconDiff
         else:
             returns totalCost, poolingCost, reconstructionCost, grad
+
+        Intermediate results are written into buffers that are kept
+        between calls (see TicaCostWorkspace), and the time spent in
+        each phase is added to self.costTimes. Gives exactly the same
+        results as _costReference.
+
+        If self.chunkSize is set, data (e.g. a numpy.memmap too large
+        to read at once) is processed in chunks of that many columns.
+        data may also be a function returning an iterator over column
+        chunks. Memory use then depends on the chunk size instead of
+        the number of examples, and the result equals the unchunked
+        one up to rounding. returnFull is not supported for chunked
+        data.
+
+        If self.nThreads > 1, each chunk is split into that many column
+        shards, processed in parallel by a pool of threads (numpy and
+        BLAS release the GIL). The shards are summed in a fixed order,
+        so results are reproducible for a given nThreads, and equal the
+        single threaded ones up to rounding. Set OMP_NUM_THREADS=1 (or
+        similar) so that BLAS does not also start its own threads.
+        Phase times are then summed over threads.
         '''
 
+        if self.referenceImpl:
+            return self._costReference(WW, data, plotEvery = plotEvery, returnFull = returnFull)
+
+        if callable(data):
+            chunks = data()
+            chunked = True
+        elif self.chunkSize is not None:
+            chunks = (data[:,begin:begin+self.chunkSize] for begin in xrange(0, data.shape[1], self.chunkSize))
+            chunked = True
+        else:
+            chunks = [data]
+            chunked = False
+        if chunked and returnFull:
+            raise Exception('returnFull is not supported for chunked data')
+
+        if self.float32:
+            # WW comes from the optimizer in float64
+            WW = array(WW, dtype='float32')
+
+        times = self.costTimes
+        t0 = time.time()
+        WW = WW.reshape(self.nHidden, self.nInputs)
+        WWold = WW
+        WW = l2RowScaled(WW)
+
+        numEvals = 0 if self.costLog is None else self.costLog.shape[0]
+        if plotEvery and numEvals % plotEvery == 0:
+            self.plotWW(WW, filePrefix = 'intermed_WW_%04d' % numEvals)
+        times['setup'] += time.time() - t0
+
+        # Sums over all chunks. The cached data.T is only valid for a
+        # whole in-memory array: chunk iterators may refill one buffer.
+        sums = self._newSums()
+        nThreads = 1 if returnFull else self.nThreads
+        cacheDataT = self.cacheDataT and not chunked
+        for chunk in chunks:
+            if nThreads > 1:
+                self._costChunkThreaded(WW, chunk, sums, nThreads, cacheDataT = cacheDataT)
+            else:
+                hidden, reconDiff = self._costChunk(WW, chunk, sums, cacheDataT = cacheDataT)
+        if sums['nDatapoints'] == 0:
+            raise Exception('Got no data')
+        for phase, elapsed in sums['times'].items():
+            times[phase] += elapsed
+
+        t0 = time.time()
+        nDatapoints = sums['nDatapoints']
+        reconstructionCost = sums['reconstructionCost']
+        poolingCost = self.lambd * sums['poolingTerm']
+        RxT = sums['RxT']
+        reconstructionCostGrad = 2 * dot(RxT + RxT.T, WW.T).T
+        poolingCostGrad = self.lambd * sums['hiddenHaDataT']
+
+        # Total cost and gradient per training example
+        poolingCost /= nDatapoints
+        reconstructionCost /= nDatapoints
+        totalCost = reconstructionCost + poolingCost
+        reconstructionCostGrad /= nDatapoints
+        poolingCostGrad /= nDatapoints
+        WGrad = reconstructionCostGrad + poolingCostGrad
+
+        grad = l2RowScaledGrad(WWold, WW, WGrad)
+        grad = grad.flatten()
+
+        if self.float32:
+            # convert back to keep fortran happy
+            grad = array(grad, dtype='float64')
+        times['finish'] += time.time() - t0
+        times['calls']  += 1
+
+        if returnFull:
+            # copy, as the buffers are overwritten by the next call
+            return totalCost, poolingCost, reconstructionCost, grad, hidden.copy(), reconDiff.copy()
+        else:
+            return totalCost, poolingCost, reconstructionCost, grad
+
+
+    def _newSums(self):
+        return {'nDatapoints': 0, 'reconstructionCost': 0.0, 'poolingTerm': 0.0, 'RxT': None, 'hiddenHaDataT': None,
+                'times': defaultdict(float)}
+
+
+    def _addSums(self, sums, other):
+        sums['nDatapoints'] += other['nDatapoints']
+        sums['reconstructionCost'] += other['reconstructionCost']
+        sums['poolingTerm'] += other['poolingTerm']
+        if sums['RxT'] is None:
+            sums['RxT'] = other['RxT']
+            sums['hiddenHaDataT'] = other['hiddenHaDataT']
+        else:
+            sums['RxT'] += other['RxT']
+            sums['hiddenHaDataT'] += other['hiddenHaDataT']
+        for phase, elapsed in other['times'].items():
+            sums['times'][phase] += elapsed
+
+
+    def _costChunkThreaded(self, WW, data, sums, nThreads, cacheDataT = False):
+        '''Like _costChunk, but splits data into nThreads column shards
+        processed in parallel. Each shard has its own workspace and
+        sums, which are added to sums in shard order.'''
+
+        dtype = float32 if self.float32 else result_type(WW, data)    # as in _costChunk
+        bounds = linspace(0, data.shape[1], nThreads + 1).astype(int)
+        shards = [(ii, data[:,bounds[ii]:bounds[ii+1]]) for ii in range(nThreads) if bounds[ii+1] > bounds[ii]]
+        for ii, shard in shards:
+            self._getWorkspace(dtype, slot = ii)     # create in this thread, not in the pool
+
+        pool = self.__dict__.get('_threadPool')
+        if pool is None or self.__dict__.get('_threadPoolSize') != nThreads:
+            if pool is not None:
+                pool.close()
+            pool = self._threadPool = ThreadPool(nThreads)
+            self._threadPoolSize = nThreads
+
+        def work(args):
+            ii, shard = args
+            shardSums = self._newSums()
+            self._costChunk(WW, shard, shardSums, slot = ii, cacheDataT = cacheDataT)
+            return shardSums
+
+        for shardSums in pool.map(work, shards):    # map returns results in shard order
+            self._addSums(sums, shardSums)
+
+
+    def _costChunk(self, WW, data, sums, slot = 0, cacheDataT = False):
+        '''Adds the contributions of the examples in data to sums (see cost).
+        Returns hidden, reconDiff, which are workspace buffers. slot
+        selects the workspace (one per concurrent caller). If
+        cacheDataT, reuses the workspace's copy of data.T when data is
+        at the same memory location as in the last call.'''
+
+        t0 = time.time()
+        nInputs = data.shape[0]
+        nDatapoints = data.shape[1]
+        if self.nInputs != nInputs:
+            raise Exception('Expected %d dimensional input, but got %d' % (self.nInputs, nInputs))
+        if self.float32:
+            data = asarray(data, dtype='float32')    # no copy if already float32
+
+        ws = self._getWorkspace(result_type(WW, data), slot = slot)
+        ws.resize(nDatapoints)
+        dataT = ws.getDataT(data) if cacheDataT else data.T
+        HHisDense = isinstance(self.HH, ndarray)
+        t1 = time.time()
+
+        # Forward Prop
+        hidden = dot(WW, data, out = ws.hidden)
+        t2 = time.time()
+
+        # Reconstruction cost
+        reconDiff = dot(WW.T, hidden, out = ws.reconDiff)
+        subtract(reconDiff, data, out = reconDiff)
+        reconstructionCost = sum(square(reconDiff, out = ws.inputTmp), dtype = float64)
+        t3 = time.time()
+
+        # L2 Pooling / Sparsity cost
+        square(hidden, out = ws.hiddenTmp)
+        if HHisDense:
+            absPooledActivations = dot(self.HH, ws.hiddenTmp, out = ws.pooled)
+        else:
+            absPooledActivations = self.HH.dot(ws.hiddenTmp)
+        add(absPooledActivations, self.epsilon, out = absPooledActivations)
+        sqrt(absPooledActivations, out = absPooledActivations)
+        poolingTerm = absPooledActivations.sum(dtype = float64)
+        t4 = time.time()
+
+        # Gradient of reconstruction cost term (the rest is done once all chunks are summed)
+        RxT = dot(reconDiff, dataT)
+        t5 = time.time()
+
+        # Gradient of sparsity / pooling term
+        invPooled = divide(1, absPooledActivations, out = absPooledActivations)
+        if HHisDense:
+            Ha = dot(self.HH.T, invPooled, out = ws.hiddenTmp)
+        else:
+            Ha = self.HH.T.dot(invPooled)
+        hiddenHa = multiply(hidden, Ha, out = ws.hiddenTmp)
+        hiddenHaDataT = dot(hiddenHa, dataT)
+        t6 = time.time()
+
+        sums['nDatapoints'] += nDatapoints
+        sums['reconstructionCost'] += reconstructionCost
+        sums['poolingTerm'] += poolingTerm
+        if sums['RxT'] is None:
+            sums['RxT'] = RxT
+            sums['hiddenHaDataT'] = hiddenHaDataT
+        else:
+            sums['RxT'] += RxT
+            sums['hiddenHaDataT'] += hiddenHaDataT
+
+        times = sums['times']
+        times['setup']       += t1 - t0
+        times['forward']     += t2 - t1
+        times['recon']       += t3 - t2
+        times['pooling']     += t4 - t3
+        times['reconGrad']   += t5 - t4
+        times['poolingGrad'] += t6 - t5
+
+        return hidden, reconDiff
+
+
+    def _getWorkspace(self, dtype, slot = 0):
+        key = (numpy.dtype(dtype), slot)    # float32 and dtype('float32') must give the same key
+        workspaces = self.__dict__.setdefault('_workspaces', {})
+        if key not in workspaces:
+            workspaces[key] = TicaCostWorkspace(self.nInputs, self.nHidden, self.nPooled, dtype)
+        return workspaces[key]
+
+
+    def releaseCostBuffers(self):
+        '''Drops the cost workspaces (including their copies of and
+        references to the data) and the thread pool, so that a trained
+        model does not hold on to memory proportional to the training
+        set. They are recreated by the next call to cost.'''
+        self.__dict__.pop('_workspaces', None)
+        pool = self.__dict__.pop('_threadPool', None)
+        self.__dict__.pop('_threadPoolSize', None)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+    @property
+    def costTimes(self):
+        '''Total wall time spent in each phase of cost, plus number of calls.'''
+        return self.__dict__.setdefault('_costTimes', defaultdict(float))
+
+
+    def printCostTimes(self):
+        times = self.costTimes
+        total = sum([times[phase] for phase in self.costPhases])
+        print 'TICA cost time breakdown over %d calls:' % times['calls']
+        for phase in self.costPhases:
+            print '  %12s: %8.3fs (%5.1f%%)' % (phase, times[phase], 100 * times[phase] / max(total, 1e-12))
+        print '  %12s: %8.3fs' % ('total', total)
+
+
+    def __getstate__(self):
+        # Do not pickle the (large) workspaces or the thread pool
+        state = self.__dict__.copy()
+        for key in ('_workspaces', '_costTimes', '_threadPool', '_threadPoolSize'):
+            state.pop(key, None)
+        return state
+
+
+    def _costReference(self, WW, data, plotEvery = None, returnFull = False):
+        '''Original version of cost, which allocates all intermediate results on each call.'''
+
         #pdb.set_trace()
 
         nInputs = data.shape[0]
@@ -165,7 +497,9 @@ class TICA(RICA):
             raise Exception('Expected %d dimensional input, but got %d' % (self.nInputs, nInputs))
 
         if self.float32:
+            # WW comes from the optimizer in float64. data should already be float32 (no copy then).
             WW = array(WW, dtype='float32')
+            data = asarray(data, dtype='float32')
         
         # NOTE: Flattening and reshaping is in C order in numpy but Fortran order in Matlab. This should not matter.
         WW = WW.reshape(self.nHidden, nInputs)
@@ -185,11 +519,11 @@ class TICA(RICA):
         
         # Reconstruction cost
         reconDiff = reconstruction - data
-        reconstructionCost = sum(reconDiff ** 2)
+        reconstructionCost = sum(reconDiff ** 2, dtype = float64)    # accumulate in float64 even for float32
 
         # L2 Pooling / Sparsity cost
-        absPooledActivations = sqrt(self.epsilon + dot(self.HH, hidden ** 2))     # 2.9s, aligned (C * C)
-        poolingTerm = absPooledActivations.sum()
+        absPooledActivations = sqrt(self.epsilon + self.HH.dot(hidden ** 2))      # 2.9s, aligned (C * C)
+        poolingTerm = absPooledActivations.sum(dtype = float64)
         poolingCost = self.lambd * poolingTerm
 
         # Gradient of reconstruction cost term
@@ -208,7 +542,7 @@ class TICA(RICA):
             print poolingCostGrad[:4,:4]
 
         # fast way
-        Ha = dot(self.HH.T, 1/absPooledActivations)                              # 3.1s, misaligned (F * C) -> -0.3 with self.HHT
+        Ha = self.HH.T.dot(1/absPooledActivations)                               # 3.1s, misaligned (F * C) -> -0.3 with self.HHT
         poolingCostGrad = self.lambd * dot(hidden * Ha, data.T)                  # 1.5s, misaligned (C * F) -> -0.3 with dataT
         #print 'fast way'
         #print poolingCostGrad[:4,:4]
@@ -243,6 +577,7 @@ class TICA(RICA):
             raise Exception('Expected %d dimensional input, but got %d' % (self.nInputs, nInputs))
         if self.float32:
             WW = array(self.WW, dtype='float32')
+            data = asarray(data, dtype='float32')
         else:
             WW = self.WW
         
@@ -252,7 +587,7 @@ class TICA(RICA):
 
         # Forward Prop
         hidden = dot(WW, data)
-        absPooledActivations = sqrt(self.epsilon + dot(self.HH, hidden ** 2))
+        absPooledActivations = sqrt(self.epsilon + self.HH.dot(hidden ** 2))
 
         return hidden, absPooledActivations
 
@@ -302,7 +637,10 @@ class TICA(RICA):
         hasher.update(self.nPoolingIgnoredNeurons)
         hasher.update(self.neighborhoodIsGaussian)
         hasher.update(self.nPooled)
-        hasher.update(self.HH)
+        if isinstance(self.HH, ndarray):
+            hasher.update(self.HH)
+        else:
+            hasher.update((self.HH.shape, self.HH.data, self.HH.indices, self.HH.indptr))
         return int(hasher.hexdigest(), 16)
         #return int(hasher.hexdigest()[:7], 16)  # only 7 hex digits fit into an int
 
@@ -31,6 +31,14 @@ def main():
                                 'partially trained StackedLayers object (default: none)'))
     parser.add_argument('--quick', action='store_true', help = 'Enable quick mode (default: off)')
     parser.add_argument('--nodiary', action='store_true', help = 'Disable diary (default: diary is on)')
+    parser.add_argument('--chunksize', type = int, default = None,
+                        help = ('Stream training data through lower layers this many examples ' +
+                                'at a time, bounding memory use (default: all at once)'))
+    parser.add_argument('--nprocs', type = int, default = None,
+                        help = 'Forward prop training data through lower layers using this many processes (default: 1)')
+    parser.add_argument('--prefetch', type = int, default = None,
+                        help = ('Sample training data in batches using this many background processes ' +
+                                'while earlier batches are forward propped (default: off)'))
 
     args = parser.parse_args()
 
@@ -53,7 +61,8 @@ def main():
 
     sl.printStatus()
 
-    sl.train(trainParams, saveDir = saveDir, quick = args.quick)
+    sl.train(trainParams, saveDir = saveDir, quick = args.quick, chunkSize = args.chunksize, nProcs = args.nprocs,
+             prefetch = args.prefetch)
 
     resman.stop()
 
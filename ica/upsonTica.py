@@ -15,15 +15,14 @@ from scipy.optimize.lbfgsb import fmin_l_bfgs_b
 from tica import TICA
 from GitResultsManager import resman, fmtSeconds
 from util.plotting import tile_raster_images
-from util.dataLoaders import loadFromPklGz, saveToFile
+from util.dataLoaders import saveToFile, loadUpsonData
 
 
 
 if __name__ == '__main__':
     resman.start('junk', diary = False)
 
-    data = loadFromPklGz('../data/upson_rovio_2/train_10_50000_1c.pkl.gz')
-    data = data.T   # Make into one example per column
+    data = loadUpsonData('../data/upson_rovio_2/train_10_50000_1c.pkl.gz')   # one example per column
     #data = data[:,:5000]      # HACK!!!!!!!!!
     
     hiddenISize = 8
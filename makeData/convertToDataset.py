@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+
+'''
+Converts .pkl.gz data files made by the makeData scripts to datasets
+(see util.fileIO.saveDataset), which the loaders then use instead.
+
+Usage:
+    ./convertToDataset.py loadUpsonData3 ../data/upson_rovio_3/*.pkl.gz
+    ./convertToDataset.py --compression zlib loadAtariData ../data/atari/*.pkl.gz
+'''
+
+import argparse
+
+from util.dataLoaders import loadAtariData, loadUpsonData, loadUpsonData3, loadRandomData, convertToDataset
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Converts .pkl.gz data files to datasets.')
+    parser.add_argument('dataLoaderName', type = str,
+                        choices = ['loadAtariData', 'loadUpsonData', 'loadUpsonData3', 'loadRandomData'],
+                        help = 'Loader that reads the files')
+    parser.add_argument('filenames', type = str, nargs = '+',
+                        help = '.pkl.gz files to convert')
+    parser.add_argument('--compression', type = str, default = None, choices = ['zlib', 'blosc', 'zstd'],
+                        help = 'Compress the datasets (default: uncompressed, loaded as memmaps)')
+    args = parser.parse_args()
+
+    dataLoader = globals()[args.dataLoaderName]   # convert string to function
+    for filename in args.filenames:
+        convertToDataset(filename, dataLoader, compression = args.compression)
+
+
+
+if __name__ == '__main__':
+    main()
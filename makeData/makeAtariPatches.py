@@ -7,7 +7,8 @@ from numpy import *
 import cPickle as pickle
 
 from rbm.utils import DuckStruct
-from util.dataLoaders import saveToFile
+from util.dataLoaders import saveLoadedDataset
+from util.patchSampler import randomPatchCoords, gatherPatchesFromFiles
 
 
 
@@ -38,34 +39,14 @@ def randomSampleMatrix(path, filterNames, Nw = 10, Nsamples = 10, color = False)
     size = im.size
 
     # select random windows
-    maxJ = size[0] - Nw
-    maxI = size[1] - Nw
-    randomSamples = vstack((random.randint(0, Nimages, Nsamples),
-                            random.randint(0, maxI+1, Nsamples),
-                            random.randint(0, maxJ+1, Nsamples))).T
+    randomSamples = randomPatchCoords(random, Nimages, (size[1], size[0]), (Nw, Nw), Nsamples)
     sortIdx = argsort(randomSamples[:,0])
     randomSamples = randomSamples[sortIdx,:]   # for efficient loading and unloading of images into memory. Re-randomize before returing
 
-    nChannels = 3 if color else 1
-    imageMatrix = zeros((Nsamples, Nw * Nw * nChannels), dtype = float32)
-    
-    imIdx = None
-    for count, sample in enumerate(randomSamples):
-        idx, ii, jj = sample
-        if imIdx != idx:
-            #print 'loading', idx
-            im = Image.open(filteredFiles[idx])
-            if not color:
-                im = im.convert('L')
-            imIdx = idx
-            if size != im.size:
-                raise Exception('Expected everything to be the same size but %s != %s' % (repr(size), repr(im.size)))
-            #im.show()
-        cropped = im.crop((jj, ii, jj + Nw, ii + Nw))
-        imageMatrix[count,:] = asarray(cropped).flatten()
-        #cropped.show()
-
-    imageMatrix /= 255   # normalize to 0-1 range
+    # decode only the images sampled from, one at a time, gathering each one's crops at once
+    # For color images, flattens to [ii_r ii_g ii_b ii+1_r ii+1_g ii+1_b ...]
+    imageMatrix = gatherPatchesFromFiles(filteredFiles, randomSamples, (Nw, Nw), color, divisor = 255)   # normalized to 0-1 range
+
     random.shuffle(imageMatrix)
     return imageMatrix
 
@@ -84,6 +65,9 @@ def main():
                                trainFilter = ['frame_0000%02d' % x for x in range(0,6)],
                                testFilter  = ['frame_0000%02d' % x for x in range(6,12)]))
 
+    # Saved as datasets (e.g. train_02_50_1c.dset), one example per column, for util.dataLoaders.loadAtariData
+    saveSamples = lambda filename, samples: saveLoadedDataset(filename, samples.T)
+
     for dataset in datasets:
         random.seed(0)
 
@@ -96,96 +80,96 @@ def main():
         #sys.exit(1)
 
         # monochrome
-        saveToFile(name + 'train_02_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 02, Nsamples = 50, color = False))
-        saveToFile(name + 'test_02_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 02, Nsamples = 50, color = False))
-        saveToFile(name + 'train_02_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 02, Nsamples = 50000, color = False))
-        saveToFile(name + 'test_02_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 02, Nsamples = 50000, color = False))
-
-        saveToFile(name + 'train_03_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 03, Nsamples = 50, color = False))
-        saveToFile(name + 'test_03_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 03, Nsamples = 50, color = False))
-        saveToFile(name + 'train_03_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 03, Nsamples = 50000, color = False))
-        saveToFile(name + 'test_03_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 03, Nsamples = 50000, color = False))
-
-        saveToFile(name + 'train_04_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 04, Nsamples = 50, color = False))
-        saveToFile(name + 'test_04_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 04, Nsamples = 50, color = False))
-        saveToFile(name + 'train_04_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 04, Nsamples = 50000, color = False))
-        saveToFile(name + 'test_04_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 04, Nsamples = 50000, color = False))
-
-        saveToFile(name + 'train_06_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 06, Nsamples = 50, color = False))
-        saveToFile(name + 'test_06_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 06, Nsamples = 50, color = False))
-        saveToFile(name + 'train_06_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 06, Nsamples = 50000, color = False))
-        saveToFile(name + 'test_06_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 06, Nsamples = 50000, color = False))
-
-        saveToFile(name + 'train_10_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 10, Nsamples = 50, color = False))
-        saveToFile(name + 'test_10_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 10, Nsamples = 50, color = False))
-        saveToFile(name + 'train_10_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 10, Nsamples = 50000, color = False))
-        saveToFile(name + 'test_10_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 10, Nsamples = 50000, color = False))
-
-        saveToFile(name + 'train_15_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 15, Nsamples = 50, color = False))
-        saveToFile(name + 'test_15_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 15, Nsamples = 50, color = False))
-        saveToFile(name + 'train_15_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 15, Nsamples = 50000, color = False))
-        saveToFile(name + 'test_15_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 15, Nsamples = 50000, color = False))
-
-        saveToFile(name + 'train_20_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 20, Nsamples = 50, color = False))
-        saveToFile(name + 'test_20_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 20, Nsamples = 50, color = False))
-        saveToFile(name + 'train_20_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 20, Nsamples = 50000, color = False))
-        saveToFile(name + 'test_20_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 20, Nsamples = 50000, color = False))
-
-        saveToFile(name + 'train_25_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 25, Nsamples = 50, color = False))
-        saveToFile(name + 'test_25_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 25, Nsamples = 50, color = False))
-        saveToFile(name + 'train_25_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 25, Nsamples = 50000, color = False))
-        saveToFile(name + 'test_25_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 25, Nsamples = 50000, color = False))
-
-        saveToFile(name + 'train_28_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 28, Nsamples = 50, color = False))
-        saveToFile(name + 'test_28_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 28, Nsamples = 50, color = False))
-        saveToFile(name + 'train_28_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 28, Nsamples = 50000, color = False))
-        saveToFile(name + 'test_28_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 28, Nsamples = 50000, color = False))
+        saveSamples(name + 'train_02_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 02, Nsamples = 50, color = False))
+        saveSamples(name + 'test_02_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 02, Nsamples = 50, color = False))
+        saveSamples(name + 'train_02_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 02, Nsamples = 50000, color = False))
+        saveSamples(name + 'test_02_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 02, Nsamples = 50000, color = False))
+
+        saveSamples(name + 'train_03_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 03, Nsamples = 50, color = False))
+        saveSamples(name + 'test_03_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 03, Nsamples = 50, color = False))
+        saveSamples(name + 'train_03_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 03, Nsamples = 50000, color = False))
+        saveSamples(name + 'test_03_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 03, Nsamples = 50000, color = False))
+
+        saveSamples(name + 'train_04_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 04, Nsamples = 50, color = False))
+        saveSamples(name + 'test_04_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 04, Nsamples = 50, color = False))
+        saveSamples(name + 'train_04_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 04, Nsamples = 50000, color = False))
+        saveSamples(name + 'test_04_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 04, Nsamples = 50000, color = False))
+
+        saveSamples(name + 'train_06_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 06, Nsamples = 50, color = False))
+        saveSamples(name + 'test_06_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 06, Nsamples = 50, color = False))
+        saveSamples(name + 'train_06_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 06, Nsamples = 50000, color = False))
+        saveSamples(name + 'test_06_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 06, Nsamples = 50000, color = False))
+
+        saveSamples(name + 'train_10_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 10, Nsamples = 50, color = False))
+        saveSamples(name + 'test_10_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 10, Nsamples = 50, color = False))
+        saveSamples(name + 'train_10_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 10, Nsamples = 50000, color = False))
+        saveSamples(name + 'test_10_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 10, Nsamples = 50000, color = False))
+
+        saveSamples(name + 'train_15_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 15, Nsamples = 50, color = False))
+        saveSamples(name + 'test_15_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 15, Nsamples = 50, color = False))
+        saveSamples(name + 'train_15_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 15, Nsamples = 50000, color = False))
+        saveSamples(name + 'test_15_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 15, Nsamples = 50000, color = False))
+
+        saveSamples(name + 'train_20_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 20, Nsamples = 50, color = False))
+        saveSamples(name + 'test_20_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 20, Nsamples = 50, color = False))
+        saveSamples(name + 'train_20_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 20, Nsamples = 50000, color = False))
+        saveSamples(name + 'test_20_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 20, Nsamples = 50000, color = False))
+
+        saveSamples(name + 'train_25_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 25, Nsamples = 50, color = False))
+        saveSamples(name + 'test_25_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 25, Nsamples = 50, color = False))
+        saveSamples(name + 'train_25_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 25, Nsamples = 50000, color = False))
+        saveSamples(name + 'test_25_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 25, Nsamples = 50000, color = False))
+
+        saveSamples(name + 'train_28_50_1c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 28, Nsamples = 50, color = False))
+        saveSamples(name + 'test_28_50_1c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 28, Nsamples = 50, color = False))
+        saveSamples(name + 'train_28_50000_1c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 28, Nsamples = 50000, color = False))
+        saveSamples(name + 'test_28_50000_1c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 28, Nsamples = 50000, color = False))
 
         # color
-        saveToFile(name + 'train_02_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 02, Nsamples = 50, color = True))
-        saveToFile(name + 'test_02_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 02, Nsamples = 50, color = True))
-        saveToFile(name + 'train_02_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 02, Nsamples = 50000, color = True))
-        saveToFile(name + 'test_02_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 02, Nsamples = 50000, color = True))
-
-        saveToFile(name + 'train_03_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 03, Nsamples = 50, color = True))
-        saveToFile(name + 'test_03_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 03, Nsamples = 50, color = True))
-        saveToFile(name + 'train_03_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 03, Nsamples = 50000, color = True))
-        saveToFile(name + 'test_03_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 03, Nsamples = 50000, color = True))
-
-        saveToFile(name + 'train_04_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 04, Nsamples = 50, color = True))
-        saveToFile(name + 'test_04_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 04, Nsamples = 50, color = True))
-        saveToFile(name + 'train_04_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 04, Nsamples = 50000, color = True))
-        saveToFile(name + 'test_04_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 04, Nsamples = 50000, color = True))
-
-        saveToFile(name + 'train_06_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 06, Nsamples = 50, color = True))
-        saveToFile(name + 'test_06_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 06, Nsamples = 50, color = True))
-        saveToFile(name + 'train_06_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 06, Nsamples = 50000, color = True))
-        saveToFile(name + 'test_06_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 06, Nsamples = 50000, color = True))
-
-        saveToFile(name + 'train_10_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 10, Nsamples = 50, color = True))
-        saveToFile(name + 'test_10_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 10, Nsamples = 50, color = True))
-        saveToFile(name + 'train_10_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 10, Nsamples = 50000, color = True))
-        saveToFile(name + 'test_10_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 10, Nsamples = 50000, color = True))
-
-        saveToFile(name + 'train_15_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 15, Nsamples = 50, color = True))
-        saveToFile(name + 'test_15_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 15, Nsamples = 50, color = True))
-        saveToFile(name + 'train_15_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 15, Nsamples = 50000, color = True))
-        saveToFile(name + 'test_15_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 15, Nsamples = 50000, color = True))
-
-        saveToFile(name + 'train_20_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 20, Nsamples = 50, color = True))
-        saveToFile(name + 'test_20_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 20, Nsamples = 50, color = True))
-        saveToFile(name + 'train_20_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 20, Nsamples = 50000, color = True))
-        saveToFile(name + 'test_20_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 20, Nsamples = 50000, color = True))
-
-        saveToFile(name + 'train_25_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 25, Nsamples = 50, color = True))
-        saveToFile(name + 'test_25_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 25, Nsamples = 50, color = True))
-        saveToFile(name + 'train_25_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 25, Nsamples = 50000, color = True))
-        saveToFile(name + 'test_25_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 25, Nsamples = 50000, color = True))
-
-        saveToFile(name + 'train_28_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 28, Nsamples = 50, color = True))
-        saveToFile(name + 'test_28_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 28, Nsamples = 50, color = True))
-        saveToFile(name + 'train_28_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 28, Nsamples = 50000, color = True))
-        saveToFile(name + 'test_28_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 28, Nsamples = 50000, color = True))
+        saveSamples(name + 'train_02_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 02, Nsamples = 50, color = True))
+        saveSamples(name + 'test_02_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 02, Nsamples = 50, color = True))
+        saveSamples(name + 'train_02_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 02, Nsamples = 50000, color = True))
+        saveSamples(name + 'test_02_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 02, Nsamples = 50000, color = True))
+
+        saveSamples(name + 'train_03_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 03, Nsamples = 50, color = True))
+        saveSamples(name + 'test_03_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 03, Nsamples = 50, color = True))
+        saveSamples(name + 'train_03_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 03, Nsamples = 50000, color = True))
+        saveSamples(name + 'test_03_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 03, Nsamples = 50000, color = True))
+
+        saveSamples(name + 'train_04_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 04, Nsamples = 50, color = True))
+        saveSamples(name + 'test_04_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 04, Nsamples = 50, color = True))
+        saveSamples(name + 'train_04_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 04, Nsamples = 50000, color = True))
+        saveSamples(name + 'test_04_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 04, Nsamples = 50000, color = True))
+
+        saveSamples(name + 'train_06_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 06, Nsamples = 50, color = True))
+        saveSamples(name + 'test_06_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 06, Nsamples = 50, color = True))
+        saveSamples(name + 'train_06_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 06, Nsamples = 50000, color = True))
+        saveSamples(name + 'test_06_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 06, Nsamples = 50000, color = True))
+
+        saveSamples(name + 'train_10_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 10, Nsamples = 50, color = True))
+        saveSamples(name + 'test_10_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 10, Nsamples = 50, color = True))
+        saveSamples(name + 'train_10_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 10, Nsamples = 50000, color = True))
+        saveSamples(name + 'test_10_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 10, Nsamples = 50000, color = True))
+
+        saveSamples(name + 'train_15_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 15, Nsamples = 50, color = True))
+        saveSamples(name + 'test_15_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 15, Nsamples = 50, color = True))
+        saveSamples(name + 'train_15_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 15, Nsamples = 50000, color = True))
+        saveSamples(name + 'test_15_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 15, Nsamples = 50000, color = True))
+
+        saveSamples(name + 'train_20_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 20, Nsamples = 50, color = True))
+        saveSamples(name + 'test_20_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 20, Nsamples = 50, color = True))
+        saveSamples(name + 'train_20_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 20, Nsamples = 50000, color = True))
+        saveSamples(name + 'test_20_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 20, Nsamples = 50000, color = True))
+
+        saveSamples(name + 'train_25_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 25, Nsamples = 50, color = True))
+        saveSamples(name + 'test_25_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 25, Nsamples = 50, color = True))
+        saveSamples(name + 'train_25_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 25, Nsamples = 50000, color = True))
+        saveSamples(name + 'test_25_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 25, Nsamples = 50000, color = True))
+
+        saveSamples(name + 'train_28_50_3c.pkl.gz',    randomSampleMatrix(path, trainFilter, Nw = 28, Nsamples = 50, color = True))
+        saveSamples(name + 'test_28_50_3c.pkl.gz',     randomSampleMatrix(path, testFilter,  Nw = 28, Nsamples = 50, color = True))
+        saveSamples(name + 'train_28_50000_3c.pkl.gz', randomSampleMatrix(path, trainFilter, Nw = 28, Nsamples = 50000, color = True))
+        saveSamples(name + 'test_28_50000_3c.pkl.gz',  randomSampleMatrix(path, testFilter,  Nw = 28, Nsamples = 50000, color = True))
 
 
 
@@ -2,7 +2,7 @@
 
 from numpy import *
 
-from util.dataLoaders import saveToFile
+from util.dataLoaders import saveLoadedDataset
 
 '''
 Creates random data!
@@ -18,7 +18,7 @@ def main():
                     nColors = (3 if color else 1)
                     size = (Nw * Nw * nColors, Nsamples)
                     xx = random.uniform(0, 1, size)
-                    saveToFile('../data/random/randomu01_%s_%02d_%d_%dc.pkl.gz' % (string, Nw, Nsamples, nColors), xx)
+                    saveLoadedDataset('../data/random/randomu01_%s_%02d_%d_%dc.pkl.gz' % (string, Nw, Nsamples, nColors), xx)
 
 
 
@@ -5,8 +5,9 @@ from PIL import Image
 from numpy import *
 import cPickle as pickle
 import ipdb
-from util.dataLoaders import saveToFile
+from util.dataLoaders import saveLoadedDataset
 from makeUpsonRovio1 import getFilesIn
+from util.patchSampler import randomPatchCoords, gatherPatchesFromFiles
 
 
 
@@ -52,39 +53,14 @@ def randomSampleMatrix(filterNames, seed, color, Nw = 10, Nsamples = 10,
     size = im.size
 
     # select random windows
-    maxJ = size[0] - Nw
-    maxI = size[1] - Nw
-    randomSamples = vstack((random.randint(0, Nimages, Nsamples),
-                            random.randint(0, maxI+1, Nsamples),
-                            random.randint(0, maxJ+1, Nsamples))).T
+    randomSamples = randomPatchCoords(random, Nimages, (size[1], size[0]), (Nw, Nw), Nsamples)
     # for efficient loading and unloading of images into memory. Re-randomize before returing
     randomSamples = randomSamples[argsort(randomSamples[:,0]), :]
-    
-    if color:
-        imageMatrix = zeros((Nsamples, Nw * Nw * 3), dtype = float32)
-    else:
-        imageMatrix = zeros((Nsamples, Nw * Nw), dtype = float32)
-    
-    imIdx = None
-    for count, sample in enumerate(randomSamples):
-        idx, ii, jj = sample
-        if imIdx != idx:
-            #print 'loading', idx
-            if color:
-                im = Image.open(filteredFiles[idx])
-            else:
-                im = Image.open(filteredFiles[idx]).convert('L')
-            imIdx = idx
-            if size != im.size:
-                raise Exception('Expected everything to be the same size but %s != %s' % (repr(size), repr(im.size)))
-            #im.show()
-
-        cropped = im.crop((jj, ii, jj + Nw, ii + Nw))
-        # For color images, flattens to [ii_r ii_g ii_b ii+1_r ii+1_g ii+1_b ...]
-        imageMatrix[count,:] = array(cropped.getdata()).flatten()
-        #cropped.show()
-
-    imageMatrix /= 255   # normalize to 0-1 range
+
+    # decode only the images sampled from, one at a time, gathering each one's crops at once
+    # For color images, flattens to [ii_r ii_g ii_b ii+1_r ii+1_g ii+1_b ...]
+    imageMatrix = gatherPatchesFromFiles(filteredFiles, randomSamples, (Nw, Nw), color, divisor = 255)   # normalized to 0-1 range
+
     random.shuffle(imageMatrix)
     return imageMatrix
 
@@ -98,7 +74,8 @@ def main():
     u2_stationary_1 u2_strafe_r_0 u2_strafe_r_1 u2_strafe_r_2
     u2_strafe_r_3 u2_turn_r_0 u2_turn_r_1'''
     
-    sav = saveToFile
+    # Saved as datasets (e.g. train_02_50_1c.dset), one example per column, for util.dataLoaders.loadUpsonData
+    sav = lambda filename, samples: saveLoadedDataset(filename, samples.T)
     rsm = randomSampleMatrix
     flnm = '../data/upson_rovio_2/%s.pkl.gz'
 
@@ -1,11 +1,14 @@
 #! /usr/bin/env python
 
 import os, pdb, gzip
+import hashlib
 from PIL import Image
 from numpy import *
+from numpy.lib.format import open_memmap
 import cPickle as pickle
 import ipdb as pdb
-from util.dataLoaders import saveToFile
+from util.dataLoaders import saveLoadedDataset
+from util.patchSampler import randomPatchCoords, gatherPatches, PatchSource
 from makeUpsonRovio1 import getFilesIn
 
 
@@ -73,16 +76,28 @@ labelStrings = ['circle',
 
 
 
-def randomSampleMatrixWithLabels(filterNames, color, Nw = (10,10), Nsamples = 10, seed = None, rng = None,
-                                 imgDirectory = '../data/upson_rovio_3/imgfiles'):
-    '''color = True or False
-    It is an error to give both a seed and an rng'''
+# Image stores already opened by this process, keyed by (imgDirectory, filterNames, color)
+_imageStores = {}
 
-    if seed is not None and rng is not None:
-        raise Exception('must specify at most one of (seed, rng)')
 
-    if rng is None:
-        rng = random.RandomState(seed)      # if seed is None, this takes its seed from timer
+
+def imageStore(filterNames, color, imgDirectory = '../data/upson_rovio_3/imgfiles', storeDirectory = None):
+    '''Returns (images, labels) for all images in imgDirectory whose
+    names contain one of filterNames, sorted by filename:
+
+        images: uint8 array of shape (Nimages, height, width) for
+                grayscale or (Nimages, height, width, 3) for color,
+                memory mapped from a .npy file
+        labels: int array of shape (Nimages, len(labelStrings))
+
+    The images are decoded once and saved in storeDirectory (default:
+    imgDirectory + '_store'), in a file named by a hash of the file
+    names, sizes and modification times and color. Later calls (from any process) just memory map
+    that file, and calls in this process reuse the open store.'''
+
+    key = (imgDirectory, tuple(filterNames), color)
+    if key in _imageStores:
+        return _imageStores[key]
 
     files = getFilesIn(imgDirectory)
 
@@ -99,48 +114,71 @@ def randomSampleMatrixWithLabels(filterNames, color, Nw = (10,10), Nsamples = 10
     Nimages = len(filteredFiles)
     if Nimages == 0:
         raise Exception('Nimages == 0, maybe try running from a different directory?')
-    
-    im = Image.open(filteredFiles[0])
-    size = im.size
 
-    # select random windows
-    maxJ = size[0] - Nw[1]   # size in x = j direction
-    maxI = size[1] - Nw[0]   # size in y = i direction
-    randomSamples = vstack((rng.randint(0, Nimages, Nsamples),
-                            rng.randint(0, maxI+1, Nsamples),
-                            rng.randint(0, maxJ+1, Nsamples))).T
-    # for efficient loading and unloading of images into memory. Re-randomize before returing
-    randomSamples = randomSamples[argsort(randomSamples[:,0]), :]
-    
-    if color:
-        imageMatrix = zeros((Nsamples, Nw[0] * Nw[1] * 3), dtype = float32)
-    else:
-        imageMatrix = zeros((Nsamples, Nw[0] * Nw[1]), dtype = float32)
-    labelMatrix = zeros((Nsamples, len(labelStrings)))
-    
-    imIdx = None
-    for count, sample in enumerate(randomSamples):
-        idx, ii, jj = sample
-        if imIdx != idx:
-            #print 'loading', idx
+    if storeDirectory is None:
+        storeDirectory = imgDirectory.rstrip('/') + '_store'
+    hasher = hashlib.sha1()
+    hasher.update('color' if color else 'gray')
+    for filename in filteredFiles:
+        stat = os.stat(filename)     # so replaced or edited images get a new store
+        hasher.update('%s %d %r' % (os.path.basename(filename), stat.st_size, stat.st_mtime))
+    storeFile = os.path.join(storeDirectory, '%s_%s.npy' % ('3c' if color else '1c', hasher.hexdigest()[:16]))
+
+    if not os.path.exists(storeFile):
+        print 'imageStore: decoding %d images into %s' % (Nimages, storeFile)
+        if not os.path.exists(storeDirectory):
+            os.makedirs(storeDirectory)
+        size = Image.open(filteredFiles[0]).size
+        shape = (Nimages, size[1], size[0], 3) if color else (Nimages, size[1], size[0])
+        tmpFile = '%s.%d.tmp' % (storeFile, os.getpid())
+        images = open_memmap(tmpFile, mode = 'w+', dtype = uint8, shape = shape)
+        for idx, filename in enumerate(filteredFiles):
             if color:
-                im = Image.open(filteredFiles[idx])
+                im = Image.open(filename).convert('RGB')
             else:
-                im = Image.open(filteredFiles[idx]).convert('L')
-            filename = os.path.basename(filteredFiles[idx])
-            labels = array([st in filename for st in labelStrings], dtype=int)
-            imIdx = idx
+                im = Image.open(filename).convert('L')
             if size != im.size:
                 raise Exception('Expected everything to be the same size but %s != %s' % (repr(size), repr(im.size)))
-            #im.show()
+            images[idx] = asarray(im, dtype = uint8)
+        images.flush()
+        del images
+        os.rename(tmpFile, storeFile)
+
+    images = load(storeFile, mmap_mode = 'r')
+    labels = array([[st in os.path.basename(filename) for st in labelStrings] for filename in filteredFiles], dtype = int)
+    _imageStores[key] = (images, labels)
+    return images, labels
 
-        cropped = im.crop((jj, ii, jj + Nw[1], ii + Nw[0]))
-        # For color images, flattens to [ii_r ii_g ii_b ii+1_r ii+1_g ii+1_b ...]
-        imageMatrix[count,:] = array(cropped.getdata()).flatten()
-        labelMatrix[count,:] = labels[:]
-        #cropped.show()
 
-    imageMatrix /= 255   # normalize to 0-1 range
+
+def randomSampleMatrixWithLabels(filterNames, color, Nw = (10,10), Nsamples = 10, seed = None, rng = None,
+                                 imgDirectory = '../data/upson_rovio_3/imgfiles'):
+    '''color = True or False
+    It is an error to give both a seed and an rng
+
+    Crops are gathered all at once from the image store (see
+    imageStore and util.patchSampler); for a given seed or rng state
+    the result is the same as cropping the images one at a time with
+    PIL.'''
+
+    if seed is not None and rng is not None:
+        raise Exception('must specify at most one of (seed, rng)')
+
+    if rng is None:
+        rng = random.RandomState(seed)      # if seed is None, this takes its seed from timer
+
+    images, imageLabels = imageStore(filterNames, color, imgDirectory = imgDirectory)
+    Nimages = images.shape[0]
+
+    # select random windows
+    randomSamples = randomPatchCoords(rng, Nimages, images.shape[1:3], Nw, Nsamples)
+    # sorted by image for locality in the store. Re-randomize before returing
+    randomSamples = randomSamples[argsort(randomSamples[:,0]), :]
+
+    # For color images, flattens to [ii_r ii_g ii_b ii+1_r ii+1_g ii+1_b ...]
+    imageMatrix = gatherPatches(PatchSource(images, divisor = 255), randomSamples, Nw)   # normalized to 0-1 range
+    idx = randomSamples[:,0]
+    labelMatrix = imageLabels[idx].astype(float)
 
     # shuffle both matrices together
     shufIdx = rng.permutation(range(Nsamples))
@@ -152,7 +190,8 @@ def randomSampleMatrixWithLabels(filterNames, color, Nw = (10,10), Nsamples = 10
 
 
 def main():
-    sav = saveToFile
+    # Saved as datasets (e.g. train_02_50_1c.dset), one example per column, for util.dataLoaders.loadUpsonData3
+    sav = lambda filename, (imageMatrix, labelMatrix, labelStrings): saveLoadedDataset(filename, (imageMatrix.T, labelMatrix.T, labelStrings))
     rsm = randomSampleMatrixWithLabels
     flnm = '../data/upson_rovio_3/%s.pkl.gz'
 
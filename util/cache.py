@@ -10,12 +10,29 @@ import ipdb as pdb
 import hashlib
 import marshal
 import os
+import errno
+import socket
+import shutil
+import sqlite3
+import argparse
 from datetime import datetime
 import time
 from numpy import *
 import cPickle as pickle
+import sys
 import types
 import inspect
+import weakref
+import copy
+import mmap
+import threading
+import Queue
+import atexit
+from collections import OrderedDict
+try:
+    import xxhash
+except ImportError:
+    xxhash = None     # only needed for the xxh64 / xxh128 hash algorithms
 
 from fileIO import loadFromPklGz, saveToFile
 from misc import mkdir_p
@@ -29,9 +46,128 @@ globalCacheDir     = os.path.join(os.path.expanduser("~"), '.pycache')    # syml
 globalCacheVerbose = 2                  # 0: print nothing. 1: Print info about hits or misses. 2: print filenames. 3: print hash steps
 globalDisableCache = False              # Set to True to disable all caching
 
+# Size limit for the whole cache, in MB (None for no limit), e.g. set
+# with PYCACHE_MAX_SIZE_MB. When a new result takes the cache over the
+# limit, old entries are evicted. Only entries in the index are
+# considered: run 'cache.py inspect' or 'prune' once to add entries
+# saved before the index existed. Single entries are further limited
+# by their callers where needed (e.g. MAX_CACHE_SIZE_MB in ica/layers.py).
+globalCacheMaxSizeMB = float(os.environ['PYCACHE_MAX_SIZE_MB']) if 'PYCACHE_MAX_SIZE_MB' in os.environ else None
+globalCacheEvictionPolicy = 'lru'       # 'lru': evict least recently used first. 'lfu': evict least often hit first.
+globalCacheNpyArrays = True             # Store ndarray results (and tuples containing them) as .npy files, loaded as memmaps
+globalCacheHitFlushSeconds = 30.0       # Record hits in the index at most this often (see _recordHit)
 
+# Whether to keep the cache index, which the size limit and hit counts
+# need (see _withIndex). sqlite locking is unreliable on network
+# filesystems such as NFS, so None (the default) skips the index, with
+# a warning, when globalCacheDir is on one. True or False forces it.
+globalCacheIndex = None
 
-__all__ = ['globalCacheDir', 'globalCacheVerbose', 'globalDisableCache', 'memoize', 'cached', 'betacached']
+# Hash algorithm used for cache keys: any hashlib algorithm (e.g. 'sha1',
+# 'md5', 'blake2b' where available), or 'xxh64' / 'xxh128' if the xxhash
+# package is installed. The default is xxh64, several times faster than
+# sha1 on large arrays, or md5 without xxhash. Changing it changes all
+# keys (old entries are not found).
+globalCacheHashAlg = os.environ.get('PYCACHE_HASH_ALG', 'md5' if xxhash is None else 'xxh64')
+globalCacheHashMemo = True              # Remember digests of large read-only arrays, so they are not rehashed (see arrayDigest)
+
+# Version of the cache key format, hashed into every key. Bump it when
+# the way arguments are hashed changes, so old entries are never
+# mistaken for new ones. Entries with old keys are no longer hit and
+# are eventually evicted by the size limit (or run: cache.py prune).
+#   1: sha1 of the raw bytes of array arguments
+#   2: arrays hashed with their dtype and shape, using globalCacheHashAlg
+cacheKeyVersion = 2
+
+# Size of the in-memory tier in front of the disk cache, in MB (0 to
+# disable). Results kept there are returned again as the very same
+# objects, as with cached2, so the tier keeps a copy with read-only
+# arrays (see _readOnlyCopy): modifying a memory hit in place raises an
+# error instead of silently changing later hits. Off by default for that reason.
+globalCacheMemoryMB = float(os.environ.get('PYCACHE_MEMORY_MB', 0))
+
+# Save results in a background thread, so a cache miss returns as soon
+# as the function does. The thread saves a copy of the result, so the
+# caller may modify its result in place right away.
+globalCacheAsyncWrites = os.environ.get('PYCACHE_ASYNC_WRITES', '0') == '1'
+
+# Single flight across processes sharing a cache directory: on a miss,
+# the first process takes a lock file on the key and computes the
+# result, the others wait for it and load it (see KeyLock).
+globalCacheLocking     = True
+globalCacheLockTimeout = 3600.0         # seconds to wait for another process before computing anyway (None: forever)
+globalCacheLockStale   = 300.0          # seconds after which a lock that is no longer refreshed is considered abandoned
+
+
+
+__all__ = ['globalCacheDir', 'globalCacheVerbose', 'globalDisableCache', 'globalCacheMaxSizeMB', 'globalCacheEvictionPolicy',
+           'globalCacheNpyArrays', 'globalCacheHitFlushSeconds', 'globalCacheIndex', 'globalCacheHashAlg', 'globalCacheHashMemo', 'globalCacheMemoryMB', 'globalCacheAsyncWrites',
+           'globalCacheLocking', 'globalCacheLockTimeout', 'globalCacheLockStale',
+           'memoize', 'cacheTierStats', 'flushCacheWrites', 'flushCacheHits', 'cached', 'betacached']
+
+
+
+def newHashAlg(name = None):
+    '''Returns a new hash object (with update, digest and hexdigest
+    methods) for the named algorithm, by default globalCacheHashAlg.'''
+
+    name = name or globalCacheHashAlg
+    if name in ('xxh64', 'xxh128'):
+        if xxhash is None:
+            raise Exception('Hash algorithm %s requires the xxhash package' % name)
+        return getattr(xxhash, name)()
+    return hashlib.new(name)
+
+
+
+_hashMemo = {}                   # (id(array), algorithm) -> (weakref to array, fingerprint, digest)
+_hashMemoMinBytes = 1 << 20      # smaller arrays are cheap enough to just rehash
+
+
+
+def _isReadOnly(arr):
+    '''True if neither arr nor any array it is a view of is writeable,
+    so its contents cannot change (through numpy) while it is alive.'''
+    while isinstance(arr, ndarray):
+        if arr.flags.writeable:
+            return False
+        arr = arr.base
+    return True
+
+
+
+def _arrayFingerprint(arr):
+    '''The memory location and layout of an array.'''
+    return (arr.__array_interface__['data'][0], arr.shape, arr.strides, arr.dtype.str)
+
+
+
+def arrayDigest(arr, hashAlgName = None):
+    '''Returns the digest of an array's dtype, shape and contents.
+
+    If globalCacheHashMemo is True, digests of large read-only arrays
+    (see _isReadOnly), such as those returned by the memory tier, are
+    remembered as long as the array object is alive and reused if the
+    same object is hashed again. Writeable arrays are always rehashed,
+    as they may have been changed in place.'''
+
+    hashAlgName = hashAlgName or globalCacheHashAlg
+    useMemo = globalCacheHashMemo and arr.nbytes >= _hashMemoMinBytes and _isReadOnly(arr)
+    if useMemo:
+        key = (id(arr), hashAlgName)
+        fingerprint = _arrayFingerprint(arr)
+        entry = _hashMemo.get(key)
+        if entry is not None and entry[0]() is arr and entry[1] == fingerprint:
+            return entry[2]
+
+    hashAlg = newHashAlg(hashAlgName)
+    hashAlg.update('%s %s' % (arr.dtype.str, repr(arr.shape)))
+    hashAlg.update(ascontiguousarray(arr))
+    digest = hashAlg.digest()
+
+    if useMemo:
+        _hashMemo[key] = (weakref.ref(arr, lambda ref : _hashMemo.pop(key, None)), fingerprint, digest)
+    return digest
 
 
 
@@ -39,14 +175,16 @@ class PersistentHasher(object):
     '''Hashes, persistently and consistenly. Suports only two methods:
     update and hexdigest. Supports numpy arrays and dicts.'''
 
-    def __init__(self, verbose = None):
+    def __init__(self, verbose = None, hashAlgName = None):
         self.verbose = verbose if verbose is not None else globalCacheVerbose
         self.counter = 0
-        self.hashAlg = hashlib.sha1()
+        self.hashAlgName = hashAlgName or globalCacheHashAlg
+        self.hashAlg = newHashAlg(self.hashAlgName)
         if self.verbose >= 3:
             self._printStatus()
         self.salt = '3.14159265358979323'
         self.classHashWarningPrinted = False
+        self.hashAlg.update('%skeyVersion%d' % (self.salt, cacheKeyVersion))
 
 
     def update(self, obj, level = 0):
@@ -61,10 +199,10 @@ class PersistentHasher(object):
             # function code itself (a bit overconservative)
             self.hashAlg.update(obj.__name__)
             self.hashAlg.update(marshal.dumps(obj.func_code))
-        elif type(obj) is ndarray:
-            # can update directly with numpy arrays
+        elif isinstance(obj, ndarray):
+            # numpy arrays (including memmaps returned by cache hits) are hashed separately, so the digest can be memoized
             self.hashAlg.update(self.salt + 'numpy.ndarray')
-            self.hashAlg.update(obj)
+            self.hashAlg.update(arrayDigest(obj, self.hashAlgName))
         elif type(obj) is dict:
             self.hashAlg.update(self.salt + 'dict')
             for key,val in sorted(obj.items()):
@@ -131,6 +269,696 @@ def persistentHash(object):
 
 
 
+#
+# Cache index: a sqlite database in the cache directory recording the
+# size, last access time and number of hits of every entry, plus hit
+# and miss counts per function. All changes are made inside a
+# transaction that takes the database write lock first, so parallel
+# jobs sharing a cache directory can record hits and evict entries at
+# the same time. If an entry is evicted while another process is about
+# to load it, that process just gets a cache miss.
+#
+# Hits are not written one by one, which would take the write lock on
+# every load: they are collected in _pendingHits and written together
+# every globalCacheHitFlushSeconds, before any eviction, and at exit.
+#
+# The index is not used on network filesystems (see globalCacheIndex).
+#
+
+_networkFsTypes = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'lustre', 'gpfs', 'glusterfs', 'ceph', 'fuse.sshfs', 'beegfs')
+_indexUsable = {}        # cache directory -> whether the index is used there
+_pendingHits = {}        # relPath -> [functionName, lastAccess, hits] not yet in the index
+_pendingHitsLock = threading.Lock()
+_lastHitFlush = time.time()
+
+
+
+def _indexPath():
+    return os.path.join(globalCacheDir, 'index.sqlite')
+
+
+
+def _fsType(path):
+    '''Type of the filesystem holding path, from /proc/mounts, or None
+    if unknown (e.g. not on Linux).'''
+
+    path = os.path.realpath(path)
+    mountPoint, fsType = '', None
+    try:
+        with open('/proc/mounts') as ff:
+            for line in ff:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) > len(mountPoint):
+                    mountPoint, fsType = mount, fields[2]
+    except IOError:
+        return None
+    return fsType
+
+
+
+def _useIndex():
+    '''Whether to use the index of globalCacheDir (see globalCacheIndex).'''
+
+    if globalCacheIndex is not None:
+        return globalCacheIndex
+    if globalCacheDir not in _indexUsable:
+        fsType = _fsType(globalCacheDir)
+        _indexUsable[globalCacheDir] = fsType not in _networkFsTypes
+        if not _indexUsable[globalCacheDir] and globalCacheVerbose >= 1:
+            print (' -> cache.py: WARNING: %s is on a %s filesystem, where sqlite locking is unreliable; not using the '
+                   'cache index (no size limit or hit counts). Set globalCacheIndex = True to use it anyway.' % (globalCacheDir, fsType))
+    return _indexUsable[globalCacheDir]
+
+
+
+def _withIndex(action, *args):
+    '''Runs action(conn, *args) in a transaction on the cache index and
+    returns its result, or None if the index is not used (see
+    globalCacheIndex). Problems with the index are reported, but
+    never stop the cached function from returning its result.'''
+
+    if not _useIndex():
+        return None
+    try:
+        mkdir_p(globalCacheDir)
+        conn = sqlite3.connect(_indexPath(), timeout = 120, isolation_level = None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')    # take the write lock now
+            conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(path TEXT PRIMARY KEY, functionName TEXT, size INTEGER, created REAL, lastAccess REAL, hits INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counts '
+                         '(functionName TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)')
+            try:
+                ret = action(conn, *args)
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return ret
+        finally:
+            conn.close()
+    except sqlite3.Error as ee:
+        if globalCacheVerbose >= 1:
+            print ' -> cache.py: WARNING: could not use cache index %s: %s' % (_indexPath(), ee)
+        return None
+
+
+
+def _pathSize(path):
+    '''Size in bytes of a file, or of all files in a directory.'''
+    if os.path.isdir(path):
+        return sum([os.path.getsize(os.path.join(dirpath, ff))
+                    for dirpath, dirnames, filenames in os.walk(path) for ff in filenames])
+    return os.path.getsize(path)
+
+
+
+def _removePath(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError:
+        pass       # already removed by someone else
+
+
+
+def _countCall(conn, functionName, column):
+    conn.execute('INSERT OR IGNORE INTO counts VALUES (?, 0, 0)', (functionName,))
+    conn.execute('UPDATE counts SET %s = %s + 1 WHERE functionName = ?' % (column, column), (functionName,))
+
+
+
+def _indexHits(conn, hits):
+    '''Records hits, a dict like _pendingHits, in the index.'''
+    counts = {}
+    for relPath, (functionName, lastAccess, nHits) in hits.items():
+        if conn.execute('UPDATE entries SET lastAccess = MAX(lastAccess, ?), hits = hits + ? WHERE path = ?',
+                        (lastAccess, nHits, relPath)).rowcount == 0:
+            # Entry written before the index existed (or evicted since the hit)
+            path = os.path.join(globalCacheDir, relPath)
+            if os.path.exists(path):
+                conn.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                             (relPath, functionName, _pathSize(path), lastAccess, lastAccess, nHits))
+        counts[functionName] = counts.get(functionName, 0) + nHits
+    for functionName, nHits in counts.items():
+        conn.execute('INSERT OR IGNORE INTO counts VALUES (?, 0, 0)', (functionName,))
+        conn.execute('UPDATE counts SET hits = hits + ? WHERE functionName = ?', (nHits, functionName))
+
+
+
+def _takePendingHits():
+    global _lastHitFlush
+    with _pendingHitsLock:
+        hits = dict(_pendingHits)
+        _pendingHits.clear()
+        _lastHitFlush = time.time()
+    return hits
+
+
+
+def _recordHit(relPath, functionName):
+    '''Notes a hit, writing all pending hits to the index if the last
+    write was more than globalCacheHitFlushSeconds ago.'''
+    with _pendingHitsLock:
+        entry = _pendingHits.setdefault(relPath, [functionName, 0, 0])
+        entry[1] = time.time()
+        entry[2] += 1
+        due = time.time() - _lastHitFlush >= globalCacheHitFlushSeconds
+    if due:
+        flushCacheHits()
+
+
+
+def flushCacheHits():
+    '''Writes hits not yet recorded in the cache index.'''
+    hits = _takePendingHits()
+    if hits:
+        _withIndex(_indexHits, hits)
+
+atexit.register(flushCacheHits)
+
+
+
+def _indexMiss(conn, relPath, functionName):
+    '''Records a newly saved entry, then evicts others if the cache is over its size limit.'''
+    now = time.time()
+    size = _pathSize(os.path.join(globalCacheDir, relPath))
+    conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, 0)', (relPath, functionName, size, now, now))
+    _countCall(conn, functionName, 'misses')
+    if globalCacheMaxSizeMB is not None:
+        _indexHits(conn, _takePendingHits())     # so recently hit entries are not evicted
+        _evict(conn, globalCacheMaxSizeMB * 1e6, globalCacheEvictionPolicy, keep = relPath)
+
+
+
+def _syncIndex(conn):
+    '''Adds cache entries missing from the index (e.g. written before it
+    existed, using their modification time as last access) and drops
+    index entries whose files are gone. This lists the whole cache
+    while holding the index lock, so it is only run by inspectCache and
+    pruneCache, never by cached functions.'''
+
+    onDisk = {}
+    for subdir in os.listdir(globalCacheDir):
+        subdirPath = os.path.join(globalCacheDir, subdir)
+        if len(subdir) != 2 or not os.path.isdir(subdirPath):
+            continue
+        for name in os.listdir(subdirPath):
+            if not name.startswith('.'):     # skip temporary files
+                onDisk[os.path.join(subdir, name)] = os.path.join(subdirPath, name)
+    inIndex = set([row[0] for row in conn.execute('SELECT path FROM entries')])
+
+    for relPath in inIndex - set(onDisk.keys()):
+        conn.execute('DELETE FROM entries WHERE path = ?', (relPath,))
+    for relPath in set(onDisk.keys()) - inIndex:
+        path = onDisk[relPath]
+        try:
+            size, mtime = _pathSize(path), os.path.getmtime(path)
+        except OSError:
+            continue
+        functionName = relPath.split('.')[1] if relPath.count('.') >= 2 else ''
+        conn.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?, 0)', (relPath, functionName, size, mtime, mtime))
+
+
+
+def _evict(conn, maxBytes, policy, keep = None, dryRun = False):
+    '''Deletes entries, least recently used (policy 'lru') or least
+    often hit (policy 'lfu') first, until the indexed entries total at
+    most maxBytes. The entry keep is never deleted. Returns a list of
+    (path, size) of the deleted entries.'''
+
+    if policy not in ('lru', 'lfu'):
+        raise Exception('Unknown eviction policy: %s' % repr(policy))
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+    evicted = []
+    if total <= maxBytes:
+        return evicted
+    order = 'lastAccess' if policy == 'lru' else 'hits, lastAccess'
+    for relPath, size in conn.execute('SELECT path, size FROM entries ORDER BY %s' % order).fetchall():
+        if total <= maxBytes:
+            break
+        if relPath == keep:
+            continue
+        if not dryRun:
+            _removePath(os.path.join(globalCacheDir, relPath))
+            conn.execute('DELETE FROM entries WHERE path = ?', (relPath,))
+        total -= size
+        evicted.append((relPath, size))
+    if evicted and globalCacheVerbose >= 1 and not dryRun:
+        print ' -> cache.py: evicted %d entries (%.1f MB) to stay under %.1f MB' % (len(evicted), sum([ee[1] for ee in evicted]) / 1e6, maxBytes / 1e6)
+    return evicted
+
+
+
+def _isNpyArray(obj):
+    '''True for arrays that can be stored in and memory mapped from a
+    .npy file. Subclasses (matrix, MaskedArray, ...) are pickled
+    instead, so they come back as the same type.'''
+    return type(obj) is ndarray and not obj.dtype.hasobject and obj.size > 0
+
+
+
+def _npyStorable(result):
+    return _isNpyArray(result) or (type(result) is tuple and any([_isNpyArray(item) for item in result]))
+
+
+
+def _saveNpyEntry(path, tmpPath, stats, result):
+    '''Saves a result for which _npyStorable is True as the directory
+    path. Each array in result (or result itself) is saved as N.npy;
+    stats and any other tuple items are pickled in meta.pkl. The
+    directory is written at tmpPath and then renamed, so readers never
+    see a partial entry.'''
+
+    kind, items = ('tuple', list(result)) if type(result) is tuple else ('array', [result])
+    others = {}
+    os.mkdir(tmpPath)
+    try:
+        for ii, item in enumerate(items):
+            if _isNpyArray(item):
+                save(os.path.join(tmpPath, '%d.npy' % ii), item)
+            else:
+                others[ii] = item
+        with open(os.path.join(tmpPath, 'meta.pkl'), 'wb') as ff:
+            pickle.dump((stats, kind, len(items), others), ff, pickle.HIGHEST_PROTOCOL)
+    except:
+        shutil.rmtree(tmpPath)
+        raise
+    try:
+        os.rename(tmpPath, path)
+    except OSError:
+        shutil.rmtree(tmpPath)     # another process saved the same entry first
+
+
+
+def _loadNpyEntry(path):
+    '''Loads an entry saved by _saveNpyEntry, returning (stats, result).
+    Arrays are memory mapped copy-on-write: loading is nearly free,
+    processes share the pages, and modifying the arrays in place only
+    changes this process's copy, never the cache.'''
+
+    with open(os.path.join(path, 'meta.pkl'), 'rb') as ff:
+        stats, kind, nItems, others = pickle.load(ff)
+    items = [others[ii] if ii in others else load(os.path.join(path, '%d.npy' % ii), mmap_mode = 'c')
+             for ii in range(nItems)]
+    return stats, (tuple(items) if kind == 'tuple' else items[0])
+
+
+
+def _resultBytes(obj, seen = None):
+    '''Rough size in bytes of a result held in memory: ndarrays count
+    their data (memory mapped arrays almost nothing, as their pages
+    belong to the OS file cache), containers and objects the sum of
+    their contents.'''
+
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, memmap):
+        return 1000
+    if isinstance(obj, ndarray):
+        return obj.nbytes + 100
+    if type(obj) in (tuple, list):
+        return sys.getsizeof(obj) + sum([_resultBytes(item, seen) for item in obj])
+    if type(obj) is dict:
+        return sys.getsizeof(obj) + sum([_resultBytes(val, seen) for val in obj.values()])
+    if hasattr(obj, '__dict__') and not inspect.isclass(obj) and not inspect.isroutine(obj):
+        return sys.getsizeof(obj) + _resultBytes(obj.__dict__, seen)
+    return sys.getsizeof(obj)
+
+
+
+def _arraysIn(obj, found = None, seen = None):
+    '''Returns the ndarrays in a result: itself, or those inside its
+    tuples, lists, dicts and object attributes.'''
+
+    found = [] if found is None else found
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return found
+    seen.add(id(obj))
+    if isinstance(obj, ndarray):
+        found.append(obj)
+    elif type(obj) in (tuple, list):
+        for item in obj:
+            _arraysIn(item, found, seen)
+    elif type(obj) is dict:
+        for val in obj.values():
+            _arraysIn(val, found, seen)
+    elif hasattr(obj, '__dict__') and not inspect.isclass(obj) and not inspect.isroutine(obj):
+        _arraysIn(obj.__dict__, found, seen)
+    return found
+
+
+
+def _readOnlyCopy(result):
+    '''Returns a copy of result whose arrays are not writeable, or None
+    if it cannot be copied. Memory mapped arrays (as loaded by
+    _loadNpyEntry) are mapped again read-only instead of being read
+    into memory.'''
+
+    memo = {}
+    for arr in _arraysIn(result):
+        if isinstance(arr, memmap) and isinstance(arr.base, mmap.mmap) and arr.filename is not None:
+            try:
+                again = load(arr.filename, mmap_mode = 'r')
+            except (IOError, ValueError):
+                continue
+            if again.shape == arr.shape and again.dtype == arr.dtype and again.strides == arr.strides:
+                memo[id(arr)] = again
+    try:
+        copied = copy.deepcopy(result, memo)
+    except Exception:
+        return None
+    for arr in _arraysIn(copied):
+        arr.flags.writeable = False
+    return copied
+
+
+
+class MemoryLRU(object):
+    '''In-memory least recently used cache of results, bounded by the
+    total of their sizes as estimated by _resultBytes.'''
+
+    def __init__(self):
+        self.entries = OrderedDict()     # key -> (result, nBytes), least recently used first
+        self.nBytes = 0
+
+
+    def get(self, key):
+        '''Returns (True, result) if key is present, else (False, None).'''
+        try:
+            result, nBytes = self.entries.pop(key)
+        except KeyError:
+            return False, None
+        self.entries[key] = (result, nBytes)     # now most recently used
+        return True, result
+
+
+    def put(self, key, result, maxBytes):
+        '''Stores result, then evicts the least recently used entries
+        until the total is at most maxBytes. Results larger than
+        maxBytes by themselves are not stored. A read-only copy of
+        result is stored (see _readOnlyCopy), as it is shared with
+        every later get; result itself is left as it is.'''
+        self.discard(key)
+        nBytes = _resultBytes(result)
+        if nBytes > maxBytes:
+            return
+        result = _readOnlyCopy(result)
+        if result is None:
+            return
+        self.entries[key] = (result, nBytes)
+        self.nBytes += nBytes
+        while self.nBytes > maxBytes:
+            oldKey, (oldResult, oldBytes) = self.entries.popitem(last = False)
+            self.nBytes -= oldBytes
+
+
+    def discard(self, key):
+        if key in self.entries:
+            self.nBytes -= self.entries.pop(key)[1]
+
+
+    def clear(self):
+        self.entries.clear()
+        self.nBytes = 0
+
+
+
+_memoryTier = MemoryLRU()
+_tierCounts = {'memory': {'hits': 0, 'misses': 0},     # misses in memory go on to the disk tier
+               'disk':   {'hits': 0, 'misses': 0}}
+
+
+
+def cacheTierStats():
+    '''Returns hit and miss counts for the memory and disk tiers in
+    this process, plus the current size of the memory tier.'''
+
+    stats = dict([(tier, dict(counts)) for tier, counts in _tierCounts.items()])
+    stats['memory']['entries'] = len(_memoryTier.entries)
+    stats['memory']['MB'] = _memoryTier.nBytes / 1e6
+    return stats
+
+
+
+def clearMemoryCache():
+    '''Empties the memory tier (the disk cache is untouched).'''
+    _memoryTier.clear()
+
+
+
+def _pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ee:
+        return ee.errno != errno.ESRCH
+    return True
+
+
+
+class KeyLock(object):
+    '''Lock file saying that a process is computing a cache entry.
+
+    The file is created with O_CREAT | O_EXCL, which is atomic on local
+    disks and on NFS v3 and later, and records the host and pid of its
+    holder. While held, a heartbeat thread refreshes its modification
+    time every globalCacheLockStale / 4 seconds. A lock whose holder
+    died (checked directly on the same host, by the missing heartbeat
+    elsewhere) is stale, and is removed by the next process to find
+    it. Two processes racing to remove the same stale lock may both
+    end up computing the entry, which is no worse than no locking.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.held = False
+        self._stopHeartbeat = None
+
+
+    def acquire(self, functionName = '', timeout = None):
+        '''Takes the lock, waiting while another process holds it.
+        Returns True once held, or False if the lock could not be
+        created or was still held after timeout seconds (default
+        globalCacheLockTimeout), in which case the caller should just
+        go ahead without it.'''
+
+        timeout = globalCacheLockTimeout if timeout is None else timeout
+        start = time.time()
+        delay = .05
+        waiting = False
+        while True:
+            try:
+                if self._tryCreate():
+                    break
+            except OSError as ee:
+                if globalCacheVerbose >= 1:
+                    print ' -> cache.py: WARNING: could not create lock %s (%s), not locking' % (self.path, ee)
+                return False
+            if self._isStale():
+                if globalCacheVerbose >= 1:
+                    print ' -> cache.py: %s: removing stale lock %s' % (functionName, self.path)
+                _removePath(self.path)
+                continue
+            if timeout is not None and time.time() - start > timeout:
+                if globalCacheVerbose >= 1:
+                    print ' -> cache.py: %s: WARNING: gave up waiting for lock %s after %.0fs' % (functionName, self.path, timeout)
+                return False
+            if not waiting and globalCacheVerbose >= 1:
+                print ' -> cache.py: %s: waiting for another process to compute this entry' % functionName
+            waiting = True
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
+        self.held = True
+        self._stopHeartbeat = threading.Event()
+        heartbeat = threading.Thread(target = self._heartbeat, args = (self._stopHeartbeat,), name = 'cache lock heartbeat')
+        heartbeat.daemon = True
+        heartbeat.start()
+        return True
+
+
+    def release(self):
+        if self.held:
+            self._stopHeartbeat.set()
+            _removePath(self.path)
+            self.held = False
+
+
+    def _tryCreate(self):
+        mkdir_p(os.path.dirname(self.path))
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+        except OSError as ee:
+            if ee.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd, '%s %d\n' % (socket.gethostname(), os.getpid()))
+        os.close(fd)
+        return True
+
+
+    def _isStale(self):
+        try:
+            with open(self.path) as ff:
+                fields = ff.read().split()
+            age = time.time() - os.path.getmtime(self.path)
+        except (IOError, OSError):
+            return False       # just released: try again
+        if len(fields) == 2 and fields[0] == socket.gethostname() and not _pidAlive(int(fields[1])):
+            return True
+        return age > globalCacheLockStale
+
+
+    def _heartbeat(self, stop):
+        while not stop.wait(globalCacheLockStale / 4):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                pass
+
+
+
+def _loadEntry(npyRelPath, pklRelPath, functionName, elapsedHashWall):
+    '''Loads and returns a saved result, raising IOError if there is none.'''
+
+    start = time.time()
+    cacheRelPath = npyRelPath if os.path.isdir(os.path.join(globalCacheDir, npyRelPath)) else pklRelPath
+    cachePath    = os.path.join(globalCacheDir, cacheRelPath)
+    if globalCacheVerbose >= 3:
+        print (' -> cache.py: %s: trying to load file %s'
+               % (functionName, cachePath))
+    if cacheRelPath == npyRelPath:
+        (stats,result) = _loadNpyEntry(cachePath)
+    else:
+        (stats,result) = loadFromPklGz(cachePath)
+    elapsedWall = time.time() - start
+    _tierCounts['disk']['hits'] += 1
+    _recordHit(cacheRelPath, functionName)
+    if globalCacheVerbose >= 1:
+        print (' -> cache.py: %s: cache hit (%.04fs hash overhead, %.04fs to load, saved %.04fs)'
+               % (functionName, elapsedHashWall, elapsedWall, stats['timeWall'] - elapsedWall))
+        if globalCacheVerbose >= 2:
+            print '   -> loaded %s' % cachePath
+    return result
+
+
+
+def _saveEntry(cachePath, cacheTmpPath, cacheRelPath, functionName, stats, result):
+    '''Writes an entry at cacheTmpPath, renames it to cachePath, and
+    records it in the index.'''
+
+    mkdir_p(os.path.dirname(cachePath))
+    if cachePath.endswith('.npy'):
+        _saveNpyEntry(cachePath, cacheTmpPath, stats, result)
+    else:
+        saveToFile(cacheTmpPath, (stats,result), quiet = True)
+        os.rename(cacheTmpPath, cachePath)
+    _withIndex(_indexMiss, cacheRelPath, functionName)
+
+
+
+#
+# Asynchronous writes (globalCacheAsyncWrites): entries are saved by a
+# single background thread, fed through a queue. pickle and zlib do
+# much of their work without the GIL, so the caller mostly keeps
+# running in parallel. The writer is given a deep copy of the result
+# (see _snapshot), so the caller may change its result right away.
+# Results waiting to be written are kept in _pendingWrites, so the same
+# key is never queued twice and lookups in this process find them.
+# Remaining writes are flushed at exit. A process forked while writes
+# are queued inherits this state but not the writer thread, so it
+# starts over with its own (see _checkFork); the parent still writes,
+# and releases the locks of, the entries it queued.
+#
+
+_writeQueue    = None
+_pendingWrites = {}       # cacheBase -> (result,) for entries queued or being written
+_pendingLock   = threading.Lock()
+_writerPid     = os.getpid()
+
+
+
+def _checkFork():
+    '''Resets the asynchronous write state if this process was forked
+    from the one that created it.'''
+
+    global _writeQueue, _pendingWrites, _pendingLock, _writerPid
+    if _writerPid != os.getpid():
+        _writeQueue    = None
+        _pendingWrites = {}
+        _pendingLock   = threading.Lock()     # may have been held by another thread at the fork
+        _writerPid     = os.getpid()
+
+
+
+def _snapshot(result):
+    '''Returns a deep copy of result for the writer thread, or None if
+    it cannot be copied (then it is saved right away instead).'''
+    try:
+        return copy.deepcopy(result)
+    except Exception:
+        return None
+
+
+
+def _writerLoop():
+    while True:
+        cacheBase, lock, saveArgs = _writeQueue.get()
+        try:
+            _saveEntry(*saveArgs)
+            if globalCacheVerbose >= 2:
+                print '   -> cache.py: saved to %s' % saveArgs[0]
+        except Exception as ee:
+            print ' -> cache.py: WARNING: could not save cache entry %s: %s' % (saveArgs[0], ee)
+            _removePath(saveArgs[1])
+        finally:
+            with _pendingLock:
+                _pendingWrites.pop(cacheBase, None)
+            if lock is not None:
+                lock.release()
+            _writeQueue.task_done()
+
+
+
+def _queueWrite(cacheBase, lock, *saveArgs):
+    '''Queues _saveEntry(*saveArgs) for the writer thread, starting it
+    if needed. The writer releases lock (a KeyLock or None) when done.
+    Returns False if cacheBase is already queued.'''
+
+    global _writeQueue
+    _checkFork()
+    with _pendingLock:
+        if cacheBase in _pendingWrites:
+            return False
+        if _writeQueue is None:
+            _writeQueue = Queue.Queue()
+            writer = threading.Thread(target = _writerLoop, name = 'cache writer')
+            writer.daemon = True
+            writer.start()
+            atexit.register(flushCacheWrites)
+        _pendingWrites[cacheBase] = (saveArgs[-1],)
+        _writeQueue.put((cacheBase, lock, saveArgs))
+    return True
+
+
+
+def flushCacheWrites():
+    '''Blocks until all queued asynchronous writes are on disk.'''
+    _checkFork()
+    if _writeQueue is not None:
+        if _pendingWrites and globalCacheVerbose >= 1:
+            print ' -> cache.py: waiting for %d cache entries to be saved' % len(_pendingWrites)
+        _writeQueue.join()
+
+
+
 def memoize(function):
     '''Decorator to memoize function'''
 
@@ -156,54 +984,96 @@ def memoize(function):
             functionName = function.__name__    # a little more reliable than func_name
             digest = hasher.hexdigest()
 
-            cacheFilename    = '%s.%s.pkl.gz' % (digest[:16], functionName)
+            # An entry is either a gzipped pickle or a directory of .npy files (see _saveNpyEntry)
+            cacheBase        = '%s.%s' % (digest[:16], functionName)
+            pklRelPath       = os.path.join(cacheBase[:2], cacheBase + '.pkl.gz')
+            npyRelPath       = os.path.join(cacheBase[:2], cacheBase + '.npy')
             # get a unique filename that does not affect any random number generators
-            cacheTmpFilename = '.%s-%06d.tmp' % (cacheFilename, datetime.now().microsecond)
-            cachePath    = os.path.join(globalCacheDir, cacheFilename[:2], cacheFilename)
-            cacheTmpPath = os.path.join(globalCacheDir, cacheFilename[:2], cacheTmpFilename)
+            cacheTmpFilename = '.%s-%06d.tmp' % (cacheBase, datetime.now().microsecond)
+            cacheTmpPath     = os.path.join(globalCacheDir, cacheBase[:2], cacheTmpFilename)
             elapsedHashWall = time.time() - startHashWall
 
-            try:
-                start = time.time()
-                if globalCacheVerbose >= 3:
-                    print (' -> cache.py: %s: trying to load file %s'
-                           % (functionName, cachePath))
-                (stats,result) = loadFromPklGz(cachePath)
-                elapsedWall = time.time() - start
+            # Memory tier: no I/O, no unpickling. Not recorded in the
+            # disk index, which only sees the hit that loaded the entry.
+            if globalCacheMemoryMB > 0:
+                found, result = _memoryTier.get(cacheBase)
+                if found:
+                    _tierCounts['memory']['hits'] += 1
+                    if globalCacheVerbose >= 1:
+                        print (' -> cache.py: %s: memory cache hit (%.04fs hash overhead)'
+                               % (functionName, elapsedHashWall))
+                    return result
+                _tierCounts['memory']['misses'] += 1
+
+            # Computed earlier by this process but still waiting to be
+            # written. Return a copy: the writer is still using it.
+            _checkFork()
+            with _pendingLock:
+                pending = _pendingWrites.get(cacheBase)
+            if pending is not None:
                 if globalCacheVerbose >= 1:
-                    print (' -> cache.py: %s: cache hit (%.04fs hash overhead, %.04fs to load, saved %.04fs)'
-                           % (functionName, elapsedHashWall, elapsedWall, stats['timeWall'] - elapsedWall))
-                    if globalCacheVerbose >= 2:
-                        print '   -> loaded %s' % cachePath
-            except IOError:
-                if globalCacheVerbose >= 3:
-                    print (' -> cache.py: %s: cache miss, computing function'
-                           % (functionName))
-                startWall = time.time()
-                startCPU  = time.clock()
-                result = function(*args, **kwargs)
-                elapsedWall = time.time() - startWall
-                elapsedCPU  = time.clock() - startCPU
-                    
-                stats = {'functionName': functionName,
-                         'timeWall': elapsedWall,
-                         'timeCPU': elapsedCPU,
-                         'saveDate': datetime.now(),
-                         }
-
-                startSave = time.time()
-                mkdir_p(os.path.dirname(cachePath))
-                if globalCacheVerbose >= 3:
-                    print (' -> cache.py: %s: function execution finished, saving result to file %s'
-                           % (functionName, cachePath))
-                saveToFile(cacheTmpPath, (stats,result), quiet = True)
-                os.rename(cacheTmpPath, cachePath)
-                if globalCacheVerbose >= 1:
-                    print (' -> cache.py: %s: cache miss (%.04fs hash overhead, %.04fs to save, %.04fs to compute)'
-                           % (functionName, elapsedHashWall, time.time() - startSave, elapsedWall))
-                    if globalCacheVerbose >= 2:
-                        print '   -> saved to %s' % cachePath
+                    print ' -> cache.py: %s: hit on result still being saved' % functionName
+                return copy.deepcopy(pending[0])
 
+            lock = None
+            try:
+                while True:
+                    try:
+                        result = _loadEntry(npyRelPath, pklRelPath, functionName, elapsedHashWall)
+                        break
+                    except IOError:
+                        if globalCacheLocking and lock is None:
+                            # Single flight: if another process is computing this
+                            # entry, wait for it, then look again
+                            lock = KeyLock(os.path.join(globalCacheDir, cacheBase[:2], '.%s.lock' % cacheBase))
+                            lock.acquire(functionName)
+                            continue
+
+                    _tierCounts['disk']['misses'] += 1
+                    if globalCacheVerbose >= 3:
+                        print (' -> cache.py: %s: cache miss, computing function'
+                               % (functionName))
+                    startWall = time.time()
+                    startCPU  = time.clock()
+                    result = function(*args, **kwargs)
+                    elapsedWall = time.time() - startWall
+                    elapsedCPU  = time.clock() - startCPU
+
+                    stats = {'functionName': functionName,
+                             'timeWall': elapsedWall,
+                             'timeCPU': elapsedCPU,
+                             'saveDate': datetime.now(),
+                             }
+
+                    cacheRelPath = npyRelPath if globalCacheNpyArrays and _npyStorable(result) else pklRelPath
+                    cachePath    = os.path.join(globalCacheDir, cacheRelPath)
+                    if globalCacheVerbose >= 3:
+                        print (' -> cache.py: %s: function execution finished, saving result to file %s'
+                               % (functionName, cachePath))
+                    snapshot = _snapshot(result) if globalCacheAsyncWrites else None
+                    if snapshot is not None:
+                        # the writer thread releases the lock once the entry is saved
+                        queued = _queueWrite(cacheBase, lock, cachePath, cacheTmpPath, cacheRelPath, functionName, stats, snapshot)
+                        if queued:
+                            lock = None
+                        if globalCacheVerbose >= 1:
+                            print (' -> cache.py: %s: cache miss (%.04fs hash overhead, %s, %.04fs to compute)'
+                                   % (functionName, elapsedHashWall, 'queued for saving' if queued else 'already being saved', elapsedWall))
+                    else:
+                        startSave = time.time()
+                        _saveEntry(cachePath, cacheTmpPath, cacheRelPath, functionName, stats, result)
+                        if globalCacheVerbose >= 1:
+                            print (' -> cache.py: %s: cache miss (%.04fs hash overhead, %.04fs to save, %.04fs to compute)'
+                                   % (functionName, elapsedHashWall, time.time() - startSave, elapsedWall))
+                            if globalCacheVerbose >= 2:
+                                print '   -> saved to %s' % cachePath
+                    break
+            finally:
+                if lock is not None:
+                    lock.release()
+
+            if globalCacheMemoryMB > 0:
+                _memoryTier.put(cacheBase, result, globalCacheMemoryMB * 1e6)
             return result
 
     return wrapper
@@ -219,7 +1089,11 @@ def cached(function, *args, **kwargs):
 
 
 def cached2(cacheobj, function, *args, **kwargs):
-    '''Return cached answer or compute and cache. Uses two layers of caching (local object for use with ipython %run and standard caching).'''
+    '''Return cached answer or compute and cache. Uses two layers of caching (local object for use with ipython %run and standard caching).
+
+    If globalCacheMemoryMB > 0, cached() itself keeps recent results
+    in memory; cacheobj is then only needed for results that should
+    outlive the memory tier, e.g. across ipython %run.'''
 
     return _cached2(cacheobj, True, function, *args, **kwargs)
 
@@ -272,7 +1146,7 @@ def invCached(mat, times = 1.0):
 
 
 
-def main():
+def demo():
     random.seed(0)
     a = random.rand(500,500)
     #print 'a is\n', a
@@ -287,6 +1161,149 @@ def main():
     invCached(a, 2.0)
     print 'computing cached(linalg.inv, a)'
     cached(linalg.inv, a)
+    print 'computing cached(linalg.inv, a) again (memory tier if globalCacheMemoryMB > 0)'
+    cached(linalg.inv, a)
+    print 'tier stats:', cacheTierStats()
+
+
+
+def inspectCache(nLargest = 10):
+    '''Prints the size of the cache, broken down by function, and its largest entries.'''
+
+    flushCacheHits()
+    def action(conn):
+        _syncIndex(conn)
+        byFunction = conn.execute('SELECT functionName, COUNT(*), SUM(size), SUM(hits) FROM entries '
+                                  'GROUP BY functionName ORDER BY SUM(size) DESC').fetchall()
+        largest = conn.execute('SELECT path, size, lastAccess, hits FROM entries ORDER BY size DESC LIMIT ?', (nLargest,)).fetchall()
+        return byFunction, largest
+    ret = _withIndex(action)
+    if ret is None:
+        print 'Cache index of %s not available' % globalCacheDir
+        return
+    byFunction, largest = ret
+
+    totalSize = sum([row[2] for row in byFunction])
+    print 'Cache %s: %d entries, %.1f MB (limit: %s)' % (globalCacheDir, sum([row[1] for row in byFunction]), totalSize / 1e6,
+                                                         'none' if globalCacheMaxSizeMB is None else '%g MB' % globalCacheMaxSizeMB)
+    print '\n%-40s %8s %12s %8s' % ('function', 'entries', 'size (MB)', 'hits')
+    for functionName, count, size, hits in byFunction:
+        print '%-40s %8d %12.1f %8d' % (functionName, count, size / 1e6, hits)
+    print '\nLargest entries:'
+    for relPath, size, lastAccess, hits in largest:
+        print '  %10.1f MB  %4d hits  last used %s  %s' % (size / 1e6, hits, datetime.fromtimestamp(lastAccess).strftime('%Y-%m-%d %H:%M'), relPath)
+
+
+
+def cacheHitRates():
+    '''Prints hits, misses, and hit rate per function, as recorded in the index.'''
+
+    flushCacheHits()
+    rows = _withIndex(lambda conn : conn.execute('SELECT functionName, hits, misses FROM counts ORDER BY hits + misses DESC').fetchall())
+    if rows is None:
+        print 'Cache index of %s not available' % globalCacheDir
+        return
+    print '%-40s %8s %8s %9s' % ('function', 'hits', 'misses', 'hit rate')
+    for functionName, hits, misses in rows:
+        print '%-40s %8d %8d %8.1f%%' % (functionName, hits, misses, 100.0 * hits / max(hits + misses, 1))
+    totalHits, totalMisses = sum([row[1] for row in rows]), sum([row[2] for row in rows])
+    print '%-40s %8d %8d %8.1f%%' % ('(all)', totalHits, totalMisses, 100.0 * totalHits / max(totalHits + totalMisses, 1))
+
+
+
+def pruneCache(maxSizeMB, policy = None, dryRun = False):
+    '''Evicts entries until the cache is at most maxSizeMB.'''
+
+    flushCacheHits()
+    policy = policy or globalCacheEvictionPolicy
+    def action(conn):
+        _syncIndex(conn)
+        return _evict(conn, maxSizeMB * 1e6, policy, dryRun = dryRun)
+    evicted = _withIndex(action)
+    if evicted is None:
+        print 'Cache index of %s not available' % globalCacheDir
+        return
+    for relPath, size in evicted:
+        print '  %s %10.1f MB  %s' % ('would remove' if dryRun else 'removed', size / 1e6, relPath)
+    print '%s %d entries, %.1f MB' % ('Would remove' if dryRun else 'Removed', len(evicted), sum([ee[1] for ee in evicted]) / 1e6)
+
+
+
+def benchHash(sizeMB = 256):
+    '''Prints hashing throughput of a large array for each available
+    algorithm, compared to the original sha1 of the raw bytes, and
+    the time to hash it again when the digest is memoized.'''
+
+    arr = random.RandomState(0).rand(int(sizeMB * 1e6 / 8))
+    arr.flags.writeable = False     # only read-only arrays are memoized
+    gb = arr.nbytes / 1e9
+
+    def bestTime(func, repeats = 3):
+        best = None
+        for ii in range(repeats):
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def original():
+        hashAlg = hashlib.sha1()
+        hashAlg.update(arr)
+        return hashAlg.hexdigest()
+
+    def cold(name):
+        _hashMemo.clear()
+        return arrayDigest(arr, name)
+
+    print 'Hashing a %.0f MB array' % (arr.nbytes / 1e6)
+    print '%-22s %10s %16s' % ('algorithm', 'GB/s', 'memo hit (ms)')
+    print '%-22s %10.2f %16s' % ('sha1 (original)', gb / bestTime(original), '-')
+    for name in ('sha1', 'md5', 'blake2b', 'xxh64', 'xxh128'):
+        try:
+            newHashAlg(name)
+        except Exception:
+            print '%-22s %10s' % (name, 'n/a')
+            continue
+        coldTime = bestTime(lambda : cold(name))
+        arrayDigest(arr, name)
+        hitTime = bestTime(lambda : arrayDigest(arr, name))
+        print '%-22s %10.2f %16.3f' % (name, gb / coldTime, hitTime * 1000)
+
+
+
+def main():
+    global globalCacheDir
+
+    parser = argparse.ArgumentParser(description='Inspects and manages the cache used by memoize / cached.')
+    parser.add_argument('--dir', type = str, default = None, help = 'Cache directory (default: %s)' % globalCacheDir)
+    subparsers = parser.add_subparsers(dest = 'command')
+    inspectParser = subparsers.add_parser('inspect', help = 'Show cache size by function and the largest entries')
+    inspectParser.add_argument('--largest', type = int, default = 10, help = 'Number of largest entries to show')
+    subparsers.add_parser('stats', help = 'Show hit rates per function')
+    pruneParser = subparsers.add_parser('prune', help = 'Evict entries until the cache is under a size')
+    pruneParser.add_argument('maxSizeMB', type = float, help = 'Size to prune the cache to, in MB')
+    pruneParser.add_argument('--policy', type = str, choices = ('lru', 'lfu'), default = None,
+                             help = 'Eviction order (default: %s)' % globalCacheEvictionPolicy)
+    pruneParser.add_argument('--dry-run', action = 'store_true', help = 'Only list what would be removed')
+    benchParser = subparsers.add_parser('benchhash', help = 'Benchmark hashing throughput of large arrays')
+    benchParser.add_argument('--size', type = float, default = 256, help = 'Array size in MB (default: 256)')
+    subparsers.add_parser('demo', help = 'Run a small caching demo')
+    args = parser.parse_args()
+
+    if args.dir:
+        globalCacheDir = args.dir
+
+    if args.command == 'inspect':
+        inspectCache(nLargest = args.largest)
+    elif args.command == 'stats':
+        cacheHitRates()
+    elif args.command == 'prune':
+        pruneCache(args.maxSizeMB, policy = args.policy, dryRun = args.dry_run)
+    elif args.command == 'benchhash':
+        benchHash(sizeMB = args.size)
+    else:
+        demo()
 
 
 
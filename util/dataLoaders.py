@@ -10,8 +10,9 @@ import sys
 import scipy
 import scipy.io
 
-from fileIO import loadFromPklGz, saveToFile
+from fileIO import loadFromPklGz, saveToFile, datasetPath, isDataset, saveDataset, loadDataset
 from cache import cached, cached2, cached2jm
+from patchSampler import randomPatchCoords, gatherPatches, PatchSource
 
 
 
@@ -76,9 +77,15 @@ def loadCifarDataSubsets(cifarDirectory, size, topLeftCoords):
 
 
 
+# The loaders below return a memmap from the dataset for filename (see
+# util.fileIO.datasetPath) if there is one, and otherwise read filename
+# itself, a .pkl.gz file.
+
 def loadAtariData(filename):
     '''Loads Atari Data'''
 
+    if isDataset(filename):
+        return loadDataset(filename)[0]['data']
     data = loadFromPklGz(filename)
     data = data.T   # Make into one example per column
     return data
@@ -88,6 +95,8 @@ def loadAtariData(filename):
 def loadUpsonData(filename):
     '''Loads Upson Data'''
 
+    if isDataset(filename):
+        return loadDataset(filename)[0]['data']
     data = loadFromPklGz(filename)
     data = data.T   # Make into one example per column
     return data
@@ -97,6 +106,9 @@ def loadUpsonData(filename):
 def loadUpsonData3(filename):
     '''Loads Upson Data from the upson_rovio_3 dataset (with labels)'''
 
+    if isDataset(filename):
+        arrays, labelStrings = loadDataset(filename)
+        return arrays['data'], arrays['labels'], labelStrings
     data,labels,labelStrings = loadFromPklGz(filename)
     data = data.T   # Make into one example per column
     labels = labels.T
@@ -107,12 +119,140 @@ def loadUpsonData3(filename):
 def loadRandomData(filename):
     '''Loads Random Data'''
 
+    if isDataset(filename):
+        return loadDataset(filename)[0]['data']
     data = loadFromPklGz(filename)
     return data
 
 
 
-def loadNYU2Data(patchSize, number, rgbColors = 3, depthChannels = 1, seed = None, filename = '../data/nyu_local/nyu_depth_v2_labeled.mat'):
+def saveLoadedDataset(filename, loaded, compression = None, quiet = False):
+    '''Saves data in the form returned by the loaders above (data, or
+    a (data, labels, labelStrings) tuple, one example per column) as
+    the dataset for filename.'''
+
+    if type(loaded) is tuple:
+        data, labels, labelStrings = loaded
+        saveDataset(filename, data, labels = labels, labelStrings = list(labelStrings), compression = compression, quiet = quiet)
+    else:
+        saveDataset(filename, loaded, compression = compression, quiet = quiet)
+
+
+
+def convertToDataset(filename, loader, compression = None):
+    '''Converts the .pkl.gz file filename, as read by loader (one of
+    the loaders above), to a dataset next to it (see
+    util.fileIO.datasetPath). Does nothing if the dataset exists.'''
+
+    if isDataset(filename):
+        print 'Dataset %s already exists' % datasetPath(filename)
+        return
+    saveLoadedDataset(filename, loader(filename), compression = compression)
+
+
+
+def openNYU2Data(filename = '../data/nyu_local/nyu_depth_v2_labeled.mat'):
+    '''Opens nyu_depth_v2_labeled.mat (an HDF5 file) once per process.
+    Only the small name lists are read; images, depths, and labels are
+    kept as h5py datasets, from which loadNYU2Data reads just the
+    images it samples from.'''
+
+    import h5py
+
+    if loadNYU2Data._loaded and loadNYU2Data._filename == filename:
+        return
+    ff = h5py.File(filename, 'r')
+    loadNYU2Data._file = ff
+    loadNYU2Data._filename = filename
+    loadNYU2Data._depths = ff['depths']
+    loadNYU2Data._images = ff['images']
+    loadNYU2Data._labels = ff['labels']
+    referencedObjects = ff['#refs#']
+    loadNYU2Data._names = []
+    for ref in ff['names'][0]:
+        name = ''.join([str(unichr(x)) for x in referencedObjects[ref]])
+        loadNYU2Data._names.append(name)
+    loadNYU2Data._scenes = []
+    for ref in ff['scenes'][0]:
+        name = ''.join([str(unichr(x)) for x in referencedObjects[ref]])
+        loadNYU2Data._scenes.append(name)
+    loadNYU2Data._sceneTypes = []
+    for ref in ff['sceneTypes'][0]:
+        name = ''.join([str(unichr(x)) for x in referencedObjects[ref]])
+        loadNYU2Data._sceneTypes.append(name)
+    loadNYU2Data._loaded = True
+
+
+
+def resetNYU2Data():
+    '''Forgets the file opened by openNYU2Data, so the next load opens
+    it again. Call this first in processes forked after it was opened:
+    h5py file handles must not be shared across fork.'''
+
+    loadNYU2Data._loaded = False
+    loadNYU2Data._file = None
+    loadNYU2Data._filename = None
+    loadNYU2Data._depths = None
+    loadNYU2Data._images = None
+    loadNYU2Data._labels = None
+
+
+
+def nyu2StoreDirectory(filename):
+    return os.path.splitext(filename)[0] + '_store'
+
+
+
+def transcodeNYU2Data(filename = '../data/nyu_local/nyu_depth_v2_labeled.mat'):
+    '''Copies images, depths, and labels from the .mat file, one image
+    at a time, into images.npy (uint8, shape (1449, 480, 640, 3)),
+    depths.npy and labels.npy (shape (1449, 480, 640)) in
+    nyu2StoreDirectory(filename). These are C ordered as (image, ii,
+    jj[, channel]), so each row of a patch is contiguous, and
+    loadNYU2Data memory maps them instead of reading the .mat file.'''
+
+    from numpy.lib.format import open_memmap
+
+    openNYU2Data(filename)
+    storeDirectory = nyu2StoreDirectory(filename)
+    if not os.path.exists(storeDirectory):
+        os.makedirs(storeDirectory)
+    # labels.npy is written last and marks a complete store
+    for name, dataset in (('images', loadNYU2Data._images), ('depths', loadNYU2Data._depths), ('labels', loadNYU2Data._labels)):
+        print 'transcodeNYU2Data: writing %s.npy' % name
+        # (N, 3, jj, ii) -> (N, ii, jj, 3) and (N, jj, ii) -> (N, ii, jj)
+        axes = (0,3,2,1) if len(dataset.shape) == 4 else (0,2,1)
+        shape = tuple([dataset.shape[ax] for ax in axes])
+        tmpFile = os.path.join(storeDirectory, '%s.npy.%d.tmp' % (name, os.getpid()))
+        out = open_memmap(tmpFile, mode = 'w+', dtype = dataset.dtype, shape = shape)
+        for idx in xrange(shape[0]):
+            out[idx] = dataset[idx].transpose([ax-1 for ax in axes[1:]])
+        out.flush()
+        del out
+        os.rename(tmpFile, os.path.join(storeDirectory, '%s.npy' % name))
+
+
+
+def _nyu2PatchSources(images, depths, rgbColors, depthChannels):
+    '''PatchSources for images (N, ii, jj, 3) and depths (N, ii, jj).'''
+
+    rgb2L = array([.299, .587, .114])  # same as PIL
+
+    # Color values are normalized to 0-1 range, depths approximately
+    # (loadNYU2Data._depths.min() = 0.71329951, loadNYU2Data._depths.max() = 9.99547)
+    sources = []
+    if rgbColors == 3:
+        sources.append(PatchSource(images, divisor = 255))
+    elif rgbColors == 1:
+        sources.append(PatchSource(images, divisor = 255, channelMix = rgb2L))
+    if depthChannels > 0:
+        sources.append(PatchSource(depths, divisor = 10))
+    return sources
+
+
+
+def loadNYU2Data(patchSize, number, rgbColors = 3, depthChannels = 1, seed = None, filename = '../data/nyu_local/nyu_depth_v2_labeled.mat',
+                 imagesPerRead = 32):
     '''Load the supervised portion of the NYU2 dataset direclty from the
     nyu_depth_v2_labeled.mat file. See:
     http://cs.nyu.edu/~silberman/datasets/nyu_depth_v2.html
@@ -125,103 +265,75 @@ def loadNYU2Data(patchSize, number, rgbColors = 3, depthChannels = 1, seed = Non
     Note: For color images, data flattens to [ii_r ii_g ii_b      ii+1_r ii+1_g ii+1_b ...]
           For RGBD images, data  flattens to [ii_r ii_g ii_b ii_d ii+1_r ii+1_g ii+1_b ii+1_d ...]
 
+    The dataset is never loaded into memory as a whole. If a store
+    written by transcodeNYU2Data exists, patches are gathered from its
+    memory mapped arrays. Otherwise the sampled images are read from
+    the .mat file imagesPerRead at a time, in order, and each group's
+    patches are gathered before the next group is read.
     '''
     
-    import h5py
-
     assert rgbColors in (0, 1, 3)
     assert depthChannels in (0, 1)
     nChannels = rgbColors + depthChannels
     assert nChannels > 0, 'Must load something!'
-    
-    if not loadNYU2Data._loaded:
-        # load data into memory, only once. Takes ~1 min.
-        print 'loadNYU2Data: loading', filename, '(could take a while)...',
-        sys.stdout.flush()
-        ff = h5py.File(filename, 'r')
-        loadNYU2Data._depths = array(ff['depths'])
-        loadNYU2Data._images = array(ff['images'])
-        loadNYU2Data._labels = array(ff['labels'])
-        referencedObjects = ff['#refs#']
-        loadNYU2Data._names = []
-        for ref in ff['names'][0]:
-            name = ''.join([str(unichr(x)) for x in referencedObjects[ref]])
-            loadNYU2Data._names.append(name)
-        loadNYU2Data._scenes = []
-        for ref in ff['scenes'][0]:
-            name = ''.join([str(unichr(x)) for x in referencedObjects[ref]])
-            loadNYU2Data._scenes.append(name)
-        loadNYU2Data._sceneTypes = []
-        for ref in ff['sceneTypes'][0]:
-            name = ''.join([str(unichr(x)) for x in referencedObjects[ref]])
-            loadNYU2Data._sceneTypes.append(name)
-        loadNYU2Data._loaded = True
-        print 'done.'
-
-    rng = random.RandomState(seed)      # if seed is None, this takes its seed from timer
 
-    # loadNYU2Data._images.shape = (1449, 3, 640, 480)  <-- note this is jj,ii
-    # loadNYU2Data._depths.shape = (1449, 640, 480)     <-- note this is jj,ii
-    # loadNYU2Data._labels.shape = (1449, 640, 480)     <-- note this is jj,ii
-    Nimages = loadNYU2Data._images.shape[0]
-    maxI = loadNYU2Data._images.shape[3] - patchSize[0]
-    maxJ = loadNYU2Data._images.shape[2] - patchSize[1]
-
-    randomSamples = vstack((rng.randint(0, Nimages, number),
-                            rng.randint(0, maxI+1, number),
-                            rng.randint(0, maxJ+1, number))).T
-    singleChannelLength = patchSize[0] * patchSize[1]
-    imageMatrix = zeros((number, singleChannelLength * nChannels), dtype = numpy.float32)
-    labelMatrix = zeros((number, singleChannelLength), dtype = numpy.uint16)
+    storeDirectory = nyu2StoreDirectory(filename)
+    useStore = os.path.exists(os.path.join(storeDirectory, 'labels.npy'))
+    if useStore:
+        images = numpy.load(os.path.join(storeDirectory, 'images.npy'), mmap_mode = 'r')
+        depths = numpy.load(os.path.join(storeDirectory, 'depths.npy'), mmap_mode = 'r')
+        labels = numpy.load(os.path.join(storeDirectory, 'labels.npy'), mmap_mode = 'r')
+        imageShape = images.shape[1:3]
+    else:
+        openNYU2Data(filename)
+        # loadNYU2Data._images.shape = (1449, 3, 640, 480)  <-- note this is jj,ii
+        # loadNYU2Data._depths.shape = (1449, 640, 480)     <-- note this is jj,ii
+        # loadNYU2Data._labels.shape = (1449, 640, 480)     <-- note this is jj,ii
+        imageShape = (loadNYU2Data._labels.shape[2], loadNYU2Data._labels.shape[1])
+    Nimages = labels.shape[0] if useStore else loadNYU2Data._labels.shape[0]
 
-    rgb2L = array([.299, .587, .114])  # same as PIL
+    rng = random.RandomState(seed)      # if seed is None, this takes its seed from timer
+    randomSamples = randomPatchCoords(rng, Nimages, imageShape, patchSize, number)
 
     print 'loadNYU2Data: grabbing', number, 'samples (could take a while)...',
     sys.stdout.flush()
 
-    for count, sample in enumerate(randomSamples):
-        idx, ii, jj = sample
-        if count % 10000 == 0:
-            #print 'loadNYU2Data: %d / %d' % (count, number)
-            pass
-
-        if rgbColors > 0:
-            # Grab imgRegion
-            imgRegion = array(loadNYU2Data._images[idx,:,jj:(jj+patchSize[1]),ii:(ii+patchSize[0])].transpose((2,1,0)),
-                              order = 'C', copy = True, dtype = numpy.float32)
-            imgRegion /= 255    # normalize to 0-1 range
-
-            if rgbColors == 1:
-                # grayscale images, no depth
-                imgRegion = dot(reshape(imgRegion, (-1,3)), rgb2L)
-                imgRegion = reshape(imgRegion, imgRegion.shape + (1,))
-
-        if depthChannels > 0:
-            # Grab depRegion
-            depRegion = copy(loadNYU2Data._depths[idx,  jj:(jj+patchSize[1]),ii:(ii+patchSize[0])].T, order='C')
-            depRegion = reshape(depRegion, depRegion.shape + (1,))
-            # loadNYU2Data._depths.min() = 0.71329951, loadNYU2Data._depths.max() = 9.99547
-            depRegion /= 10     # approx normalize to 0-1 range
-
-        if rgbColors == 0:
-            concatRegion = depRegion
-        elif depthChannels == 0:
-            concatRegion = imgRegion
-        else:
-            concatRegion = concatenate((imgRegion, depRegion), axis = 2)
-        imageMatrix[count,:] = concatRegion.flatten()
-
-        labelRegion = copy(loadNYU2Data._labels[idx, jj:(jj+patchSize[1]),ii:(ii+patchSize[0])].T, order='C')
-        labelMatrix[count,:] = labelRegion.flatten()
+    if useStore:
+        imageMatrix = gatherPatches(_nyu2PatchSources(images, depths, rgbColors, depthChannels),
+                                    randomSamples, patchSize, dtype = numpy.float32)
+        labelMatrix = gatherPatches(labels, randomSamples, patchSize, dtype = numpy.uint16)
+    else:
+        singleChannelLength = patchSize[0] * patchSize[1]
+        imageMatrix = zeros((number, singleChannelLength * nChannels), dtype = numpy.float32)
+        labelMatrix = zeros((number, singleChannelLength), dtype = numpy.uint16)
+
+        def readImages(dataset, group):
+            # Transposed views, so all stacks are (image, ii, jj[, channel])
+            stack = numpy.array([dataset[idx] for idx in group])
+            return stack.transpose((0,3,2,1) if stack.ndim == 4 else (0,2,1))
+
+        used = numpy.unique(randomSamples[:,0])
+        for start in xrange(0, len(used), imagesPerRead):
+            group = used[start:start+imagesPerRead]
+            rows = numpy.nonzero((randomSamples[:,0] >= group[0]) & (randomSamples[:,0] <= group[-1]))[0]
+            local = randomSamples[rows]
+            local[:,0] = numpy.searchsorted(group, local[:,0])
+            images = readImages(loadNYU2Data._images, group) if rgbColors > 0 else None
+            depths = readImages(loadNYU2Data._depths, group) if depthChannels > 0 else None
+            imageMatrix[rows] = gatherPatches(_nyu2PatchSources(images, depths, rgbColors, depthChannels),
+                                              local, patchSize, dtype = numpy.float32)
+            labelMatrix[rows] = gatherPatches(readImages(loadNYU2Data._labels, group), local, patchSize, dtype = numpy.uint16)
 
     print 'done.'
     # one example per column
     return imageMatrix.T, labelMatrix.T
 
-# Note: we cache the large matrices by attaching them to the function
-# instead of in a class object so that the higher level util.cache
-# framework will work
+# Note: we keep the open file and its datasets by attaching them to the
+# function instead of in a class object so that the higher level
+# util.cache framework will work
 loadNYU2Data._loaded = False
+loadNYU2Data._file = None
+loadNYU2Data._filename = None
 loadNYU2Data._depths = None
 loadNYU2Data._images = None
 loadNYU2Data._labels = None
@@ -241,33 +353,16 @@ def loadCS294Images(patchSize = (8,8), number = 10000, seed = None, filename = '
 
     rng = random.RandomState(seed)      # if seed is None, this takes its seed from timer
 
-    # loadNYU2Data._images.shape = (1449, 3, 640, 480)  <-- note this is jj,ii
-    # loadNYU2Data._depths.shape = (1449, 640, 480)     <-- note this is jj,ii
-    # loadNYU2Data._labels.shape = (1449, 640, 480)     <-- note this is jj,ii
-    Nimages = images.shape[2]
-    maxI = images.shape[0] - patchSize[0]
-    maxJ = images.shape[1] - patchSize[1]
+    # images.shape = (512, 512, 10)  <-- note the image index is last
+    stack = images.transpose((2,0,1))
+    Nimages = stack.shape[0]
 
-    randomSamples = vstack((rng.randint(0, Nimages, number),
-                            rng.randint(0, maxI+1, number),
-                            rng.randint(0, maxJ+1, number))).T
-    singleChannelLength = patchSize[0] * patchSize[1]
-    imageMatrix = zeros((number, singleChannelLength), dtype = numpy.float32)
+    randomSamples = randomPatchCoords(rng, Nimages, stack.shape[1:3], patchSize, number)
 
     print 'loadCS294Images: grabbing', number, 'samples (could take a while)...',
     sys.stdout.flush()
 
-    for count, sample in enumerate(randomSamples):
-        idx, ii, jj = sample
-        if count % 10000 == 0:
-            #print 'loadNYU2Data: %d / %d' % (count, number)
-            pass
-
-        # Grab imgRegion
-        imgRegion = array(images[ii:(ii+patchSize[0]), jj:(jj+patchSize[1]), idx],
-                          order = 'C', copy = True, dtype = numpy.float32)
-
-        imageMatrix[count,:] = imgRegion.flatten()
+    imageMatrix = gatherPatches(stack, randomSamples, patchSize, dtype = numpy.float32)
 
     print 'done.'
 
@@ -13,13 +13,20 @@ from util.cache import cached, PersistentHasher
 class PCAWhiteningDataNormalizer(object):
     '''Uses PCA to white data and optionally project points to the unit ball.'''
 
-    def __init__(self, data, saveDir = None):
+    def __init__(self, data, saveDir = None, chunkSize = None):
         '''Create DataPrepPCA object.
-        data: 1 example per column
+        data: 1 example per column, or a function returning an iterator
+            over such arrays (chunks of examples), see PCA
         saveDir: If set to a string DIR, saves DIR/fracVar.{png,pdf}
+        chunkSize: if set, fit the PCA streaming over this many
+            examples at a time (always done for chunks)
         '''
 
-        self.pca = PCA(data.T)
+        if callable(data):
+            self.pca = PCA(lambda : (chunk.T for chunk in data()))
+        else:
+            self.pca = PCA(data.T, chunkSize = chunkSize)
+        self._zca = None
 
         if saveDir:
             pyplot.figure()
@@ -30,12 +37,30 @@ class PCAWhiteningDataNormalizer(object):
             pyplot.close()
 
 
+    def zcaMatrices(self):
+        '''Returns (WW, bb, WWinv), computed once and then reused, such
+        that dot(WW, data) - bb is the same as
+        pca.toZca(data.T, epsilon = 1e-6).T and dot(WWinv, zca) + mu
+        is the same as pca.fromZca(zca.T, epsilon = 1e-6).T, with
+        WW = UU diag(1/sqrt(ss + 1e-6)) UU.T and bb = dot(WW, mu).'''
+
+        if getattr(self, '_zca', None) is None:     # older pickles lack _zca
+            UU, ss = self.pca.UU, self.pca.ss
+            WW     = dot(UU / sqrt(ss + 1e-6), UU.T)
+            WWinv  = dot(UU * sqrt(ss + 1e-6), UU.T)
+            self._zca = (WW, dot(WW, self.pca.mu), WWinv)
+        return self._zca
+
+
     def raw2normalized(self, data, unitNorm = True):
         '''Projects points from raw space to normalized space.
         returns: (data, extra), where extra may be extra information needed to project back from normalized -> raw
         '''
 
-        data = self.pca.toZca(data.T, epsilon = 1e-6).T
+        # Whitening is one matrix product, then the bias is subtracted in place
+        WW, bb, WWinv = self.zcaMatrices()
+        data = dot(WW, data)
+        data -= bb[:,newaxis]
         
         #if saveDir and self.doPlots:
         #    image = Image.fromarray(tile_raster_images(
@@ -58,7 +83,7 @@ class PCAWhiteningDataNormalizer(object):
         if unitNorm:
             # Project each patch to the unit ball
             patchNorms = sqrt(sum(data**2, 0) + (1e-8))
-            data = data / patchNorms
+            data /= patchNorms
             extra = {'patchNorms': patchNorms}
         else:
             extra = {}
@@ -73,7 +98,17 @@ class PCAWhiteningDataNormalizer(object):
     def normalized2raw(self, data, extra = None):
         '''Projects points from raw space to normalized space.'''
 
-        return self.pca.fromZca(data.T, epsilon = 1e-6).T
+        WW, bb, WWinv = self.zcaMatrices()
+        data = dot(WWinv, data)
+        data += self.pca.mu[:,newaxis]
+        return data
+
+
+    def __getstate__(self):
+        # The ZCA matrices are cheap to recompute from pca
+        state = self.__dict__.copy()
+        state.pop('_zca', None)
+        return state
 
 
     def __hash__(self):
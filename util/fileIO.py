@@ -1,7 +1,22 @@
 #! /usr/bin/env python
 
+import os
+import json
+import zlib
+import shutil
 import cPickle as pickle
 import gzip
+import numpy
+from numpy.lib.format import open_memmap
+
+try:
+    import blosc
+except ImportError:
+    blosc = None      # only needed for blosc compressed datasets
+try:
+    import zstd
+except ImportError:
+    zstd = None       # only needed for zstd compressed datasets
 
 
 
@@ -18,3 +33,178 @@ def loadFromPklGz(filename):
     with gzip.open(filename, 'rb') as ff:
         ret = pickle.load(ff)
     return ret
+
+
+
+######################
+# Datasets
+######################
+#
+# A dataset is a directory (by convention named like foo.dset) holding
+# one or more 2D arrays with one example per column, plus a
+# manifest.json describing them:
+#
+#   foo.dset/manifest.json
+#   foo.dset/data.npy          uncompressed arrays are .npy files stored
+#   foo.dset/labels.npy        in Fortran order, so each example is contiguous
+#   foo.dset/data.zlib         compressed arrays are a sequence of independently
+#                              compressed chunks of chunkExamples examples
+#
+# Uncompressed arrays are loaded as memmaps, so loading is nearly
+# instant and only the examples actually used are read from disk.
+
+datasetVersion = 1
+
+# Large enough to compress well, small enough to decompress in cache
+defaultChunkExamples = 4096
+
+
+
+def datasetPath(filename):
+    '''Path of the dataset for filename: foo.pkl.gz -> foo.dset.
+    Dataset paths are returned unchanged.'''
+    filename = filename.rstrip('/')
+    if filename.endswith('.pkl.gz'):
+        filename = filename[:-len('.pkl.gz')]
+    if not filename.endswith('.dset'):
+        filename += '.dset'
+    return filename
+
+
+
+def isDataset(filename):
+    '''Whether the dataset for filename (see datasetPath) exists.'''
+    return os.path.exists(os.path.join(datasetPath(filename), 'manifest.json'))
+
+
+
+def _codec(compression):
+    '''Returns (compress(buf, itemsize), decompress(buf)) for a dataset compression.'''
+    if compression == 'zlib':
+        return (lambda buf, itemsize: zlib.compress(buf, 1)), zlib.decompress
+    elif compression == 'blosc':
+        if blosc is None:
+            raise Exception('Dataset compression blosc requires the blosc package')
+        return (lambda buf, itemsize: blosc.compress(buf, typesize = itemsize, shuffle = blosc.SHUFFLE)), blosc.decompress
+    elif compression == 'zstd':
+        if zstd is None:
+            raise Exception('Dataset compression zstd requires the zstd package')
+        return (lambda buf, itemsize: zstd.compress(buf, 3)), zstd.decompress
+    else:
+        raise Exception('Unknown dataset compression: %s' % repr(compression))
+
+
+
+def saveDataset(filename, data, labels = None, labelStrings = None, compression = None, chunkExamples = None, quiet = False):
+    '''Saves data and, optionally, labels (2D arrays with one example
+    per column) and labelStrings as a dataset at datasetPath(filename).
+
+    compression: None to store .npy files that load as memmaps, or
+        'zlib', 'blosc', or 'zstd' to compress chunks of chunkExamples
+        examples at a time (smaller, but loaded fully into memory).
+
+    The dataset is written to a temporary directory and then renamed,
+    so a partially written dataset is never seen by the loaders.'''
+
+    dirname = datasetPath(filename)
+    if chunkExamples is None:
+        chunkExamples = defaultChunkExamples
+    arrays = [('data', data)] + ([] if labels is None else [('labels', labels)])
+
+    if compression is not None:
+        _codec(compression)    # fail early if unavailable
+
+    tmpDir = '%s.%d.tmp' % (dirname, os.getpid())
+    if os.path.exists(tmpDir):
+        shutil.rmtree(tmpDir)
+    os.makedirs(tmpDir)
+    try:
+        manifest = _writeDatasetArrays(tmpDir, arrays, compression, chunkExamples)
+        manifest['labelStrings'] = labelStrings
+        with open(os.path.join(tmpDir, 'manifest.json'), 'w') as ff:
+            json.dump(manifest, ff, indent = 1)
+    except:
+        shutil.rmtree(tmpDir)
+        raise
+
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpDir, dirname)
+    if not quiet:
+        print 'saved dataset to', dirname
+
+
+
+def _writeDatasetArrays(dirname, arrays, compression, chunkExamples):
+    '''Writes each (name, array) in arrays into dirname. Returns the manifest.'''
+
+    manifest = {'version': datasetVersion, 'arrays': {}}
+    for name, array in arrays:
+        array = numpy.asarray(array)
+        if array.ndim != 2:
+            raise Exception('Expected %s to be 2D (one example per column) but it has shape %s' % (name, repr(array.shape)))
+        info = {'shape': array.shape, 'dtype': array.dtype.str, 'compression': compression}
+        if compression is None:
+            info['file'] = name + '.npy'
+            out = open_memmap(os.path.join(dirname, info['file']), mode = 'w+', dtype = array.dtype, shape = array.shape,
+                              fortran_order = True)
+            out[:] = array
+            out.flush()
+            del out
+        else:
+            compress, decompress = _codec(compression)
+            info['file'] = name + '.' + compression
+            info['chunkExamples'] = chunkExamples
+            info['chunks'] = []
+            offset = 0
+            with open(os.path.join(dirname, info['file']), 'wb') as ff:
+                for begin in xrange(0, array.shape[1], chunkExamples):
+                    buf = compress(array[:,begin:begin+chunkExamples].tostring(order = 'F'), array.dtype.itemsize)
+                    ff.write(buf)
+                    info['chunks'].append((offset, len(buf)))
+                    offset += len(buf)
+        manifest['arrays'][name] = info
+    return manifest
+
+
+
+def loadDataset(filename, mmapMode = 'c'):
+    '''Loads the dataset at datasetPath(filename). Returns (arrays,
+    labelStrings), where arrays maps 'data' (and 'labels', if saved)
+    to 2D arrays with one example per column.
+
+    Uncompressed arrays are memmaps opened with mmapMode. The default,
+    'c' (copy on write), allows modifying the arrays in memory without
+    changing the files.'''
+
+    dirname = datasetPath(filename)
+    with open(os.path.join(dirname, 'manifest.json')) as ff:
+        manifest = json.load(ff)
+    if manifest['version'] > datasetVersion:
+        raise Exception('Dataset %s has version %d, but only versions up to %d are supported'
+                        % (dirname, manifest['version'], datasetVersion))
+
+    arrays = {}
+    for name, info in manifest['arrays'].iteritems():
+        path = os.path.join(dirname, info['file'])
+        shape = tuple(info['shape'])
+        if info['compression'] is None:
+            arrays[name] = numpy.load(path, mmap_mode = mmapMode)
+        else:
+            compress, decompress = _codec(info['compression'])
+            dtype = numpy.dtype(info['dtype'])
+            array = numpy.empty(shape, dtype = dtype, order = 'F')
+            with open(path, 'rb') as ff:
+                for ii, (offset, length) in enumerate(info['chunks']):
+                    ff.seek(offset)
+                    chunk = numpy.frombuffer(decompress(ff.read(length)), dtype = dtype)
+                    begin = ii * info['chunkExamples']
+                    array[:,begin:begin+info['chunkExamples']] = chunk.reshape((shape[0], -1), order = 'F')
+            arrays[name] = array
+        if arrays[name].shape != shape:
+            raise Exception('Expected %s in %s to have shape %s but got %s' % (name, dirname, repr(shape), repr(arrays[name].shape)))
+
+    labelStrings = manifest['labelStrings']
+    if labelStrings is not None:
+        labelStrings = [str(ss) for ss in labelStrings]     # json gives unicode, the .pkl.gz files had str
+    return arrays, labelStrings
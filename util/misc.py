@@ -3,6 +3,7 @@
 import os, errno
 import time
 from numpy import tanh, arctanh, sqrt, mean, absolute
+from numpy.lib.stride_tricks import as_strided
 
 
 
@@ -77,6 +78,46 @@ def rms(data):
 
 
 
+def stridedWindows(arr, windowShape, step, axis = 0):
+    '''Returns a read-only view of arr containing every window of
+    shape windowShape, taken every step elements along the
+    len(windowShape) axes starting at axis. No data is copied.
+
+    For arr.shape = (A, B, C, D), windowShape = (w0, w1), step = (s0, s1)
+    and axis = 1, the returned view has shape
+
+        (A, n0, n1, w0, w1, D)    where n_k = 1 + (shape_k - w_k) / s_k
+
+    and view[a, i, j, :, :, d] = arr[a, i*s0:i*s0+w0, j*s1:j*s1+w1, d].
+    Trailing elements that do not fill a whole window are ignored.
+    '''
+
+    windowShape = tuple(windowShape)
+    step = tuple(step)
+    nDims = len(windowShape)
+    assert len(step) == nDims, 'windowShape and step must be same length'
+    assert axis >= 0 and axis + nDims <= arr.ndim, 'windowShape does not fit in arr.shape %s' % repr(arr.shape)
+
+    before = arr.shape[:axis]
+    spanned = arr.shape[axis:axis+nDims]
+    after = arr.shape[axis+nDims:]
+    spannedStrides = arr.strides[axis:axis+nDims]
+    nWindows = tuple([1 + (sh - ww) / st for sh,ww,st in zip(spanned, windowShape, step)])
+    if min(nWindows) < 1 or min(step) < 1:
+        raise Exception('Cannot take windows of shape %s with step %s from shape %s'
+                        % (repr(windowShape), repr(step), repr(spanned)))
+
+    shape   = before + nWindows + windowShape + after
+    strides = (arr.strides[:axis]
+               + tuple([ss * st for ss,st in zip(spannedStrides, step)])
+               + spannedStrides
+               + arr.strides[axis+nDims:])
+    ret = as_strided(arr, shape = shape, strides = strides)
+    ret.flags.writeable = False    # windows overlap in memory
+    return ret
+
+
+
 def mkdir_p(path):
     '''Behaves like `mkdir -P` on Linux.
     From: http://stackoverflow.com/questions/600268/mkdir-p-functionality-in-python'''
@@ -0,0 +1,218 @@
+#! /usr/bin/env python
+
+'''
+Research code
+
+Jason Yosinski
+
+Vectorized random patch sampling shared by the data loaders. Images
+are kept as stacks of shape (Nimages, height, width) or (Nimages,
+height, width, channels), in memory or memory mapped (transposed
+views are fine). Patches at arrays of (image, ii, jj) coordinates are
+gathered all at once through a stridedWindows view of each stack,
+instead of slicing one window at a time in a Python loop.
+'''
+
+from numpy import *
+
+from misc import stridedWindows
+
+
+
+def randomPatchCoords(rng, nImages, imageShape, patchShape, number):
+    '''Returns a (number, 3) array of random (image, ii, jj) patch
+    coordinates. Draws from rng (a RandomState, or the numpy.random
+    module) in the order the loaders always have: all images, then all
+    rows, then all columns, so results for a given seed are unchanged.'''
+
+    maxI = imageShape[0] - patchShape[0]
+    maxJ = imageShape[1] - patchShape[1]
+    return vstack((rng.randint(0, nImages, number),
+                   rng.randint(0, maxI+1, number),
+                   rng.randint(0, maxJ+1, number))).T
+
+
+
+def loadImageStack(filenames, color):
+    '''Decodes image files with PIL into a uint8 stack of shape (N,
+    height, width) (converted to grayscale as by PIL's convert('L')) or
+    (N, height, width, 3) if color. All images must be the same size.'''
+
+    from PIL import Image
+
+    stack = None
+    for idx, filename in enumerate(filenames):
+        im = Image.open(filename).convert('RGB' if color else 'L')
+        if stack is None:
+            size = im.size
+            stack = zeros((len(filenames), size[1], size[0]) + ((3,) if color else ()), dtype = uint8)
+        if size != im.size:
+            raise Exception('Expected everything to be the same size but %s != %s' % (repr(size), repr(im.size)))
+        stack[idx] = asarray(im, dtype = uint8)
+    return stack
+
+
+
+class PatchSource(object):
+    '''One image stack to gather patches from, plus how to convert
+    them: after conversion to the output dtype, patches are divided
+    by divisor, then (if channelMix is given) multiplied by
+    channelMix, a (channels in, channels out) matrix, e.g. an
+    (3, 1) RGB to luminance matrix.'''
+
+    def __init__(self, stack, divisor = None, channelMix = None):
+        self.stack = stack
+        self.divisor = divisor
+        self.channelMix = None if channelMix is None else asarray(channelMix)
+        if self.channelMix is not None and self.channelMix.ndim == 1:
+            self.channelMix = self.channelMix[:,newaxis]
+        inChannels = stack.shape[3] if stack.ndim == 4 else 1
+        self.channels = inChannels if self.channelMix is None else self.channelMix.shape[1]
+
+
+    def gather(self, windows, idx, ii, jj, dtype):
+        patches = windows[idx, ii, jj].astype(dtype)
+        if patches.ndim == 3:
+            patches = patches[:,:,:,newaxis]
+        if self.divisor is not None:
+            patches /= self.divisor
+        if self.channelMix is not None:
+            patches = dot(patches, self.channelMix)
+        return patches
+
+
+
+def gatherPatches(sources, coords, patchShape, dtype = float32, normalize = None, batchSize = 10000):
+    '''Returns an array of shape (len(coords), prod(patchShape) *
+    channels) whose row kk is the patch of shape patchShape at
+    coords[kk] = (image, ii, jj), flattened as
+    [ii_c0 ii_c1 ... ii+1_c0 ii+1_c1 ...] (channels fastest).
+
+    sources: one PatchSource or image stack, or a list of them with
+        the same number and size of images, whose channels are
+        concatenated in order (e.g. RGB and depth for RGBD).
+    normalize: None, 'center' to subtract each patch's mean, or 'unit'
+        to also scale each patch to unit norm. Applied per batch.
+    batchSize: patches are gathered this many at a time, in order of
+        image, which bounds temporaries and keeps reads from memory
+        mapped stacks local.'''
+
+    if not isinstance(sources, (list, tuple)):
+        sources = [sources]
+    sources = [src if isinstance(src, PatchSource) else PatchSource(src) for src in sources]
+    patchShape = tuple(patchShape)
+    coords = asarray(coords)
+    nPatches = coords.shape[0]
+    channels = sum([src.channels for src in sources])
+
+    # windows[idx, ii, jj] is the patch at (ii, jj) of image idx (a view: nothing is copied until indexed)
+    windows = [stridedWindows(src.stack, patchShape, (1,1), axis = 1) for src in sources]
+
+    ret = zeros((nPatches, prod(patchShape) * channels), dtype = dtype)
+    order = argsort(coords[:,0], kind = 'mergesort')
+    for start in xrange(0, nPatches, batchSize):
+        rows = order[start:start+batchSize]
+        idx, ii, jj = coords[rows].T
+        block = empty((len(rows),) + patchShape + (channels,), dtype = dtype)
+        channel = 0
+        for src, win in zip(sources, windows):
+            block[..., channel:channel+src.channels] = src.gather(win, idx, ii, jj, dtype)
+            channel += src.channels
+        block = block.reshape(len(rows), -1)
+        if normalize in ('center', 'unit'):
+            block -= block.mean(1)[:,newaxis]
+            if normalize == 'unit':
+                block /= sqrt((block**2).sum(1) + 1e-8)[:,newaxis]
+        elif normalize is not None:
+            raise Exception('Unknown normalize option: %s' % repr(normalize))
+        ret[rows] = block
+    return ret
+
+
+
+def gatherPatchesFromFiles(filenames, coords, patchShape, color, divisor = None, dtype = float32, imagesPerRead = 1):
+    '''Like gatherPatches(PatchSource(loadImageStack(filenames, color),
+    divisor), coords, patchShape), but decodes only the images that
+    coords use, imagesPerRead at a time, gathering each group's
+    patches before the next is decoded. At most imagesPerRead frames
+    are in memory at once.'''
+
+    coords = asarray(coords)
+    order = argsort(coords[:,0], kind = 'mergesort')
+    sortedImages = coords[order,0]
+    used = unique(sortedImages)
+    ret = zeros((len(coords), prod(patchShape) * (3 if color else 1)), dtype = dtype)
+    for start in xrange(0, len(used), imagesPerRead):
+        group = used[start:start+imagesPerRead]
+        rows = order[searchsorted(sortedImages, group[0], 'left'):searchsorted(sortedImages, group[-1], 'right')]
+        local = coords[rows]
+        local[:,0] = searchsorted(group, local[:,0])
+        images = loadImageStack([filenames[idx] for idx in group], color)
+        ret[rows] = gatherPatches(PatchSource(images, divisor = divisor), local, patchShape, dtype = dtype)
+    return ret
+
+
+
+def check_gatherPatchesFromFiles():
+    '''Checks gatherPatchesFromFiles against decoding all images at once.'''
+
+    import os, tempfile, shutil
+    from PIL import Image
+
+    rng = random.RandomState(0)
+    tempDir = tempfile.mkdtemp()
+    try:
+        filenames = []
+        for idx in range(6):
+            filenames.append(os.path.join(tempDir, '%d.png' % idx))
+            Image.fromarray((rng.rand(20, 30, 3) * 255).astype(uint8)).save(filenames[-1])
+        coords = randomPatchCoords(rng, 5, (20, 30), (4, 4), 500)     # image 5 unused
+        for color in (False, True):
+            allAtOnce = gatherPatches(PatchSource(loadImageStack(filenames, color), divisor = 255), coords, (4, 4))
+            for imagesPerRead in (1, 2, 10):
+                assert (gatherPatchesFromFiles(filenames, coords, (4, 4), color, divisor = 255,
+                                               imagesPerRead = imagesPerRead) == allAtOnce).all()
+    finally:
+        shutil.rmtree(tempDir)
+    print 'check_gatherPatchesFromFiles: ok'
+
+
+
+def check_gatherPatches():
+    '''Checks gatherPatches against slicing one window at a time.'''
+
+    rng = random.RandomState(0)
+    gray  = (rng.rand(5, 20, 30) * 255).astype(uint8)
+    color = (rng.rand(5, 20, 30, 3) * 255).astype(uint8)
+    depth = rng.rand(5, 30, 20).astype(float32).transpose((0,2,1))     # transposed view, as in NYU2
+    patchShape = (4, 6)
+    coords = randomPatchCoords(rng, 5, (20, 30), patchShape, 1000)
+
+    def loop(stack, divisor):
+        ret = zeros((len(coords), prod(patchShape) * (stack.shape[3] if stack.ndim == 4 else 1)), dtype = float32)
+        for count, (idx, ii, jj) in enumerate(coords):
+            ret[count,:] = stack[idx, ii:ii+patchShape[0], jj:jj+patchShape[1]].astype(float32).flatten() / divisor
+        return ret
+
+    assert (gatherPatches(gray, coords, patchShape, batchSize = 77) == loop(gray, 1)).all()
+    assert (gatherPatches(PatchSource(color, divisor = 255), coords, patchShape) == loop(color, 255)).all()
+    rgbd = gatherPatches([PatchSource(color, divisor = 255), PatchSource(depth, divisor = 10)], coords, patchShape)
+    rgbd = rgbd.reshape(len(coords), -1, 4)
+    assert (rgbd[:,:,:3].reshape(len(coords), -1) == loop(color, 255)).all()
+    assert (rgbd[:,:,3] == loop(depth, 10)).all()
+    lum = gatherPatches(PatchSource(color, divisor = 255, channelMix = [.299, .587, .114]), coords, patchShape)
+    assert abs(lum - dot(loop(color, 255).reshape(len(coords), -1, 3), [.299, .587, .114])).max() < 1e-6
+    unit = gatherPatches(gray, coords, patchShape, normalize = 'unit')
+    assert abs(unit.mean(1)).max() < 1e-5 and abs((unit**2).sum(1) - 1).max() < 1e-4
+    print 'check_gatherPatches: ok'
+
+
+
+def tests():
+    check_gatherPatches()
+    check_gatherPatchesFromFiles()
+
+
+
+if __name__ == '__main__':
+    tests()
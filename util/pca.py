@@ -1,15 +1,51 @@
 #! /usr/bin/env ipythonpl
 
 import pdb
-from numpy import array, dot, random, linalg, sqrt, asarray, cov, eye, sum, hstack
+from numpy import array, dot, random, linalg, sqrt, asarray, cov, eye, sum, hstack, zeros, outer, float64, argsort
 from numpy.linalg import norm
 
 from cache import cached, PersistentHasher
 
 
 
+def meanAndScatter(chunks, diagonal = False):
+    '''Streams over chunks (each a numobservations x numdims array) and
+    returns (nn, mu, scatter), where nn is the total number of
+    observations, mu their mean and scatter the sum of outer products
+    of the centered observations. Each chunk is centered on its own
+    mean and merged with the running totals by the pairwise update of
+    Chan et al., which is as accurate as centering the whole data set
+    at once and needs memory for only one chunk. If diagonal, only
+    the diagonal of scatter is computed.'''
+
+    nn, mu, scatter = 0, None, None
+    for chunk in chunks:
+        chunk = asarray(chunk, dtype = float64)
+        nChunk = chunk.shape[0]
+        if nChunk == 0:
+            continue
+        muChunk = chunk.mean(axis=0)
+        centered = chunk - muChunk
+        scatterChunk = (centered**2).sum(axis=0) if diagonal else dot(centered.T, centered)
+        if nn == 0:
+            nn, mu, scatter = nChunk, muChunk, scatterChunk
+        else:
+            delta = muChunk - mu
+            total = nn + nChunk
+            scatter += scatterChunk + (delta**2 if diagonal else outer(delta, delta)) * (float(nn) * nChunk / total)
+            mu = mu + delta * (float(nChunk) / total)
+            nn = total
+    if nn == 0:
+        raise Exception('no data to compute mean and covariance of')
+    return nn, mu, scatter
+
+
+
 class PCA(object):
-    def __init__(self, xx):
+
+    defaultChunkSize = 10000    # rows per chunk for method randomized when chunkSize is not given
+
+    def __init__(self, xx, chunkSize = None, numDims = None, method = None, oversample = 10, powerIters = 4, seed = 0):
         '''
         Inspired by PCA in matplotlib.mlab
 
@@ -20,7 +56,25 @@ class PCA(object):
 
         Inputs:
 
-          *xx*: a numobservations x numdims array
+          *xx*: a numobservations x numdims array, or a function
+          returning an iterator over such arrays (chunks of the data
+          set). Chunks, and any xx if chunkSize is given (e.g. a
+          memmap too large to read at once), are streamed through
+          meanAndScatter instead of being centered and multiplied in
+          one piece, so only one chunk needs to be in memory at a time.
+
+          *chunkSize*: number of rows per chunk when streaming over
+          an array
+
+          *numDims*, *method*: method 'full' (the default unless
+          numDims is given) takes the SVD of the whole covariance
+          matrix. Method 'randomized' computes only the leading
+          numDims components by randomized subspace iteration
+          (Halko et al.) with numDims + oversample vectors and
+          powerIters passes over the data, multiplying the centered
+          data by the current basis chunk by chunk, so the numdims x
+          numdims covariance is never formed (sigma is None). toPC,
+          toZca, etc. then work on the truncated basis.
 
         Attrs:
 
@@ -37,16 +91,40 @@ class PCA(object):
           *fracVar* : the fractional amount of variance from each principal component
 
           *fracStd* : sqrt of fracVar
+
+          *capturedVar* : the fraction of the total variance captured by
+          the components kept (1 for method 'full')
         '''
 
-        self.nn, self.mm = xx.shape
-        if self.nn < self.mm:
-            raise RuntimeError('we assume data in a is organized with numrows>numcols')
+        if method is None:
+            method = 'full' if numDims is None else 'randomized'
+        if method == 'randomized':
+            if numDims is None:
+                raise Exception('method randomized requires numDims')
+            self._fitRandomized(xx, chunkSize, numDims, oversample, powerIters, seed)
+            return
+        elif method != 'full':
+            raise Exception('Unknown PCA method: %s' % repr(method))
+
+        if callable(xx) or chunkSize is not None:
+            if callable(xx):
+                chunks = xx()
+            else:
+                chunks = (xx[ii:ii+chunkSize] for ii in xrange(0, xx.shape[0], chunkSize))
+            self.nn, self.mu, scatter = meanAndScatter(chunks)
+            self.mm = self.mu.shape[0]
+            if self.nn < self.mm:
+                raise RuntimeError('we assume data in a is organized with numrows>numcols')
+            self.sigma   = scatter / self.nn
+        else:
+            self.nn, self.mm = xx.shape
+            if self.nn < self.mm:
+                raise RuntimeError('we assume data in a is organized with numrows>numcols')
 
-        self.mu          = xx.mean(axis=0)
-        centeredXX       = self.center(xx)
-        #self.sigma       = dot(centeredXX.T, centeredXX) / self.nn
-        self.sigma       = cached(dot, centeredXX.T, centeredXX) / self.nn
+            self.mu          = xx.mean(axis=0)
+            centeredXX       = self.center(xx)
+            #self.sigma       = dot(centeredXX.T, centeredXX) / self.nn
+            self.sigma       = cached(dot, centeredXX.T, centeredXX) / self.nn
 
         # Columns of UU are the eigenvectors of self.sigma, i.e. the
         # principle components. UU and VV are transpose of each other;
@@ -58,6 +136,56 @@ class PCA(object):
         self.std = sqrt(self.var)
         self.fracVar = self.var / self.var.sum()
         self.fracStd = self.std / self.std.sum()
+        self.capturedVar = 1.0
+
+
+    def _fitRandomized(self, xx, chunkSize, numDims, oversample, powerIters, seed):
+        '''Fits the leading numDims components without forming the
+        covariance (see __init__). Each pass over the data computes
+        dot(sigma, QQ) as a sum over chunks of centered rows.'''
+
+        if callable(xx):
+            getChunks = xx
+        else:
+            chunkSize = chunkSize or self.defaultChunkSize
+            getChunks = lambda : (xx[ii:ii+chunkSize] for ii in xrange(0, xx.shape[0], chunkSize))
+
+        # First pass: mean and total variance (trace of sigma)
+        self.nn, self.mu, scatterDiag = meanAndScatter(getChunks(), diagonal = True)
+        self.mm = self.mu.shape[0]
+        if self.nn < self.mm:
+            raise RuntimeError('we assume data in a is organized with numrows>numcols')
+        totalVar = scatterDiag.sum() / self.nn
+        numDims = min(numDims, self.mm)
+        nVecs = min(numDims + oversample, self.mm)
+
+        def sigmaTimes(QQ):
+            ret = zeros(QQ.shape)
+            for chunk in getChunks():
+                centered = asarray(chunk, dtype = float64) - self.mu
+                ret += dot(centered.T, dot(centered, QQ))
+            return ret / self.nn
+
+        rng = random.RandomState(seed)
+        QQ, RR = linalg.qr(rng.randn(self.mm, nVecs))
+        for ii in range(powerIters):
+            QQ, RR = linalg.qr(sigmaTimes(QQ))
+
+        # Rayleigh-Ritz: eigenvectors of sigma within the span of QQ
+        sigmaQQ = sigmaTimes(QQ)
+        evals, evecs = linalg.eigh(dot(QQ.T, sigmaQQ))
+        order = argsort(evals)[::-1][:numDims]
+
+        self.sigma = None
+        self.UU = dot(QQ, evecs[:,order])
+        self.ss = evals[order].clip(0)
+        self.VV = self.UU.T
+
+        self.var = self.ss / float(self.nn)
+        self.std = sqrt(self.var)
+        self.fracVar = self.ss / totalVar                     # fractions of the total, as for 'full'
+        self.fracStd = self.std / self.std.sum()              # only over the components kept
+        self.capturedVar = self.ss.sum() / totalVar
 
 
     def pc(self, numDims = None):
@@ -210,7 +338,7 @@ class PCA(object):
         hasher.update(self.nn)
         hasher.update(self.mm)
         hasher.update(self.mu)
-        hasher.update(self.sigma)
+        hasher.update(self.sigma if self.sigma is not None else 'no sigma')
         hasher.update(self.UU)
         hasher.update(self.ss)
         hasher.update(self.VV)